@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from typing import Iterable
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError("The analytics need numpy, pip install numpy") from e
+
+from sqlalchemy import BigInteger, cast, func, select
+
+from app.clients import DEFAULT_CHUNK_SIZE, Accounts, DBClient, Transactions, filtered, stream_rows
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+PERIODS = ("day", "week", "month", "year")
+DEFAULT_PERIOD = "month"
+
+
+# The synced transactions as columns, ordered by account and then created_at, so every account is one
+# contiguous run and per account work is a cumsum or reduceat over it instead of a loop over rows.
+# account holds indexes into account_ids (sorted). Rows without an account or created_at are left out,
+# like the daily totals do.
+@dataclass
+class TransactionArrays:
+    account_ids: list[str]
+    account: np.ndarray
+    value_base: np.ndarray
+    created_at: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.account)
+
+    @classmethod
+    def from_chunks(cls, chunks: Iterable[list[tuple]]) -> TransactionArrays:
+        # chunks of (account_id, value_base, created_at as microseconds since the epoch) rows, as load
+        # streams them. Only the arrays are kept, each chunk's tuples go once it's converted
+        codes = {}
+        accounts, values, created = [], [], []
+        for chunk in chunks:
+            if not chunk:
+                continue
+            chunk_accounts, chunk_values, chunk_created = zip(*chunk)
+            account = np.array(chunk_accounts, dtype=object)
+            # numbers convert in bulk, datetime objects would be converted one by one
+            created_at = np.array(chunk_created, dtype=np.float64)
+            keep = (account != None) & ~np.isnan(created_at)  # noqa: E711
+            labels, inverse = np.unique(account[keep].astype(str), return_inverse=True)
+            mapping = np.array([codes.setdefault(label, len(codes)) for label in labels], dtype=np.int64)
+            accounts.append(mapping[inverse])
+            # a NULL value_base counts as 0
+            values.append(np.nan_to_num(np.array(chunk_values, dtype=np.float64)[keep]).astype(np.int64))
+            created.append(created_at[keep].astype(np.int64).astype("datetime64[us]"))
+        if not accounts:
+            return cls([], np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, "datetime64[us]"))
+        account_ids = sorted(codes)
+        # codes were handed out in the order accounts showed up, renumbered so they sort like the ids
+        renumber = np.zeros(len(codes), dtype=np.int64)
+        renumber[[codes[id] for id in account_ids]] = np.arange(len(account_ids))
+        account = renumber[np.concatenate(accounts)]
+        created_at = np.concatenate(created)
+        order = np.lexsort((created_at, account))
+        return cls(account_ids, account[order], np.concatenate(values)[order], created_at[order])
+
+    @classmethod
+    def load(
+        cls,
+        session: DBClient.session,
+        account_id: str | list[str] = None,
+        since: str = None,
+        until: str = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> TransactionArrays:
+        # created_at is stored without an offset, its epoch is taken as if it were UTC so the dates don't move
+        created_at = cast(func.extract("epoch", Transactions.created_at) * 1_000_000, BigInteger)
+        query = filtered(
+            select(Transactions.account_id, Transactions.value_base, created_at), Transactions.account_id, account_id
+        )
+        if since:
+            query = query.where(Transactions.created_at >= since)
+        if until:
+            query = query.where(Transactions.created_at < until)
+        return cls.from_chunks(stream_rows(session, query, chunk_size))
+
+    def starts(self, *keys: np.ndarray) -> np.ndarray:
+        # index of the first row of every run of the same account (and keys)
+        if not len(self):
+            return np.zeros(0, dtype=np.int64)
+        changed = np.zeros(len(self), dtype=bool)
+        changed[0] = True
+        for key in (self.account, *keys):
+            changed[1:] |= key[1:] != key[:-1]
+        return np.flatnonzero(changed)
+
+
+@dataclass
+class PeriodTotals:
+    # one entry per account and period with transactions, closing_base is the account's running balance
+    # after the period's last transaction
+    account_id: np.ndarray
+    period: np.ndarray
+    debit_base: np.ndarray
+    credit_base: np.ndarray
+    count: np.ndarray
+    closing_base: np.ndarray
+
+    def rows(self) -> list[dict]:
+        columns = {name: getattr(self, name).tolist() for name in self.__dataclass_fields__}
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+def period_starts(created_at: np.ndarray, period: str = DEFAULT_PERIOD) -> np.ndarray:
+    # the first day of each timestamp's period, weeks start on a Monday
+    days = created_at.astype("datetime64[D]")
+    if period == "day":
+        return days
+    if period == "week":
+        # numpy's day 0, 1970-01-01, was a Thursday
+        offsets = (days.astype(np.int64) + 3) % 7
+        return days - offsets.astype("timedelta64[D]")
+    if period == "month":
+        return created_at.astype("datetime64[M]").astype("datetime64[D]")
+    if period == "year":
+        return created_at.astype("datetime64[Y]").astype("datetime64[D]")
+    raise ValueError(f"Unknown period {period}, expected one of {', '.join(PERIODS)}")
+
+
+def running_balances(data: TransactionArrays) -> np.ndarray:
+    # each transaction's account balance after it, counted from the account's first synced transaction
+    totals = np.cumsum(data.value_base)
+    starts = data.starts()
+    before = np.concatenate(([0], totals))[starts]
+    return totals - np.repeat(before, np.diff(np.append(starts, len(data))))
+
+
+def period_totals(data: TransactionArrays, period: str = DEFAULT_PERIOD) -> PeriodTotals:
+    periods = period_starts(data.created_at, period)
+    balances = running_balances(data)
+    starts = data.starts(periods)
+    if not len(starts):
+        empty = np.zeros(0, dtype=np.int64)
+        return PeriodTotals(np.zeros(0, dtype=object), periods, empty, empty, empty, empty)
+    ends = np.append(starts[1:], len(data))
+    return PeriodTotals(
+        np.array(data.account_ids, dtype=object)[data.account[starts]],
+        periods[starts],
+        np.add.reduceat(np.maximum(-data.value_base, 0), starts),
+        np.add.reduceat(np.maximum(data.value_base, 0), starts),
+        ends - starts,
+        balances[ends - 1],
+    )
+
+
+def account_balances(session: DBClient.session, chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict[str, int | None]:
+    # the balance Up reported for each account in cents, None when it was never synced
+    balances = {}
+    for chunk in Accounts.stream(session, ["id", "value_base", "balance"], chunk_size=chunk_size):
+        for id, value_base, balance in chunk:
+            if value_base is None and balance is not None:
+                value_base = int(round(balance * 100))
+            balances[id] = value_base
+    return balances
+
+
+def reconcile(data: TransactionArrays, balances: dict[str, int | None]) -> list[dict]:
+    # drift is the part of an account's balance its synced transactions don't add up to, e.g. history from
+    # before the first sync's lookback or transactions that failed to sync
+    starts = data.starts()
+    summed = dict(zip(
+        (data.account_ids[account] for account in data.account[starts]),
+        np.add.reduceat(data.value_base, starts).tolist() if len(starts) else [],
+    ))
+    counts = dict(zip(data.account_ids, np.bincount(data.account, minlength=len(data.account_ids)).tolist()))
+    rows = []
+    for account_id in sorted(set(balances) | set(data.account_ids)):
+        balance = balances.get(account_id)
+        transactions = summed.get(account_id, 0)
+        rows.append({
+            "account_id": account_id,
+            "balance_base": balance,
+            "transactions_base": transactions,
+            "count": counts.get(account_id, 0),
+            "drift_base": None if balance is None else balance - transactions,
+        })
+    return rows
+
+
+def report(session: DBClient.session, period: str = DEFAULT_PERIOD, chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+    data = TransactionArrays.load(session, chunk_size=chunk_size)
+    LOG.info(f"Loaded {len(data)} transactions of {len(data.account_ids)} accounts")
+    return {
+        "transactions": len(data),
+        "period": period,
+        "reconciliation": reconcile(data, account_balances(session, chunk_size)),
+        "periods": period_totals(data, period).rows(),
+    }
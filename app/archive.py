@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+from dataclasses import dataclass
+from typing import Generator
+from urllib.parse import urlsplit
+
+from app.metrics import endpoint_label
+from app.parsing import loads
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE_MB = 64
+# the paged endpoints worth replaying, by the stream their pages are parsed as
+ENDPOINT_STREAMS = {
+    "/accounts": "accounts",
+    "/categories": "categories",
+    "/tags": "tags",
+    "/accounts/{id}/transactions": "transactions",
+    "/attachments": "attachments",
+}
+ACCOUNT_PATH = re.compile(r"/accounts/([^/]+)/transactions")
+# directory of the streams that aren't fetched per account
+NO_ACCOUNT = "_"
+
+
+@dataclass
+class ArchivedPage:
+    stream: str
+    account_id: str | None
+    url: str
+    fetched_at: str
+    body: dict
+
+
+@dataclass
+class Segment:
+    path: str
+    file: gzip.GzipFile
+    size: int = 0
+
+
+# Append only archive of the raw page bodies a sync fetched, so a parser change can be backfilled by
+# replaying them instead of refetching years of history. Pages are gzipped NDJSON lines
+# ({"url", "fetched_at", "account_id", "body"}) in segments laid out as
+#   <directory>/<stream>/<account id, or _>/<fetch date>/<time>-<pid>-<n>.ndjson.gz
+# so a replay only opens the segments of the streams, accounts and dates it asked for. Every run writes
+# segments of its own and never reopens old ones, each page is flushed as it's written so a killed run
+# leaves readable segments behind.
+class PageArchive:
+    def __init__(self, directory: str, segment_size: int = DEFAULT_SEGMENT_SIZE_MB * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        # (stream, account) -> the Segment being written
+        self.segments = {}
+        self.written = 0
+        self.pages = 0
+        self.bytes = 0
+
+    def stream_of(self, url: str) -> str | None:
+        return ENDPOINT_STREAMS.get(endpoint_label(url))
+
+    def _open(self, stream: str, account_id: str | None) -> Segment:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        directory = os.path.join(self.directory, stream, account_id or NO_ACCOUNT, now.date().isoformat())
+        os.makedirs(directory, exist_ok=True)
+        self.written += 1
+        path = os.path.join(directory, f"{now:%H%M%S}-{os.getpid()}-{self.written:04d}.ndjson.gz")
+        return Segment(path, gzip.open(path, "wb"))
+
+    def append(self, url: str, body: bytes) -> bool:
+        # the raw body as is, bar newlines, which can only be whitespace between JSON tokens
+        if (stream := self.stream_of(url)) is None:
+            return False
+        account_id = match.group(1) if (match := ACCOUNT_PATH.search(urlsplit(url).path)) else None
+        fetched_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        head = json.dumps({"url": url, "fetched_at": fetched_at, "account_id": account_id})[:-1]
+        line = b"".join([head.encode(), b', "body": ', body.strip().replace(b"\n", b" ").replace(b"\r", b" "), b"}\n"])
+        with self.lock:
+            key = (stream, account_id)
+            if (segment := self.segments.get(key)) is None:
+                segment = self.segments[key] = self._open(stream, account_id)
+            segment.file.write(line)
+            segment.file.flush()
+            segment.size += len(line)
+            if segment.size >= self.segment_size:
+                segment.file.close()
+                del self.segments[key]
+            self.pages += 1
+            self.bytes += len(line)
+        return True
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments.values():
+                segment.file.close()
+            self.segments = {}
+
+    def stats(self) -> dict:
+        return {"pages": self.pages, "bytes": self.bytes}
+
+    def segment_paths(
+        self, stream: str, accounts: list[str] = None, since: str = None, until: str = None
+    ) -> list[str]:
+        # in the order they were written, dates are [since, until) as YYYY-MM-DD
+        paths = []
+        for account_dir in sorted(glob.glob(os.path.join(self.directory, stream, "*"))):
+            if accounts is not None and os.path.basename(account_dir) not in accounts:
+                continue
+            for date_dir in sorted(glob.glob(os.path.join(account_dir, "*"))):
+                date = os.path.basename(date_dir)
+                if (since and date < since) or (until and date >= until):
+                    continue
+                paths.extend(glob.glob(os.path.join(date_dir, "*.ndjson.gz")))
+        return sorted(paths, key=lambda path: (path.split(os.sep)[-2], os.path.basename(path)))
+
+    def pages_of(
+        self, stream: str, accounts: list[str] = None, since: str = None, until: str = None
+    ) -> Generator[ArchivedPage]:
+        # one page in memory at a time however big the archive is
+        for path in self.segment_paths(stream, accounts, since, until):
+            try:
+                with gzip.open(path, "rb") as file:
+                    for line in file:
+                        record = loads(line)
+                        yield ArchivedPage(
+                            stream, record["account_id"], record["url"], record["fetched_at"], record["body"]
+                        )
+            except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+                # cut short by a run that was killed, the pages flushed before that were read
+                LOG.warning(f"Archive segment {path} is truncated: {e}")
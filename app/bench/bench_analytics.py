@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# The numpy analytics in app/analytics.py against the per row Python loops they replace. Generates
+# synthetic (account_id, value_base, created_at) rows in memory, computes running balances, per period
+# totals and reconciliation drift both ways, checks they agree and prints one JSON line with the
+# timings and speedups, e.g.
+#   python app/bench/bench_analytics.py --rows 500000 --accounts 8 --output analytics.jsonl
+# Each starts from what it would read: the vectorized timings include converting the chunks
+# TransactionArrays.load streams (created_at in epoch microseconds) to arrays, the naive ones start from
+# the list of dicts Transactions.all() returns. Nothing touches the database.
+
+import argparse
+import datetime
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+
+from app.analytics import DEFAULT_PERIOD, PERIODS, TransactionArrays, period_totals, reconcile, running_balances
+from app.bench.bench_sync import commit
+from app.clients import DEFAULT_CHUNK_SIZE
+
+START = datetime.datetime(2020, 1, 1)
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def synthetic_rows(rows: int, accounts: int, days: int, seed: int) -> list[tuple]:
+    rng = random.Random(seed)
+    return [
+        (
+            f"bench-account-{rng.randrange(accounts)}",
+            rng.randint(-15000, 5000),
+            START + datetime.timedelta(seconds=rng.randrange(days * 86400)),
+        )
+        for _ in range(rows)
+    ]
+
+
+def naive_period_start(created_at: datetime.datetime, period: str) -> datetime.date:
+    day = created_at.date()
+    if period == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    if period == "year":
+        return day.replace(month=1, day=1)
+    return day
+
+
+def naive(rows: list[dict], balances: dict[str, int], period: str) -> dict:
+    # the ad hoc way, a loop over every row in account and created_at order
+    running = {}
+    counts = {}
+    balance_after = []
+    periods = {}
+    for row in sorted(rows, key=lambda row: (row["account_id"], row["created_at"])):
+        account_id = row["account_id"]
+        running[account_id] = running.get(account_id, 0) + row["value_base"]
+        counts[account_id] = counts.get(account_id, 0) + 1
+        balance_after.append(running[account_id])
+        key = (account_id, naive_period_start(row["created_at"], period))
+        totals = periods.setdefault(key, {"debit_base": 0, "credit_base": 0, "count": 0})
+        totals["debit_base"] += max(-row["value_base"], 0)
+        totals["credit_base"] += max(row["value_base"], 0)
+        totals["count"] += 1
+        totals["closing_base"] = running[account_id]
+    drift = {account_id: balance - running.get(account_id, 0) for account_id, balance in balances.items()}
+    return {"running": balance_after, "periods": periods, "drift": drift}
+
+
+def vectorized(chunks: list[list[tuple]], balances: dict[str, int], period: str) -> dict:
+    data = TransactionArrays.from_chunks(chunks)
+    return {
+        "running": running_balances(data),
+        "periods": period_totals(data, period),
+        "drift": {row["account_id"]: row["drift_base"] for row in reconcile(data, balances)},
+    }
+
+
+def agree(naive_result: dict, vectorized_result: dict) -> bool:
+    names = ("debit_base", "credit_base", "count", "closing_base")
+    periods = {
+        (row["account_id"], row["period"]): {name: row[name] for name in names}
+        for row in vectorized_result["periods"].rows()
+    }
+    return (
+        naive_result["running"] == vectorized_result["running"].tolist()
+        and naive_result["periods"] == periods
+        and naive_result["drift"] == vectorized_result["drift"]
+    )
+
+
+def timed(function, runs: int) -> tuple[float, dict]:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def run(args) -> dict:
+    rows = synthetic_rows(args.rows, args.accounts, args.days, args.seed)
+    dicts = [dict(zip(("account_id", "value_base", "created_at"), row)) for row in rows]
+    microsecond = datetime.timedelta(microseconds=1)
+    epoch_rows = [(account_id, value, (created_at - EPOCH) // microsecond) for account_id, value, created_at in rows]
+    chunks = [epoch_rows[start:start + args.chunk_size] for start in range(0, len(rows), args.chunk_size)]
+    balances = {f"bench-account-{i}": 0 for i in range(args.accounts)}
+    naive_seconds, naive_result = timed(lambda: naive(dicts, balances, args.period), args.runs)
+    vectorized_seconds, vectorized_result = timed(lambda: vectorized(chunks, balances, args.period), args.runs)
+    return {
+        "commit": commit(),
+        "config": {"rows": args.rows, "accounts": args.accounts, "days": args.days, "period": args.period},
+        "naive_seconds": round(naive_seconds, 4),
+        "vectorized_seconds": round(vectorized_seconds, 4),
+        "speedup": round(naive_seconds / vectorized_seconds, 2),
+        "rows_per_sec": {
+            "naive": round(args.rows / naive_seconds),
+            "vectorized": round(args.rows / vectorized_seconds),
+        },
+        "agree": agree(naive_result, vectorized_result),
+    }
+
+
+def parse_args(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the numpy analytics against per row loops")
+    parser.add_argument("--rows", type=int, default=200_000, help="Synthetic transactions")
+    parser.add_argument("--accounts", type=int, default=8, help="Accounts the rows are spread over")
+    parser.add_argument("--days", type=int, default=730, help="Days the rows are spread over")
+    parser.add_argument("--period", choices=PERIODS, default=DEFAULT_PERIOD, help="Period the totals are bucketed by")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Rows per chunk, like the stream's")
+    parser.add_argument("--runs", type=int, default=3, help="Timed runs of each, the median is reported")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic rows")
+    parser.add_argument("--output", type=str, default=None, help="Append the JSON result to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = json.dumps(run(args))
+    if args.output:
+        with open(args.output, "a") as file:
+            file.write(result + "\n")
+    print(result)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Compares rows/sec of the ORM page parser against the app.parsing record parser on the
+# mockserver transactions fixture scaled up to --rows rows, e.g.
+#   python app/bench/bench_parsing.py --rows 100000
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+
+from app.clients import Transactions, as_row
+from app.parsing import loads, orjson, parse_transactions
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "../../config/mockserver/transactions.json")
+
+
+def fixture_pages(rows: int, page_size: int) -> list[bytes]:
+    with open(FIXTURE) as file:
+        samples = [t for exp in json.load(file) for t in exp["httpResponse"]["body"]["data"]]
+    transactions = []
+    for i, sample in zip(range(rows), itertools.cycle(samples)):
+        transactions.append({**sample, "id": f"{sample['id']}-{i}"})
+    return [
+        json.dumps({"data": transactions[start:start + page_size], "links": {"prev": None, "next": None}}).encode()
+        for start in range(0, len(transactions), page_size)
+    ]
+
+
+def orm_parser(pages: list[bytes]) -> int:
+    count = 0
+    for body in pages:
+        for transaction in json.loads(body).get("data", []):
+            as_row(Transactions.parse_transaction(transaction, "123"))
+            count += 1
+    return count
+
+
+def record_parser(pages: list[bytes]) -> int:
+    return sum(len(parse_transactions(loads(body), "123")) for body in pages)
+
+
+def bench(parser, pages: list[bytes], repeat: int) -> dict:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = parser(pages)
+        best = min(best, time.perf_counter() - start)
+    return {"rows": rows, "seconds": round(best, 4), "rows_per_sec": round(rows / best)}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark transaction page parsing")
+    parser.add_argument("--rows", type=int, default=100_000, help="Number of transactions to parse")
+    parser.add_argument("--page-size", type=int, default=100, help="Transactions per page")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per parser, the fastest is reported")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    pages = fixture_pages(args.rows, args.page_size)
+    results = {
+        "json_backend": "orjson" if orjson is not None else "json",
+        "orm": bench(orm_parser, pages, args.repeat),
+        "records": bench(record_parser, pages, args.repeat),
+    }
+    results["speedup"] = round(results["orm"]["seconds"] / results["records"]["seconds"], 2)
+    print(json.dumps(results))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Range query latency on the plain transactions layout against the month partitioned one from
+# app/partitions.py. Fills two scratch tables (bench_transactions_heap and bench_transactions_partitioned)
+# with the same synthetic rows, times the dashboard and sync queries on each and prints one JSON line
+# with p50/p99 per query and layout, e.g.
+#   python app/bench/bench_partitions.py --rows 2000000 --months 36 --output partitions.jsonl
+# The scratch tables are dropped afterwards unless --keep is given, the real tables are left alone.
+
+import argparse
+import datetime
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+
+from sqlalchemy import text
+
+from app.bench.bench_sync import commit
+from app.clients import DBClient
+from app.partitions import MonthlyPartitions, create_partitioned_table
+
+HEAP = "bench_transactions_heap"
+PARTITIONED = "bench_transactions_partitioned"
+START = datetime.datetime(2020, 1, 1)
+
+QUERIES = {
+    # a dashboard's monthly spend across every account
+    "month_totals": "SELECT sum(value_base), count(*) FROM {table} WHERE created_at >= :start AND created_at < :end",
+    # one account's week, as the sync's change window and account scoped dashboards ask for
+    "account_week": (
+        "SELECT id, value_base FROM {table} WHERE account_id = :account AND created_at >= :start AND created_at < :end"
+    ),
+    # the sync's per account watermark
+    "watermark": "SELECT max(created_at) FROM {table} WHERE account_id = :account",
+}
+
+
+def drop(conn):
+    conn.exec_driver_sql(f"DROP TABLE IF EXISTS {HEAP}")
+    conn.exec_driver_sql(f"DROP TABLE IF EXISTS {PARTITIONED}")
+
+
+def fill(engine, rows: int, accounts: int, months: int):
+    span = months * 30 * 86400
+    with engine.begin() as conn:
+        drop(conn)
+        conn.exec_driver_sql(f"CREATE TABLE {HEAP} (LIKE transactions INCLUDING DEFAULTS INCLUDING INDEXES)")
+        create_partitioned_table(conn, PARTITIONED, "transactions", foreign_keys=False)
+    partitions = MonthlyPartitions(engine, PARTITIONED)
+    # every calendar month the rows span, a 15 day step can't skip one
+    partitions.ensure([{"created_at": START + datetime.timedelta(days=day)} for day in range(0, months * 30 + 15, 15)])
+    # ids and created_at rise together, like a table filled by syncs over the years
+    insert = (
+        "INSERT INTO {table} (id, account_id, status, value_base, created_at) "
+        f"SELECT 'bench-' || lpad(i::text, 12, '0'), 'bench-account-' || mod(i, {accounts}), 'SETTLED', "
+        f"(random() * 20000 - 15000)::int, TIMESTAMP '{START}' + make_interval(secs => i::float8 * {span} / {rows}) "
+        f"FROM generate_series(1, {rows}) i"
+    )
+    for table in (HEAP, PARTITIONED):
+        with engine.begin() as conn:
+            conn.exec_driver_sql(insert.format(table=table))
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"ANALYZE {table}")
+
+
+def size_mb(conn, table: str) -> float:
+    # summed over partitions for the partitioned table
+    size = conn.execute(text(
+        "SELECT sum(pg_total_relation_size(c.oid)) FROM pg_class c "
+        "WHERE c.oid = CAST(:table AS regclass) OR c.oid IN (SELECT inhrelid FROM pg_inherits "
+        "WHERE inhparent = CAST(:table AS regclass))"
+    ), {"table": table}).scalar()
+    return round(float(size) / 1024 / 1024, 1)
+
+
+def params(query: str, rng: random.Random, accounts: int, months: int) -> dict:
+    account = f"bench-account-{rng.randrange(accounts)}"
+    if query == "month_totals":
+        start = START + datetime.timedelta(days=30 * rng.randrange(months))
+        return {"start": start, "end": start + datetime.timedelta(days=30)}
+    if query == "account_week":
+        start = START + datetime.timedelta(days=rng.randrange(months * 30 - 7))
+        return {"account": account, "start": start, "end": start + datetime.timedelta(days=7)}
+    return {"account": account}
+
+
+def time_queries(engine, table: str, args) -> dict:
+    results = {}
+    for name, query in QUERIES.items():
+        # the same windows for both layouts
+        rng = random.Random(args.seed)
+        timings = []
+        with engine.connect() as conn:
+            statement = text(query.format(table=table))
+            for run in range(args.warmup + args.runs):
+                start = time.perf_counter()
+                conn.execute(statement, params(name, rng, args.accounts, args.months)).all()
+                if run >= args.warmup:
+                    timings.append(time.perf_counter() - start)
+        timings.sort()
+        results[name] = {
+            "p50_ms": round(statistics.median(timings) * 1000, 3),
+            "p99_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000, 3),
+        }
+    return results
+
+
+def run(args) -> dict:
+    engine = DBClient.engine()
+    start = time.perf_counter()
+    fill(engine, args.rows, args.accounts, args.months)
+    fill_seconds = time.perf_counter() - start
+    try:
+        results = {layout: time_queries(engine, table, args) for layout, table in (
+            ("heap", HEAP), ("partitioned", PARTITIONED)
+        )}
+        with engine.connect() as conn:
+            sizes = {"heap": size_mb(conn, HEAP), "partitioned": size_mb(conn, PARTITIONED)}
+    finally:
+        if not args.keep:
+            with engine.begin() as conn:
+                drop(conn)
+    return {
+        "commit": commit(),
+        "config": {"rows": args.rows, "accounts": args.accounts, "months": args.months, "runs": args.runs},
+        "fill_seconds": round(fill_seconds, 2),
+        "size_mb": sizes,
+        "queries": results,
+        "speedup_p50": {
+            name: round(results["heap"][name]["p50_ms"] / results["partitioned"][name]["p50_ms"], 2)
+            for name in QUERIES
+        },
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark range queries on plain vs month partitioned transactions")
+    parser.add_argument("--rows", type=int, default=500_000, help="Synthetic transactions per layout")
+    parser.add_argument("--accounts", type=int, default=8, help="Accounts the rows are spread over")
+    parser.add_argument("--months", type=int, default=24, help="Months the rows are spread over")
+    parser.add_argument("--runs", type=int, default=50, help="Timed runs per query")
+    parser.add_argument("--warmup", type=int, default=5, help="Untimed runs per query first")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the query windows")
+    parser.add_argument("--keep", action="store_true", help="Leave the scratch tables behind")
+    parser.add_argument("--output", type=str, default=None, help="Append the JSON result to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = json.dumps(run(args))
+    if args.output:
+        with open(args.output, "a") as file:
+            file.write(result + "\n")
+    print(result)
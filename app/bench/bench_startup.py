@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Cold start of a sync against the fake Up API in app/bench/fake_up_api.py. Each run is a fresh
+# interpreter timing the import of app.up_sync, constructing UpSync and syncing one small stream,
+# and the median of --runs is printed as one JSON line together with the API requests each run made
+# and which of the heavy optional modules got imported, e.g.
+#   python app/bench/bench_startup.py --runs 10 --output startup.jsonl
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+
+from app.bench.bench_sync import commit
+from app.bench.fake_up_api import FakeUpConfig, start_in_process
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+# modules only some runs need, anything listed here being imported by a plain sync is a regression
+DEFERRED_MODULES = ("requests", "aiohttp.web", "pyarrow", "cProfile", "http.server", "numpy")
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+from app.up_sync import UpSync
+imported = time.perf_counter()
+sink = None
+if {sink!r} != "postgres":
+    from app.sinks import FILE_SINKS
+    sink = FILE_SINKS[{sink!r}]({output_dir!r})
+up_sync = UpSync("bench_token", sink=sink)
+constructed = time.perf_counter()
+up_sync.sync([{stream!r}])
+synced = time.perf_counter()
+print(json.dumps({{
+    "import_seconds": imported - start,
+    "construct_seconds": constructed - imported,
+    "first_sync_seconds": synced - constructed,
+    "modules": [name for name in {deferred!r} if name in sys.modules],
+}}))
+"""
+
+
+def api_requests(url: str) -> int:
+    with urllib.request.urlopen(f"{url}/_stats") as res:
+        return json.load(res)["requests"]
+
+
+def run_once(args) -> dict:
+    code = CHILD.format(
+        root=ROOT, sink=args.sink, output_dir=args.output_dir, stream=args.stream, deferred=DEFERRED_MODULES
+    )
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True, env=os.environ
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    # includes interpreter startup
+    result["process_seconds"] = time.perf_counter() - start
+    return result
+
+
+def run(args) -> dict:
+    process, url = start_in_process(FakeUpConfig(accounts=2, transactions=10), args.port)
+    os.environ["MOCKSERVER_URL"] = url
+    try:
+        before = api_requests(url)
+        runs = [run_once(args) for _ in range(args.runs)]
+        requests = api_requests(url) - before
+    finally:
+        process.terminate()
+        process.join()
+
+    def median(name):
+        return round(statistics.median(run[name] for run in runs), 4)
+
+    return {
+        "commit": commit(),
+        "sink": args.sink,
+        "stream": args.stream,
+        "runs": args.runs,
+        "process_seconds": median("process_seconds"),
+        "import_seconds": median("import_seconds"),
+        "construct_seconds": median("construct_seconds"),
+        "first_sync_seconds": median("first_sync_seconds"),
+        "requests_per_run": requests / args.runs,
+        "deferred_modules_imported": runs[-1]["modules"],
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark sync cold start against a fake Up API")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to time, the median is reported")
+    parser.add_argument("--sink", choices=["postgres", "csv", "parquet"], default="postgres")
+    parser.add_argument("--output-dir", type=str, default="bench_output", help="Directory for file sinks")
+    parser.add_argument("--stream", type=str, default="accounts", help="Stream each run syncs")
+    parser.add_argument("--port", type=int, default=0, help="Port for the fake API, 0 picks a free one")
+    parser.add_argument("--output", type=str, default=None, help="Append the JSON result to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = json.dumps(run(args))
+    if args.output:
+        with open(args.output, "a") as file:
+            file.write(result + "\n")
+    print(result)
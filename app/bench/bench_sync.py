@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# End to end sync throughput against the fake Up API in app/bench/fake_up_api.py. Starts the
+# fake API in a subprocess, runs a full UpSync.sync() into the configured sink and prints one
+# JSON line with rows/sec, p50/p99 transaction page latency, peak RSS and time spent writing, e.g.
+#   python app/bench/bench_sync.py --accounts 4 --transactions 50000 --output bench.jsonl
+# --output appends, and each line records the commit so runs can be compared across commits.
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+
+from sqlalchemy import text
+
+from app.bench.fake_up_api import FakeUpConfig, start_in_process
+from app.clients import DEFAULT_BATCH_SIZE, DEFAULT_COPY_THRESHOLD, DEFAULT_WRITERS, DBClient, Transactions
+from app.http_cache import HttpCache
+from app.scheduler import RequestScheduler
+from app.sinks import FILE_SINKS, PostgresSink
+from app.up_sync import UpSync
+
+BENCH_TOKEN = "bench_token"
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def reset_bench_rows():
+    # only the fake API's accounts, so benching against a dev DB leaves real data alone
+    session = DBClient().session
+    columns = {
+        "transaction_tags": "transaction_id",
+        "transaction_categories": "transaction_id",
+        "attachments": "transaction_id",
+        "sync_state": "account_id",
+        "daily_account_totals": "account_id",
+        "transactions": "account_id",
+        "accounts": "id",
+    }
+    for table, column in columns.items():
+        session.execute(text(f"DELETE FROM {table} WHERE {column} LIKE 'bench-account-%'"))
+    session.commit()
+    session.close()
+
+
+def run(config: FakeUpConfig, args) -> dict:
+    process, url = start_in_process(config, args.port)
+    os.environ["MOCKSERVER_URL"] = url
+    try:
+        sink = FILE_SINKS[args.sink](args.output_dir) if args.sink in FILE_SINKS else None
+        if args.http_cache and not args.keep:
+            # a cold run, cached pages would otherwise be skipped as already written
+            shutil.rmtree(args.http_cache, ignore_errors=True)
+        scheduler = RequestScheduler(rate=args.rate_limit, max_concurrency=args.max_concurrency)
+        up_sync = UpSync(
+            BENCH_TOKEN,
+            lookback=config.days + 1,
+            batch_size=args.batch_size,
+            copy_threshold=args.copy_threshold,
+            writers=args.writers,
+            scheduler=scheduler,
+            sink=sink,
+            cache=HttpCache(args.http_cache) if args.http_cache else None,
+        )
+        if up_sync.client.sink.stateful and not args.keep:
+            reset_bench_rows()
+        start = time.perf_counter()
+        rows = up_sync.sync()
+        elapsed = time.perf_counter() - start
+        up_sync.client.close()
+    finally:
+        process.terminate()
+        process.join()
+
+    metrics = up_sync.client.metrics
+    endpoint = f"/accounts/{{id}}/{Transactions.STREAM}"
+    latency = metrics.histogram("http_request_seconds", endpoint=endpoint)
+    db_seconds = sum(
+        h.sum for (name, _), h in metrics.histograms.items()
+        if name in ("db_batch_seconds", "db_copy_seconds", "db_merge_seconds")
+    )
+    return {
+        "commit": commit(),
+        "config": {**config.__dict__, "sink": args.sink, "batch_size": args.batch_size,
+                   "copy_threshold": args.copy_threshold, "writers": args.writers},
+        "rows": rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(rows / elapsed),
+        "pages": metrics.counter("pages", endpoint=endpoint),
+        "page_latency_p50_ms": round(latency.quantile(0.5) * 1000, 2) if latency else None,
+        "page_latency_p99_ms": round(latency.quantile(0.99) * 1000, 2) if latency else None,
+        "bytes_received": metrics.counter("http_bytes_received"),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        # summed over writer threads, so it can exceed the wall clock time
+        "db_write_seconds": round(db_seconds, 3),
+        "db_commits": metrics.counter("db_commits"),
+        "requests": scheduler.stats(),
+        "http_cache": up_sync.client.cache.stats() if up_sync.client.cache else None,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark a full sync against a fake Up API")
+    parser.add_argument("--accounts", type=int, default=2, help="Number of synthetic accounts")
+    parser.add_argument("--transactions", type=int, default=10_000, help="Transactions per account")
+    parser.add_argument("--page-size", type=int, default=100, help="Transactions per page")
+    parser.add_argument("--days", type=int, default=365, help="Days the transactions are spread over")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake API waits per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered 429/503")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for error injection")
+    parser.add_argument("--rate-limit", type=float, default=1000.0, help="Client request rate limit")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="Client requests in flight cap")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Rows per INSERT")
+    parser.add_argument("--copy-threshold", type=int, default=DEFAULT_COPY_THRESHOLD, help="Rows before COPY")
+    parser.add_argument("--writers", type=int, default=DEFAULT_WRITERS, help="DB writer threads")
+    parser.add_argument("--sink", choices=[PostgresSink.name, *FILE_SINKS], default=PostgresSink.name)
+    parser.add_argument("--output-dir", type=str, default="bench_output", help="Directory for file sinks")
+    parser.add_argument("--etags", action="store_true", help="Have the fake API send ETags and 304s")
+    parser.add_argument("--http-cache", type=str, default=None, help="Sync with an http cache in this directory")
+    parser.add_argument("--port", type=int, default=8765, help="Port for the fake API, 0 picks a free one")
+    parser.add_argument("--keep", action="store_true", help="Don't delete bench rows first (measures a resync)")
+    parser.add_argument("--output", type=str, default=None, help="Append the JSON result to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = FakeUpConfig(
+        accounts=args.accounts,
+        transactions=args.transactions,
+        page_size=args.page_size,
+        days=args.days,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        etags=args.etags,
+    )
+    result = json.dumps(run(config, args))
+    if args.output:
+        with open(args.output, "a") as file:
+            file.write(result + "\n")
+    print(result)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# A local stand in for the Up API serving /util/ping, /accounts, /categories, /tags, /attachments and
+# paginated /accounts/{id}/transactions for N synthetic accounts x M transactions, with configurable
+# page size, latency and error injection. Transactions are generated on the fly from their
+# index, so large datasets cost no memory, e.g.
+#   python app/bench/fake_up_api.py --accounts 10 --transactions 100000 --port 8080
+
+import argparse
+import asyncio
+import datetime
+import hashlib
+import math
+import random
+import socket
+import time
+from dataclasses import asdict, dataclass
+from multiprocessing import Process, get_context
+
+from aiohttp import web
+
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S+00:00"
+# (id, name, parent id), transactions cycle through the child categories
+CATEGORIES = [
+    ("good-life", "Good Life", None),
+    ("takeaway", "Takeaway", "good-life"),
+    ("restaurants-and-cafes", "Restaurants & Cafes", "good-life"),
+    ("home", "Home", None),
+    ("groceries", "Groceries", "home"),
+    ("utilities", "Utilities", "home"),
+]
+TAGS = ["Holiday", "Pizza Night", "Work"]
+# every n'th transaction has an attachment
+ATTACHMENT_EVERY = 1000
+
+
+@dataclass
+class FakeUpConfig:
+    accounts: int = 2
+    transactions: int = 1000
+    page_size: int = 100
+    # transactions are spread evenly over the last `days` days, newest first like the real API
+    days: int = 365
+    latency: float = 0.0
+    error_rate: float = 0.0
+    seed: int = 0
+    # send ETags and answer If-None-Match with 304s, the real API doesn't
+    etags: bool = False
+
+
+class FakeUpApi:
+    def __init__(self, config: FakeUpConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        # midnight, so restarting the API serves the same transactions for the rest of the day
+        self.now = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        self.interval = config.days * 86400 / max(config.transactions, 1)
+        self.requests = 0
+        self.errors = 0
+
+    def account_id(self, i: int) -> str:
+        return f"bench-account-{i}"
+
+    def account(self, i: int) -> dict:
+        return {
+            "type": "accounts",
+            "id": self.account_id(i),
+            "attributes": {
+                "displayName": f"Bench {i}",
+                "accountType": "TRANSACTIONAL",
+                "ownershipType": "INDIVIDUAL",
+                "balance": {"currencyCode": "AUD", "value": "100.00", "valueInBaseUnits": 10000},
+                "createdAt": self.now.strftime(DATETIME_FORMAT),
+            },
+        }
+
+    def created_at(self, i: int) -> datetime.datetime:
+        return self.now - datetime.timedelta(seconds=i * self.interval)
+
+    def ref(self, type: str, id: str = None) -> dict:
+        return {"data": {"type": type, "id": id} if id else None}
+
+    def category(self, id: str, name: str, parent: str) -> dict:
+        children = [child for child, _, child_parent in CATEGORIES if child_parent == id]
+        return {
+            "type": "categories",
+            "id": id,
+            "attributes": {"name": name},
+            "relationships": {
+                "parent": self.ref("categories", parent),
+                "children": {"data": [{"type": "categories", "id": child} for child in children]},
+            },
+        }
+
+    def attachment(self, account_id: str, i: int) -> dict:
+        created_at = self.created_at(i)
+        return {
+            "type": "attachments",
+            "id": f"{account_id}-{i}-attachment",
+            "attributes": {
+                "createdAt": created_at.strftime(DATETIME_FORMAT),
+                "fileURL": f"https://example.com/{account_id}-{i}.jpg?expires={int(self.now.timestamp()) + 86400}",
+                "fileURLExpiresAt": (created_at + datetime.timedelta(hours=1)).strftime(DATETIME_FORMAT),
+                "fileExtension": "jpg",
+                "fileContentType": "image/jpeg",
+            },
+            "relationships": {"transaction": self.ref("transactions", f"{account_id}-{i}")},
+        }
+
+    def relationships(self, account_id: str, i: int) -> dict:
+        children = [category for category in CATEGORIES if category[2]]
+        category_id, _, parent_id = children[i % len(children)] if i % 5 else (None, None, None)
+        tags = [TAGS[i % len(TAGS)]] if i % 7 == 0 else []
+        attachment = f"{account_id}-{i}-attachment" if i % ATTACHMENT_EVERY == 0 else None
+        return {
+            "account": self.ref("accounts", account_id),
+            "category": self.ref("categories", category_id),
+            "parentCategory": self.ref("categories", parent_id),
+            "tags": {"data": [{"type": "tags", "id": tag} for tag in tags]},
+            "attachment": self.ref("attachments", attachment),
+        }
+
+    def transaction(self, account_id: str, i: int) -> dict:
+        value_base = -((i * 7919) % 100_000) - 1
+        created_at = self.created_at(i).strftime(DATETIME_FORMAT)
+        return {
+            "type": "transactions",
+            "id": f"{account_id}-{i}",
+            "attributes": {
+                "status": "HELD" if i < 5 else "SETTLED",
+                "rawText": None,
+                "description": f"Merchant {i % 97}",
+                "message": None,
+                "isCategorizable": True,
+                "holdInfo": None,
+                "roundUp": None,
+                "cashback": None,
+                "amount": {"currencyCode": "AUD", "value": f"{value_base / 100:.2f}", "valueInBaseUnits": value_base},
+                "foreignAmount": None,
+                "cardPurchaseMethod": {"cardNumberSuffix": f"{i % 10000:04d}"} if i % 3 else None,
+                "settledAt": None if i < 5 else created_at,
+                "createdAt": created_at,
+            },
+            "relationships": self.relationships(account_id, i),
+        }
+
+    def index_range(self, since: str = None, until: str = None) -> tuple[int, int]:
+        # transactions i with since <= created_at(i) < until, as a [lo, hi) index range
+        lo, hi = 0, self.config.transactions
+        if until:
+            offset = (self.now - datetime.datetime.fromisoformat(until)).total_seconds() / self.interval
+            lo = max(lo, math.floor(offset) + 1 if offset >= 0 else 0)
+        if since:
+            offset = (self.now - datetime.datetime.fromisoformat(since)).total_seconds() / self.interval
+            hi = min(hi, math.floor(offset) + 1)
+        return lo, max(lo, hi)
+
+    async def respond(self, request: web.Request, body) -> web.Response:
+        self.requests += 1
+        if self.config.latency:
+            await asyncio.sleep(self.config.latency)
+        if request.headers.get("Authorization") in (None, "Bearer ", "Bearer bad_token"):
+            return web.json_response({"errors": [{"status": "401"}]}, status=401)
+        if self.config.error_rate and self.random.random() < self.config.error_rate:
+            self.errors += 1
+            if self.random.random() < 0.5:
+                return web.json_response({"errors": [{"status": "429"}]}, status=429, headers={"Retry-After": "0"})
+            return web.json_response({"errors": [{"status": "503"}]}, status=503)
+        response = web.json_response(body() if callable(body) else body)
+        if self.config.etags:
+            etag = '"' + hashlib.md5(response.body).hexdigest() + '"'
+            if request.headers.get("If-None-Match") == etag:
+                return web.Response(status=304, headers={"ETag": etag})
+            response.headers["ETag"] = etag
+        return response
+
+    async def ping(self, request: web.Request) -> web.Response:
+        return await self.respond(request, {"meta": {"id": "bench", "statusEmoji": "⚡️"}})
+
+    async def accounts(self, request: web.Request) -> web.Response:
+        data = [self.account(i) for i in range(self.config.accounts)]
+        return await self.respond(request, {"data": data, "links": {"prev": None, "next": None}})
+
+    async def categories(self, request: web.Request) -> web.Response:
+        # not paginated, like the real endpoint
+        return await self.respond(request, {"data": [self.category(*category) for category in CATEGORIES]})
+
+    async def tags(self, request: web.Request) -> web.Response:
+        data = [{"type": "tags", "id": tag} for tag in TAGS]
+        return await self.respond(request, {"data": data, "links": {"prev": None, "next": None}})
+
+    async def attachments(self, request: web.Request) -> web.Response:
+        data = [
+            self.attachment(self.account_id(account), i)
+            for account in range(self.config.accounts)
+            for i in range(0, self.config.transactions, ATTACHMENT_EVERY)
+        ]
+        return await self.respond(request, {"data": data, "links": {"prev": None, "next": None}})
+
+    async def transactions(self, request: web.Request) -> web.Response:
+        account_id = request.match_info["account_id"]
+        lo, hi = self.index_range(request.query.get("filter[since]"), request.query.get("filter[until]"))
+        start = max(lo, int(request.query.get("page[after]", lo)))
+        end = min(hi, start + self.config.page_size)
+
+        def body():
+            next_page = None
+            if end < hi:
+                next_page = str(request.url.update_query({"page[after]": str(end)}))
+            data = [self.transaction(account_id, i) for i in range(start, end)]
+            return {"data": data, "links": {"prev": None, "next": next_page}}
+
+        return await self.respond(request, body)
+
+    async def transaction_by_id(self, request: web.Request) -> web.Response:
+        # ids are "{account_id}-{i}", as served by the transactions endpoint
+        account_id, _, i = request.match_info["transaction_id"].rpartition("-")
+        if not account_id.startswith("bench-account-") or not i.isdigit() or int(i) >= self.config.transactions:
+            return web.json_response({"errors": [{"status": "404"}]}, status=404)
+        return await self.respond(request, {"data": self.transaction(account_id, int(i))})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests, "errors": self.errors})
+
+    def app(self) -> web.Application:
+        # the client joins endpoints as f"{base}/{endpoint}" so "//util/ping" has to resolve too
+        app = web.Application(middlewares=[web.normalize_path_middleware(append_slash=False, merge_slashes=True)])
+        app.router.add_get("/util/ping", self.ping)
+        app.router.add_get("/accounts", self.accounts)
+        app.router.add_get("/categories", self.categories)
+        app.router.add_get("/tags", self.tags)
+        app.router.add_get("/attachments", self.attachments)
+        app.router.add_get("/accounts/{account_id}/transactions", self.transactions)
+        app.router.add_get("/transactions/{transaction_id}", self.transaction_by_id)
+        app.router.add_get("/_stats", self.stats)
+        return app
+
+
+def serve(config: FakeUpConfig, port: int):
+    web.run_app(FakeUpApi(config).app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_in_process(config: FakeUpConfig, port: int = None) -> tuple[Process, str]:
+    # in its own process so it doesn't show up in the sync's CPU time or RSS. Spawned, as a forked child
+    # would share the parent's pooled postgres connections and interleave its own traffic on them
+    port = port or free_port()
+    process = get_context("spawn").Process(target=serve, args=(config, port), daemon=True)
+    process.start()
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return process, url
+        except OSError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError("Fake Up API didn't start")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve a synthetic Up API")
+    defaults = FakeUpConfig()
+    for name, value in asdict(defaults).items():
+        if isinstance(value, bool):
+            parser.add_argument(f"--{name.replace('_', '-')}", action="store_true")
+        else:
+            parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    parser.add_argument("--port", type=int, default=8080)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = vars(parse_args())
+    port = args.pop("port")
+    serve(FakeUpConfig(**args), port)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Sends signed Up webhook events to a running `up_sync.py serve`, referencing transactions the fake
+# Up API in app/bench/fake_up_api.py serves, and prints one JSON line with the acknowledgement
+# latencies, e.g.
+#   python app/bench/fake_up_api.py --accounts 2 --port 8080 &
+#   MOCKSERVER_URL=http://127.0.0.1:8080 UP_WEBHOOK_SECRET=secret ./up_sync.py serve --port 8000 &
+#   python app/bench/send_webhooks.py --url http://127.0.0.1:8000/webhook --secret secret --events 500
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import aiohttp
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+
+from app.metrics import Histogram
+from app.webhooks import DELETE_EVENTS, UPSERT_EVENTS, signed_request, webhook_event
+
+
+def events(count: int, accounts: int, transactions: int, event_type: str, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    return [
+        webhook_event(f"bench-account-{rng.randrange(accounts)}-{rng.randrange(transactions)}", event_type)
+        for _ in range(count)
+    ]
+
+
+async def send(url: str, secret: str, payloads: list[dict], concurrency: int) -> dict:
+    latency = Histogram()
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(session, event):
+        body, headers = signed_request(secret, event)
+        async with semaphore:
+            start = time.perf_counter()
+            async with session.post(url, data=body, headers=headers) as res:
+                await res.read()
+            latency.observe(time.perf_counter() - start)
+            statuses[res.status] = statuses.get(res.status, 0) + 1
+
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[post(session, event) for event in payloads])
+    elapsed = time.perf_counter() - start
+    return {
+        "events": len(payloads),
+        "seconds": round(elapsed, 3),
+        "events_per_sec": round(len(payloads) / elapsed),
+        "statuses": statuses,
+        "ack_latency": latency.summary(),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Send signed Up webhook events")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8000/webhook", help="Webhook endpoint")
+    parser.add_argument("--secret", type=str, default=os.environ.get("UP_WEBHOOK_SECRET"), help="Signing secret")
+    parser.add_argument("--events", type=int, default=100, help="Number of events to send")
+    parser.add_argument("--accounts", type=int, default=2, help="Accounts the fake API serves")
+    parser.add_argument("--transactions", type=int, default=1000, help="Transactions per account the fake API serves")
+    parser.add_argument(
+        "--event-type", choices=sorted(UPSERT_EVENTS | DELETE_EVENTS | {"PING"}), default="TRANSACTION_CREATED"
+    )
+    parser.add_argument("--concurrency", type=int, default=10, help="Events in flight at once")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for picking transactions")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    payloads = events(args.events, args.accounts, args.transactions, args.event_type, args.seed)
+    print(json.dumps(asyncio.run(send(args.url, args.secret, payloads, args.concurrency))))
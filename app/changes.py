@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+from typing import Callable, Iterable
+
+from app.metrics import Metrics
+
+# stored rows from before content hashes existed are in the index with a None hash
+MISSING = object()
+# ids remembered by a bounded memory sync, per change index and per account's dedupe
+DEFAULT_MAX_TRACKED_IDS = 10_000
+
+
+def forget_oldest(ids: dict, max_size: int = None):
+    # dicts keep insertion order, so the first keys are the ones remembered longest ago
+    if max_size is None:
+        return
+    while len(ids) > max_size:
+        del ids[next(iter(ids))]
+
+
+# id -> content hash of the rows already stored for the window being synced, loaded in one query at
+# the start of a sync. Fetched rows whose hash matches are dropped before they're queued for a writer,
+# the rest are counted as inserted or updated and their hash remembered, so a row repeated by
+# overlapping date slices is only written once, and forgotten again if its write fails. Rows without a
+# content hash (tags) are only checked for their id. Only used from the event loop thread.
+# With a lookup (bounded memory syncs) nothing is loaded upfront, the stored hashes of each page's ids
+# are looked up as it's filtered and only the max_size most recent ids are kept. A row that was forgotten
+# and fetched again is looked up again, at worst it's rewritten, which the upsert makes a no-op. Callers
+# that can't block (the event loop) look up the unknown ids themselves and pass what's stored to filter.
+class ChangeIndex:
+    def __init__(
+        self,
+        table: str,
+        hashes: dict[str, str],
+        metrics: Metrics = None,
+        lookup: Callable[[list[str]], dict[str, str]] = None,
+        max_size: int = None,
+    ):
+        self.table = table
+        self.hashes = hashes
+        self.metrics = metrics or Metrics()
+        self.lookup = lookup
+        self.max_size = max_size
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def unknown(self, rows: list) -> list[str]:
+        # ids whose stored hashes have to be looked up before the rows are filtered
+        if self.lookup is None:
+            return []
+        return [row.id for row in rows if row.id not in self.hashes]
+
+    def filter(self, rows: list, stored: dict[str, str] = None) -> list:
+        if stored is None and (unknown := self.unknown(rows)):
+            stored = self.lookup(unknown)
+        if stored:
+            # rows filtered while the lookup ran already have newer hashes than the stored ones
+            self.hashes.update({id: digest for id, digest in stored.items() if id not in self.hashes})
+        changed = []
+        inserted = updated = 0
+        for row in rows:
+            stored = self.hashes.get(row.id, MISSING)
+            digest = getattr(row, "content_hash", None)
+            if stored == digest:
+                continue
+            if stored is MISSING:
+                inserted += 1
+            else:
+                updated += 1
+            self.hashes[row.id] = digest
+            changed.append(row)
+        forget_oldest(self.hashes, self.max_size)
+        skipped = len(rows) - len(changed)
+        self.inserted += inserted
+        self.updated += updated
+        self.skipped += skipped
+        self.metrics.inc("rows_inserted", inserted, table=self.table)
+        self.metrics.inc("rows_updated", updated, table=self.table)
+        self.metrics.inc("rows_skipped", skipped, table=self.table)
+        return changed
+
+    def forget(self, ids: Iterable[str]):
+        # rows that failed to write, so they aren't taken as unchanged if they're fetched again
+        for id in ids:
+            self.hashes.pop(id, None)
+
+    def stats(self) -> dict:
+        return {"inserted": self.inserted, "updated": self.updated, "skipped": self.skipped}
@@ -3,15 +3,57 @@ from __future__ import annotations
 import asyncio
 import datetime
 import logging
+import math
 import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Generator
+from typing import TYPE_CHECKING, Generator
+from urllib.parse import urlencode
 
 import aiohttp
-import requests
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, Numeric, String, create_engine, func
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    Numeric,
+    String,
+    and_,
+    cast,
+    create_engine,
+    delete,
+    func,
+    or_,
+    select,
+    tuple_,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import declarative_base, sessionmaker
 
+from app.archive import PageArchive
+from app.changes import DEFAULT_MAX_TRACKED_IDS, ChangeIndex, forget_oldest
+from app.http_cache import HttpCache, content_hash
+from app.metrics import SIZE_BUCKETS, Metrics, endpoint_label
+from app.parsing import (
+    loads,
+    parse_account,
+    parse_transaction,
+    parse_transaction_page_links,
+    parse_transactions,
+)
+from app.scheduler import RequestScheduler
+from app.sinks import BatchWriteError, CopyLoader, PostgresSink, Sink, upsert_rows
+
+if TYPE_CHECKING:
+    import requests
+
 logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
@@ -19,6 +61,33 @@ TEST_DATABASE = "test"
 
 VERSION = "v1"
 
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_COPY_THRESHOLD = 10_000
+DEFAULT_WRITERS = 2
+DEFAULT_QUEUE_SIZE = 8
+DEFAULT_SLICE_DAYS = 30
+DEFAULT_MAX_SLICES = 4
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_CHUNK_SIZE = 5_000
+# pages fetched but not yet written, across all accounts, in a bounded memory sync
+DEFAULT_MAX_PAGES_IN_FLIGHT = 8
+
+HTTP_POOL_LIMIT = 100
+HTTP_POOL_LIMIT_PER_HOST = 10
+HTTP_KEEPALIVE_TIMEOUT = 30
+HTTP_DNS_CACHE_TTL = 300
+UNCACHED_ENDPOINTS = ("/util/ping",)
+
+def http_connector(clients: int = 1) -> aiohttp.TCPConnector:
+    # every client talks to the same host, so a connector shared by several gets their combined allowance
+    return aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=min(HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST * clients),
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+    )
+
 def sanitize(record: dict):
     try:
         record.pop("_sa_instance_state")
@@ -26,10 +95,88 @@ def sanitize(record: dict):
         pass
     return record
 
+def as_row(instance) -> dict:
+    return {column.name: getattr(instance, column.name) for column in instance.__table__.columns}
+
+def projection(model, columns: list[str] = None) -> list:
+    table = model.__table__
+    if (unknown := set(columns or ()) - set(table.c.keys())):
+        raise ValueError(f"unknown {model.__tablename__} columns {', '.join(sorted(unknown))}")
+    return [table.c[name] for name in columns] if columns else list(table.c)
+
+def filtered(query, column, value):
+    # value is one id or a list of them
+    if value is None:
+        return query
+    if isinstance(value, (list, tuple, set)):
+        return query.where(column.in_(list(value)))
+    return query.where(column == value)
+
+def stream_rows(session, query, chunk_size: int = DEFAULT_CHUNK_SIZE, as_dicts: bool = False) -> Generator[list]:
+    # rows come off a server side cursor chunk_size at a time as plain tuples (or dicts), no ORM objects,
+    # so a scan of the whole table holds one chunk in memory however big the table is
+    result = session.execute(query.execution_options(stream_results=True, yield_per=chunk_size))
+    try:
+        for chunk in result.partitions():
+            yield [row._asdict() for row in chunk] if as_dicts else [tuple(row) for row in chunk]
+    finally:
+        result.close()
+
+@dataclass
+class Page:
+    stream: str
+    rows: list[dict]
+    # links.next of the page, None once the stream is exhausted
+    cursor: str = None
+    # transaction id -> (category link, tag links) for the page's rows
+    links: dict = None
+
+@dataclass
+class AccountSync:
+    # per account write progress, only ever touched by the writer that owns the account
+    account_id: str
+    count: int = 0
+    failed: int = 0
+    seen: int = 0
+    loader: CopyLoader = None
+    # ids already written (a dict kept in insertion order, capped in bounded memory syncs), only tracked when
+    # overlapping date slices can return the same transaction
+    ids: dict = None
+    # checkpoints for pages staged with COPY, only committed once the staging table is merged
+    pending_cursors: dict = None
+    pending_watermark: str = None
+    # ids of the rows staged with COPY (capped like ids), unwritten if the staging table is lost
+    staged: dict = None
+    # ids of rows that failed to write, dropped from the change index by the writer back on the event loop
+    unwritten: list = None
+
 class DBClient:
-    def __init__(self):
-        db = create_engine(DBClient.db_string())
-        self.session = sessionmaker(db)()
+    BatchWriteError = BatchWriteError
+
+    # one engine, and with it one connection pool, per database and pool size for the whole process
+    _engines = {}
+    _engines_lock = threading.Lock()
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE):
+        self.session = sessionmaker(DBClient.engine(pool_size))()
+
+    @classmethod
+    def engine(cls, pool_size: int = DEFAULT_POOL_SIZE):
+        # create_engine doesn't connect, the first connection is opened when a session first needs it
+        key = (cls.db_string(), pool_size)
+        with cls._engines_lock:
+            if (engine := cls._engines.get(key)) is None:
+                engine = cls._engines[key] = create_engine(
+                    key[0], pool_size=pool_size, max_overflow=DEFAULT_MAX_OVERFLOW
+                )
+        return engine
+
+    @classmethod
+    def dispose(cls):
+        with cls._engines_lock:
+            for engine in cls._engines.values():
+                engine.dispose()
+            cls._engines = {}
 
     @classmethod
     def db_string(cls):
@@ -44,18 +191,157 @@ class UpClient():
     class UpAuthError(Exception):
         pass
 
-    def __init__(self, token: str, lookback: int = None):
+    class UpRequestError(Exception):
+        pass
+
+    def __init__(
+        self,
+        token: str,
+        lookback: int = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        copy_threshold: int = DEFAULT_COPY_THRESHOLD,
+        writers: int = DEFAULT_WRITERS,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        scheduler: RequestScheduler = None,
+        slice_days: int = DEFAULT_SLICE_DAYS,
+        max_slices: int = DEFAULT_MAX_SLICES,
+        sink: Sink = None,
+        metrics: Metrics = None,
+        cache: HttpCache = None,
+        detect_changes: bool = True,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        archive: PageArchive = None,
+        bounded_memory: bool = False,
+        max_pages_in_flight: int = None,
+    ):
         self.token = token
         self.headers = {"Authorization": f"Bearer {self.token}"}
-        self.authenticate()
+        self.scheduler = scheduler or RequestScheduler()
+        self.metrics = metrics or Metrics()
+        self.cache = cache
+        # raw bodies of the pages fetched, for replaying through the parsers later
+        self.archive = archive
+        self.detect_changes = detect_changes
+        # table name -> ChangeIndex of stored row hashes, set up at the start of each stream's sync
+        self.changes = {}
+        self._requests_session = None
+        self.http_session = None
+        self._http_depth = 0
+        # a TCPConnector shared with other clients (manifest syncs), closed by whoever created it
+        self.connector = None
+        # {account id: future} claims shared by the clients of a manifest sync, so a joint account is only
+        # synced once. A claim resolves True once its transactions are fetched, False when that failed
+        self.claimed = None
+        # no separate ping, the first request made is the auth check (None until it's answered)
+        self.authenticated = None
+        self._auth_lock = None
         self.lookback = lookback
-        self.session = DBClient().session
+        self.batch_size = batch_size
+        self.copy_threshold = copy_threshold
+        self.writers = writers
+        self.queue_size = queue_size
+        self.slice_days = slice_days
+        self.max_slices = max_slices
+        self.run_id = None
+        self.run_started_at = None
+        # accounts fetched by the last accounts sync, None until there's been one. Transactions are
+        # fetched for these, the token's own accounts, before falling back to every stored account
+        self.accounts = None
+        self.pool_size = pool_size
+        self._session = None
+        # bounded memory syncs keep peak memory flat whatever the lookback: a session per batch, stored hashes
+        # looked up per page, capped id tracking and a cap on the pages held between fetchers and writers
+        self.bounded_memory = bounded_memory
+        self.max_tracked_ids = DEFAULT_MAX_TRACKED_IDS if bounded_memory else None
+        if max_pages_in_flight is None and bounded_memory:
+            max_pages_in_flight = DEFAULT_MAX_PAGES_IN_FLIGHT
+        self.max_pages_in_flight = max_pages_in_flight
+        # semaphore of the pages in flight, one per transactions sync as it's bound to its event loop
+        self.page_slots = None
+        # thread a bounded memory sync looks up stored hashes on, one per transactions sync
+        self.lookups = None
+        self.sink = sink or PostgresSink(DBClient.engine(pool_size), session_per_batch=bounded_memory)
+
+    @property
+    def session(self):
+        # only opened once something needs the database, so file sink runs never connect
+        if self._session is None:
+            self._session = DBClient(self.pool_size).session
+        return self._session
+
+    @property
+    def requests_session(self) -> requests.Session:
+        # only the blocking helpers use requests, most runs never import it
+        if self._requests_session is None:
+            self._requests_session = self._new_requests_session()
+        return self._requests_session
+
+    def _new_requests_session(self) -> requests.Session:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_LIMIT_PER_HOST, pool_maxsize=HTTP_POOL_LIMIT_PER_HOST)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    async def __aenter__(self):
+        # reentrant, so a request made inside an already open sync reuses the same connection pool
+        if self._http_depth == 0:
+            self.http_session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=self.connector or http_connector(),
+                connector_owner=self.connector is None,
+            )
+            self._auth_lock = asyncio.Lock()
+        self._http_depth += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        self._http_depth -= 1
+        if self._http_depth == 0:
+            await self.http_session.close()
+            self.http_session = None
+
+    def close(self):
+        if self._requests_session is not None:
+            self._requests_session.close()
+        self.release_session()
+
+    def release_session(self):
+        # hands the connection back to the shared pool, the next query opens a new session
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
     def authenticate(self):
+        # an explicit check, syncs don't need it as their first request already fails with UpAuthError
         for _ in self._get_request(endpoint="/util/ping"):
-            return LOG.info("Successfully authenticated")
+            return
         raise self.UpAuthError("Failed to authenticate")
 
+    def _check_auth(self, status: int):
+        if status == 401:
+            self.authenticated = False
+            raise self.UpAuthError("Failed to authenticate")
+        if not self.authenticated and status < 400:
+            self.authenticated = True
+            LOG.info("Successfully authenticated")
+
+    async def _async_request(self, url: str, extras: dict):
+        if self.authenticated:
+            return await self.scheduler.async_request(lambda: self._async_send(url, extras))
+        # until the token has been accepted requests go one at a time, so a bad token costs one 401
+        # rather than one per concurrent stream
+        async with self._auth_lock:
+            if self.authenticated is False:
+                raise self.UpAuthError("Failed to authenticate")
+            response = await self.scheduler.async_request(lambda: self._async_send(url, extras))
+            self._check_auth(response[0])
+        return response
+
     def base_url(self) -> str:
         if os.environ.get("env") == "prod":
             return f"https://api.up.com.au/api/{VERSION}"
@@ -64,55 +350,177 @@ class UpClient():
     def join_endpoint(self, endpoint: str) -> str:
         return f"{self.base_url()}/{endpoint}"
 
-    async def async_get_request(self, endpoint: str = None, url: str = None, extras: dict = {}) -> Generator:
+    def _record_response(self, url: str, start: float, status: int, body: bytes):
+        endpoint = endpoint_label(url)
+        self.metrics.observe("http_request_seconds", time.perf_counter() - start, endpoint=endpoint)
+        self.metrics.inc("http_responses", endpoint=endpoint, status=status)
+        self.metrics.inc("http_bytes_received", len(body), endpoint=endpoint)
+
+    async def _async_send(self, url: str, extras: dict):
+        start = time.perf_counter()
+        async with self.http_session.get(url, **extras) as res:
+            status, headers, body = res.status, res.headers, await res.read()
+        self._record_response(url, start, status, body)
+        return status, headers, body
+
+    def _send(self, url: str, extras: dict):
+        start = time.perf_counter()
+        res = self.requests_session.get(url, **extras)
+        self._record_response(url, start, res.status_code, res.content)
+        return res.status_code, res.headers, res.content
+
+    def _decode(self, url: str, status: int, headers, body: bytes) -> dict:
+        if status == 401:
+            raise self.UpAuthError("Failed to authenticate")
+        if status >= 400:
+            error = self.UpRequestError(f"{status} error fetching {url}")
+            LOG.error(error)
+            raise error
+        return loads(body)
+
+    def _cache_lookup(self, url: str, extras: dict) -> tuple[str, dict, dict]:
+        # the cache key and entry for a request, plus its extras with any conditional headers added
+        if self.cache is None or endpoint_label(url) in UNCACHED_ENDPOINTS:
+            return None, None, extras
+        key = self.cache.key(url, extras.get("params"))
+        # get drops entries whose body file is gone, so validators are only sent for bodies that can be served
+        entry = self.cache.get(key)
+        if (headers := self.cache.conditional_headers(entry)):
+            extras = {**extras, "headers": {**extras.get("headers", {}), **headers}}
+        return key, entry, extras
+
+    def _archive(self, url: str, body: bytes):
+        if self.archive is not None and self.archive.append(url, body):
+            self.metrics.inc("pages_archived", endpoint=endpoint_label(url))
+
+    def _page(
+        self, url: str, key: str, entry: dict, status: int, headers, body: bytes, skip_unchanged: bool
+    ) -> dict | None:
+        # unchanged pages (a 304, or a 200 with the cached content hash) skip parsing entirely when the
+        # caller has already stored them, leaving just the next link to follow. Only new bodies are archived,
+        # an unchanged one was when it was first fetched. None when a 304's cached body has gone missing
+        # meanwhile, the caller then sends the request again without validators
+        if key is None:
+            res_json = self._decode(url, status, headers, body)
+            self._archive(url, body)
+            return res_json
+        if status == 304 and entry is not None:
+            cached = None if skip_unchanged else self.cache.body(key)
+            if not skip_unchanged and cached is None:
+                return None
+            self.cache.revalidated += 1
+            self.metrics.inc("http_cache", result="revalidated")
+            if skip_unchanged:
+                return {"data": [], "links": {"next": entry["next"]}}
+            return self._decode(url, 200, headers, cached)
+        if status >= 400:
+            return self._decode(url, status, headers, body)
+        digest = content_hash(body)
+        if entry is not None and entry["hash"] == digest:
+            self.cache.hits += 1
+            self.metrics.inc("http_cache", result="hit")
+            self.cache.refresh(key, headers)
+            if skip_unchanged:
+                return {"data": [], "links": {"next": entry["next"]}}
+            return self._decode(url, status, headers, body)
+        self.cache.misses += 1
+        self.metrics.inc("http_cache", result="miss")
+        res_json = self._decode(url, status, headers, body)
+        self.cache.put(key, body, headers, digest, res_json.get("links", {}).get("next"))
+        self._archive(url, body)
+        return res_json
+
+    async def async_get_request(
+        self, endpoint: str = None, url: str = None, extras: dict = {}, skip_unchanged: bool = False
+    ) -> Generator:
         url = url or self.join_endpoint(endpoint)
         page = 1
-        while True:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=self.headers, **extras) as res:
-                    res_json = await res.json()
-                    try:
-                        res.raise_for_status()
-                    except Exception as e:
-                        LOG.error(e)
-                        raise e
-                    LOG.info(f"Successfully fetched {url}, page {page}, extras {extras}")
-                    yield res_json
-
-                    if (next_page := res_json.get("links", {}).get("next")):
-                        url = next_page
-                        page += 1
-                        LOG.info("Fetching next page", page)
-                        continue
-                    LOG.info("Finished pagination")
-                    break
-    
-
-    def _get_request(self, endpoint: str = None, url: str = None, extras: dict = {}) -> Generator:
+        async with self:
+            while True:
+                key, entry, request_extras = self._cache_lookup(url, extras)
+                response = await self._async_request(url, request_extras)
+                if (res_json := self._page(url, key, entry, *response, skip_unchanged)) is None:
+                    # counted as a miss once it's refetched unconditionally
+                    response = await self._async_request(url, extras)
+                    res_json = self._page(url, key, None, *response, skip_unchanged)
+                self.metrics.inc("pages", endpoint=endpoint_label(url))
+                LOG.info(f"Successfully fetched {url}, page {page}, extras {extras}")
+                yield res_json
+
+                if (next_page := res_json.get("links", {}).get("next")):
+                    url = next_page
+                    page += 1
+                    LOG.info(f"Fetching next page {page}")
+                    continue
+                LOG.info("Finished pagination")
+                break
+
+    def _get_request(
+        self, endpoint: str = None, url: str = None, extras: dict = {}, skip_unchanged: bool = False
+    ) -> Generator:
         url = url or self.join_endpoint(endpoint)
         page = 1
         while True:
-            res = requests.get(url, headers=self.headers, **extras)
-            res_json = res.json()
-            try:
-                res.raise_for_status()
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 401:
-                    raise self.UpAuthError("Failed to authenticate")
-            except Exception as e:
-                LOG.error(e)
-                raise e
-            LOG.info(f"Successfully fetched {url}, \"page:\": page, \"extras\": extras")
+            key, entry, request_extras = self._cache_lookup(url, extras)
+            response = self.scheduler.request(lambda: self._send(url, request_extras))
+            self._check_auth(response[0])
+            if (res_json := self._page(url, key, entry, *response, skip_unchanged)) is None:
+                # counted as a miss once it's refetched unconditionally
+                response = self.scheduler.request(lambda: self._send(url, extras))
+                res_json = self._page(url, key, None, *response, skip_unchanged)
+            self.metrics.inc("pages", endpoint=endpoint_label(url))
+            LOG.info(f"Successfully fetched {url}, page {page}, extras {extras}")
             yield res_json
 
             if (next_page := res_json.get("links", {}).get("next")):
                 url = next_page
                 page += 1
-                LOG.info("Fetching next page", page)
+                LOG.info(f"Fetching next page {page}")
                 continue
             LOG.info("Finished pagination")
             break
 
+    def write(self, model, rows: list, statements: list = ()) -> int:
+        # every sink write goes through here so batch latency and commits are measured in one place
+        table = model.__tablename__
+        try:
+            with self.metrics.timer("db_batch_seconds", table=table):
+                count = self.sink.write(model, rows, statements)
+        except BatchWriteError:
+            self.metrics.inc("db_batch_errors", table=table)
+            raise
+        self.metrics.inc("rows_written", count, table=table)
+        if self.sink.stateful:
+            self.metrics.inc("db_commits")
+        return count
+
+    def save_cache(self, errors: float) -> bool:
+        # errors is the db_batch_errors count when the run started. A write that failed since means a page
+        # fetched meanwhile may not be stored, so the last good index on disk is kept
+        if self.cache is None:
+            return False
+        if self.metrics.counter("db_batch_errors") != errors:
+            LOG.warning("Not saving the HTTP cache index, writes failed since it was last saved")
+            return False
+        marker = None
+        if self.sink.stateful:
+            # stored before the index is written, an index saved without it in the database is cleared later
+            marker = uuid.uuid4().hex
+            HttpCacheMarkers.replace(self.session, self.cache.marker, marker)
+        self.cache.save(marker)
+        return True
+
+    def verify_cache(self) -> bool:
+        # a cache saved against another database, or this one before it was reset or restored, would skip
+        # pages whose rows aren't stored. False when it was cleared
+        if self.cache is None or not self.sink.stateful or not self.cache.entries:
+            return True
+        if self.cache.marker is not None and HttpCacheMarkers.exists(self.session, self.cache.marker):
+            return True
+        LOG.warning("The HTTP cache wasn't saved against this database, clearing it")
+        self.cache.clear()
+        return False
+
 base = declarative_base()
 
 @dataclass
@@ -128,24 +536,9 @@ class Accounts(base):
     currency = Column(String)
     value_str = Column(String)
     value_base = Column(Integer)
-    created_at = Column(String)
-
+    created_at = Column(DateTime)
+    content_hash = Column(String)
 
-    @classmethod
-    def sync_accounts(cls, client: UpClient):
-        LOG.info("\n💳💳💳💳💳💳💳💳💳💳💳💳💳💳💳💳")
-        LOG.info("Syncing Accounts")
-        LOG.info("💳💳💳💳💳💳💳💳💳💳💳💳💳💳💳💳")
-        count = 0
-        #TODO move this to a method on  accounts class
-        for res in client._get_request(endpoint="/accounts"):
-            for lst in res.get("data", []):
-                account = Accounts.parse_account(lst)
-                Accounts.insert(client.session, account)
-                count += 1
-        LOG.info("💳💳💳💳💳💳💳💳💳💳💳💳💳💳💳💳")
-        LOG.info(f"Successfully synced {count} accounts")
-        LOG.info("💳💳💳💳💳💳💳💳💳💳💳💳💳💳💳💳")
 
     @classmethod
     def insert(cls, session: DBClient.session, row: Accounts):
@@ -156,34 +549,51 @@ class Accounts(base):
             session.rollback()
             LOG.error(e)
 
+    @classmethod
+    def insert_batch(cls, session: DBClient.session, rows: list[dict]) -> int:
+        return upsert_rows(session, Accounts, rows)
+
+    @classmethod
+    def hash_index(cls, session: DBClient.session) -> dict[str, str]:
+        return dict(session.query(Accounts.id, Accounts.content_hash).all())
 
     @classmethod
     def from_id(cls, session: DBClient.session, id: str) -> Accounts:
         return sanitize(session.query(Accounts).filter(Accounts.id == id).first())
 
     @classmethod
-    def all(cls, session: DBClient.session) -> list[Accounts]:
-        return [sanitize(account.__dict__) for account in session.query(Accounts).all()]
+    def stream(
+        cls,
+        session: DBClient.session,
+        columns: list[str] = None,
+        account_id: str | list[str] = None,
+        since: str = None,
+        until: str = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        as_dicts: bool = False,
+    ) -> Generator[list]:
+        # chunks of accounts (all columns unless given), optionally only account_id and those created in [since, until)
+        query = filtered(select(*projection(cls, columns)), Accounts.id, account_id)
+        if since:
+            query = query.where(Accounts.created_at >= since)
+        if until:
+            query = query.where(Accounts.created_at < until)
+        return stream_rows(session, query, chunk_size, as_dicts)
+
+    @classmethod
+    def all(cls, session: DBClient.session) -> list[dict]:
+        return [row for chunk in cls.stream(session, as_dicts=True) for row in chunk]
 
     @classmethod
     def parse_account(self, account: dict) -> Accounts:
-        return Accounts(
-            id=account.get("id"),
-            type=account.get("type"),
-            display_name=account.get("attributes", {}).get("displayName"),
-            account_type=account.get("attributes", {}).get("accountType"),
-            ownership_type=account.get("attributes", {}).get("ownershipType"),
-            balance=float(account.get("attributes", {}).get("balance", {}).get("value")),
-            currency=account.get("attributes", {}).get("balance", {}).get("currencyCode"),
-            value_str=account.get("attributes", {}).get("balance", {}).get("value"),
-            value_base=account.get("attributes", {}).get("balance", {}).get("valueInBaseUnits"),
-            created_at=account.get("attributes", {}).get("createdAt")
-        )
+        return Accounts(**parse_account(account)._asdict())
 
 
 @dataclass
 class Transactions(base):
     __tablename__ = "transactions"
+    __table_args__ = (Index("transactions_account_id_created_at_idx", "account_id", "created_at"),)
+    STREAM = "transactions"
     DEFAULT_LOOKBACK = 30
     DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S+00:00"
 
@@ -198,41 +608,394 @@ class Transactions(base):
     value_str = Column(String)
     value_base = Column(Integer)
     card_purchase_suffix = Column(String)
-    settled_at = Column(String)
-    created_at = Column(String)
+    settled_at = Column(DateTime)
+    created_at = Column(DateTime)
+    content_hash = Column(String)
+
+    @classmethod
+    def lookback_since(cls, days: int) -> str:
+        # from midnight, so request URLs (and with them http cache keys) stay the same for the whole day
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        return (today - datetime.timedelta(days=days)).strftime(cls.DATETIME_FORMAT)
 
     @classmethod
     def determine_account_filter_since_param(cls, client: UpClient, account_id: str, session: DBClient.session):
         # lookback takes precedence, if not given then look at the last date of transaction
         if client.lookback:
-            return (datetime.datetime.now() - datetime.timedelta(days=client.lookback)).strftime(cls.DATETIME_FORMAT)
+            return cls.lookback_since(client.lookback)
+        if (watermark := SyncState.get_watermark(session, account_id, cls.STREAM)):
+            return watermark.strftime(cls.DATETIME_FORMAT)
         return cls.max_transaction_date_for_account(session, account_id)
 
+    @classmethod
+    def change_window_since(cls, client: UpClient, account_ids: list[str]) -> str:
+        # the window the change index covers, rows fetched from before it are treated as new and left
+        # to the upsert's own content_hash check
+        if client.lookback:
+            return cls.lookback_since(client.lookback)
+        watermark = client.session.query(func.min(SyncState.watermark)).filter(
+            SyncState.stream == cls.STREAM, SyncState.account_id.in_(account_ids)
+        ).scalar()
+        if watermark:
+            return watermark.strftime(cls.DATETIME_FORMAT)
+        return cls.lookback_since(cls.DEFAULT_LOOKBACK)
+
+    @classmethod
+    def hash_index(cls, session: DBClient.session, since: str, account_ids: list[str]) -> dict[str, str]:
+        query = session.query(Transactions.id, Transactions.content_hash).filter(
+            Transactions.account_id.in_(account_ids), Transactions.created_at >= since
+        )
+        return dict(query.all())
+
+    @classmethod
+    def stored_hashes(cls, session: DBClient.session, ids: list[str]) -> dict[str, str]:
+        # the hashes of just these rows, for change indexes that don't load the whole window upfront
+        query = session.query(Transactions.id, Transactions.content_hash).filter(Transactions.id.in_(ids))
+        return dict(query.all())
+
+    @classmethod
+    def time_slices(cls, since: str, slice_days: int, max_slices: int) -> list[tuple[str, str]]:
+        # splits [since, now) into at most max_slices windows of roughly slice_days, the last one open ended.
+        # Bounds fall on whole days from since so they only move once a day
+        start = datetime.datetime.strptime(since, cls.DATETIME_FORMAT)
+        span = datetime.datetime.now() - start
+        count = min(max_slices, math.ceil(span / datetime.timedelta(days=slice_days)))
+        step = datetime.timedelta(days=max(1, span.days // count)) if count > 1 else None
+        if step is None or step >= span:
+            return [(since, None)]
+        bounds = [(start + step * i).strftime(cls.DATETIME_FORMAT) for i in range(count) if step * i < span]
+        return list(zip(bounds, bounds[1:] + [None]))
+
     @classmethod
     async def sync_transactions(cls, client: UpClient, account_ids=None):
-        accounts = account_ids or client.session.query(Accounts.id, Accounts.display_name).all()
+        if account_ids:
+            accounts = account_ids
+        elif client.accounts is not None:
+            accounts = client.accounts
+        elif client.sink.stateful:
+            accounts = client.session.query(Accounts.id, Accounts.display_name).all()
+        else:
+            accounts = []
+        client.run_id = uuid.uuid4().hex
+        client.run_started_at = datetime.datetime.now().strftime(cls.DATETIME_FORMAT)
+        if client.detect_changes and client.sink.stateful and client.bounded_memory:
+
+            def lookup(ids: list[str]) -> dict[str, str]:
+                # runs on client.lookups, in a session of its own as client.session belongs to the event loop
+                with DBClient(client.pool_size).session as session:
+                    return cls.stored_hashes(session, ids)
+
+            client.changes[cls.__tablename__] = ChangeIndex(
+                cls.__tablename__, {}, client.metrics, lookup, client.max_tracked_ids
+            )
+            client.lookups = ThreadPoolExecutor(max_workers=1)
+        elif client.detect_changes and client.sink.stateful:
+            account_ids = [account.id for account in accounts]
+            since = cls.change_window_since(client, account_ids)
+            hashes = cls.hash_index(client.session, since, account_ids)
+            LOG.info(f"Loaded {len(hashes)} stored transaction hashes since {since}")
+            client.changes[cls.__tablename__] = ChangeIndex(cls.__tablename__, hashes, client.metrics)
+        if client.max_pages_in_flight:
+            client.page_slots = asyncio.Semaphore(client.max_pages_in_flight)
+        # fetchers push parsed pages onto bounded queues, one per writer so an account's pages stay in order
+        queues = [asyncio.Queue(maxsize=client.queue_size) for _ in range(client.writers)]
+        writers = [asyncio.create_task(cls._write_pages(client, queue)) for queue in queues]
+        sync = cls._sync_transactions_for_account if client.claimed is None else cls._sync_claimed_account
         cors = []
-        for account in accounts:
-            cors.append(cls._sync_transactions_for_account(client, account))
-        await asyncio.gather(*cors)
+        for i, account in enumerate(accounts):
+            cors.append(sync(client, account, queues[i % len(queues)]))
+        try:
+            async with client:
+                results = await asyncio.gather(*cors, return_exceptions=True)
+        finally:
+            if client.lookups is not None:
+                client.lookups.shutdown()
+                client.lookups = None
+        for queue in queues:
+            await queue.put(None)
+        await asyncio.gather(*writers)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return sum(state.count for state in results)
 
     @classmethod
-    async def _sync_transactions_for_account(cls, client: UpClient, account: Accounts):
+    async def _sync_claimed_account(cls, client: UpClient, account: Accounts, queue: asyncio.Queue):
+        # joint accounts show up under every member's token. The first client to get to one syncs it and the
+        # others wait on its claim, only syncing the account themselves when that client's fetch failed
+        while (claim := client.claimed.get(account.id)) is not None:
+            if await asyncio.shield(claim):
+                LOG.info(f"Transactions for account {account.id} were already synced by another token")
+                return AccountSync(account.id)
+        claim = client.claimed[account.id] = asyncio.get_running_loop().create_future()
+        try:
+            state = await cls._sync_transactions_for_account(client, account, queue)
+        except BaseException:
+            del client.claimed[account.id]
+            claim.set_result(False)
+            raise
+        claim.set_result(True)
+        return state
+
+    @classmethod
+    async def _sync_transactions_for_account(cls, client: UpClient, account: Accounts, queue: asyncio.Queue):
         LOG.info("🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝")
-        LOG.info(f"Syncing transactions for account: {account._mapping['display_name']}")
+        LOG.info(f"Syncing transactions for account: {account.display_name}")
         LOG.info("🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝🤝")
-        count = 0
-        account_id = account._mapping["id"]
-        params = {"filter[since]": cls.determine_account_filter_since_param(client, account_id, client.session)}
-        async for record in client.async_get_request(
-            endpoint=f"accounts/{account_id}/transactions",
-            extras={"params": params}
-        ):
-            for lst in record.get("data", []):
-                transaction = Transactions.parse_transaction(lst, account_id)
-                Transactions.insert(client.session, transaction)
-                count += 1
-        LOG.info(f"Successfully synced {count} transactions for account {account_id}")
+        account_id = account.id
+        state = AccountSync(account_id)
+        stateful = client.sink.stateful
+        # cursors left behind by a run that died mid-pagination are finished first
+        cursors = SyncState.cursors(client.session, account_id, cls.STREAM) if stateful else {}
+        if cursors:
+            LOG.info(f"Resuming {len(cursors)} unfinished cursors for account {account_id}")
+        if stateful:
+            since = cls.determine_account_filter_since_param(client, account_id, client.session)
+        else:
+            since = cls.lookback_since(client.lookback or cls.DEFAULT_LOOKBACK)
+        slices = cls.time_slices(since, client.slice_days, client.max_slices)
+        if len(slices) > 1:
+            LOG.info(f"Fetching account {account_id} in {len(slices)} date slices")
+        url = client.join_endpoint(f"accounts/{account_id}/transactions")
+        for i, (since, until) in enumerate(slices):
+            params = {"filter[since]": since}
+            if until:
+                params["filter[until]"] = until
+            cursors[f"{cls.STREAM}:{client.run_id}:{i}"] = f"{url}?{urlencode(params)}"
+        if stateful:
+            SyncState.start(client.session, account_id, cls.STREAM, cursors, client.run_id, client.run_started_at)
+        if len(cursors) > 1:
+            state.ids = {}
+        try:
+            results = await asyncio.gather(
+                *[cls._fetch_cursor(client, state, queue, stream, cursor) for stream, cursor in cursors.items()],
+                return_exceptions=True,
+            )
+        finally:
+            # still flush whatever was fetched before a failure
+            await queue.put((state, None))
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return state
+
+    @classmethod
+    async def _fetch_cursor(cls, client: UpClient, state: AccountSync, queue: asyncio.Queue, stream: str, url: str):
+        pages = client.async_get_request(url=url, skip_unchanged=client.sink.stateful)
+        try:
+            while (record := await cls._next_page(client, pages)) is not None:
+                await cls._queue_page(client, state, queue, stream, record)
+        finally:
+            await pages.aclose()
+
+    @classmethod
+    async def _next_page(cls, client: UpClient, pages) -> dict | None:
+        # with a cap on pages in flight a slot is taken before a page is fetched, the writer hands it
+        # back once the page is written
+        if client.page_slots is not None:
+            await client.page_slots.acquire()
+        try:
+            return await anext(pages)
+        except BaseException as e:
+            if client.page_slots is not None:
+                client.page_slots.release()
+            if isinstance(e, StopAsyncIteration):
+                return None
+            raise
+
+    @classmethod
+    async def _queue_page(cls, client: UpClient, state: AccountSync, queue: asyncio.Queue, stream: str, record):
+        rows = parse_transactions(record, state.account_id)
+        client.metrics.inc("rows_parsed", len(rows), stream=cls.STREAM)
+        if (changes := client.changes.get(cls.__tablename__)) is not None:
+            stored = None
+            if (unknown := changes.unknown(rows)) and client.lookups is not None:
+                stored = await asyncio.get_running_loop().run_in_executor(client.lookups, changes.lookup, unknown)
+            rows = changes.filter(rows, stored)
+            links = parse_transaction_page_links(record, {row.id for row in rows})
+        else:
+            links = parse_transaction_page_links(record)
+        await queue.put((state, Page(stream, rows, record.get("links", {}).get("next"), links)))
+        client.metrics.observe("queue_depth", queue.qsize(), buckets=SIZE_BUCKETS)
+
+    @classmethod
+    async def _write_pages(cls, client: UpClient, queue: asyncio.Queue):
+        # each writer owns a thread (and with it a sink session) so writes never block the event loop
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while (item := await queue.get()) is not None:
+                state, page = item
+                try:
+                    await loop.run_in_executor(executor, cls._write_page, client, state, page)
+                except Exception as e:
+                    LOG.error(f"Failed to write transactions for account {state.account_id}: {e}")
+                    client.metrics.inc("db_batch_errors", table=cls.__tablename__)
+                    state.failed += len(page.rows) if page else 0
+                    cls._unwritten(state, [row.id for row in page.rows] if page else [])
+                finally:
+                    if state.unwritten and (changes := client.changes.get(cls.__tablename__)) is not None:
+                        changes.forget(state.unwritten)
+                    state.unwritten = None
+                    if page is not None and client.page_slots is not None:
+                        client.page_slots.release()
+
+    @classmethod
+    def _checkpoints(cls, client: UpClient, account_id: str, cursors: dict, watermark: str) -> list:
+        if not client.sink.stateful:
+            return []
+        statements = [
+            SyncState.checkpoint(account_id, cls.STREAM, client.run_id, client.run_started_at, watermark=watermark)
+        ]
+        for stream, cursor in cursors.items():
+            if cursor:
+                statements.append(
+                    SyncState.checkpoint(account_id, stream, client.run_id, client.run_started_at, cursor=cursor)
+                )
+            else:
+                statements.append(SyncState.finish(account_id, stream))
+        return statements
+
+    @classmethod
+    def _write_page(cls, client: UpClient, state: AccountSync, page: Page):
+        if page is None:
+            return cls._finish_account(client, state)
+        rows = page.rows
+        if state.ids is not None:
+            rows = [row for row in rows if row.id not in state.ids]
+            state.ids.update(dict.fromkeys(row.id for row in rows))
+            # a forgotten id fetched again is just upserted again
+            forget_oldest(state.ids, client.max_tracked_ids)
+        links = page.links or {}
+        state.seen += len(rows)
+        watermark = max((row.created_at for row in rows if row.created_at), default=None)
+        # large backfills switch over to COPY into a staging table once past the threshold
+        if state.loader is None and state.seen > client.copy_threshold:
+            state.loader = client.sink.copy_loader(Transactions)
+            if state.loader is not None:
+                LOG.info(f"Switching to COPY backfill for account {state.account_id} after {state.seen} rows")
+                state.pending_cursors = {}
+                state.staged = {}
+        if state.loader is not None:
+            try:
+                with client.metrics.timer("db_copy_seconds", table=cls.__tablename__):
+                    state.loader.copy(rows)
+                # links don't go through the staging table, replacing them early is harmless as a failed
+                # merge leaves the rows unhashed and they're rewritten next run
+                cls.write_batch(client, [], cls.batch_links(links, rows))
+            except DBClient.BatchWriteError as e:
+                LOG.error(e)
+                client.metrics.inc("db_batch_errors", table=cls.__tablename__)
+                state.failed += state.loader.rows
+                state.loader = None
+                cls._unwritten(state, [*state.staged, *(row.id for row in rows)])
+                state.staged = None
+                return
+            state.staged.update(dict.fromkeys(row.id for row in rows))
+            # an id forgotten here has long been forgotten by a change index capped the same way
+            forget_oldest(state.staged, client.max_tracked_ids)
+            state.pending_cursors[page.stream] = page.cursor
+            state.pending_watermark = max(filter(None, [state.pending_watermark, watermark]), default=None)
+            return
+        # the checkpoint rides along with the page's last batch so the cursor only moves once it's all committed.
+        # Once any batch of the account has failed nothing more is checkpointed, the cursor and watermark would
+        # move past rows that were never written and the next run wouldn't fetch them again
+        checkpoints = cls._checkpoints(client, state.account_id, {page.stream: page.cursor}, watermark)
+        batches = [rows[start:start + client.batch_size] for start in range(0, len(rows), client.batch_size)] or [[]]
+        for i, batch in enumerate(batches):
+            last = i == len(batches) - 1
+            try:
+                state.count += cls.write_batch(
+                    client, batch, cls.batch_links(links, batch), checkpoints if last and not state.failed else ()
+                )
+            except DBClient.BatchWriteError as e:
+                LOG.error(e)
+                state.failed += len(batch)
+                cls._unwritten(state, [row.id for row in batch])
+
+    @classmethod
+    def _unwritten(cls, state: AccountSync, ids: list[str]):
+        # rows that failed to write are written again if they're fetched again later in the run, so they're
+        # forgotten by the account's dedupe here and by the change index once the writer's back on the loop
+        if state.ids is not None:
+            for id in ids:
+                state.ids.pop(id, None)
+        state.unwritten = (state.unwritten or []) + ids
+
+    @classmethod
+    def _finish_account(cls, client: UpClient, state: AccountSync):
+        if state.loader is not None:
+            try:
+                with client.metrics.timer("db_merge_seconds", table=cls.__tablename__):
+                    merged = state.loader.merge(DailyAccountTotals.refresh_staged_sql(state.loader.staging))
+                client.metrics.inc("rows_written", merged, table=cls.__tablename__)
+                client.metrics.inc("db_commits")
+                state.count += merged
+                if not state.failed:
+                    client.write(
+                        Transactions,
+                        [],
+                        cls._checkpoints(client, state.account_id, state.pending_cursors, state.pending_watermark),
+                    )
+            except DBClient.BatchWriteError as e:
+                LOG.error(e)
+                client.metrics.inc("db_batch_errors", table=cls.__tablename__)
+                state.failed += state.loader.rows
+                cls._unwritten(state, list(state.staged))
+            state.loader = None
+            state.staged = None
+        if client.sink.stateful and not state.failed:
+            client.write(Transactions, [], [
+                SyncState.checkpoint(
+                    state.account_id,
+                    cls.STREAM,
+                    client.run_id,
+                    client.run_started_at,
+                    completed_at=datetime.datetime.now().strftime(cls.DATETIME_FORMAT),
+                )
+            ])
+        LOG.info(f"Successfully synced {state.count} transactions for account {state.account_id}")
+        if state.failed:
+            LOG.error(f"Failed to sync {state.failed} transactions for account {state.account_id}")
+
+    @classmethod
+    def batch_links(cls, links: dict, rows: list) -> dict:
+        return {row.id: links[row.id] for row in rows if row.id in links}
+
+    @classmethod
+    def link_rows(cls, links: dict) -> dict:
+        rows = {TransactionCategories: [], TransactionTags: []}
+        for category, tags in links.values():
+            if category is not None:
+                rows[TransactionCategories].append(category)
+            rows[TransactionTags].extend(tags)
+        return rows
+
+    @classmethod
+    def link_statements(cls, links: dict) -> list:
+        # a transaction's links are replaced wholesale, so a removed tag or category goes too
+        if not links:
+            return []
+        statements = []
+        for model, rows in cls.link_rows(links).items():
+            table = model.__table__
+            statements.append(delete(table).where(table.c.transaction_id.in_(list(links))))
+            if rows:
+                statements.append(pg_insert(table).values([row._asdict() for row in rows]).on_conflict_do_nothing())
+        return statements
+
+    @classmethod
+    def write_batch(cls, client: UpClient, rows: list, links: dict, statements: list = (), touched: set = ()) -> int:
+        # with postgres the links and the daily totals of the days written to (plus touched, the days of
+        # rows deleted by statements) are updated in the same commit as the transactions, file sinks get
+        # the links as rows of their own tables
+        if client.sink.stateful:
+            rollups = DailyAccountTotals.refresh(DailyAccountTotals.keys(rows) | set(touched))
+            return client.write(Transactions, rows, [*cls.link_statements(links), *statements, *rollups])
+        count = client.write(Transactions, rows, statements)
+        for model, link_rows in cls.link_rows(links).items():
+            if link_rows:
+                client.write(model, link_rows)
+        return count
 
     @classmethod
     def insert(cls, session, row: Transactions):
@@ -244,37 +1007,315 @@ class Transactions(base):
             LOG.error(e)
 
     @classmethod
-    def all(cls, session: DBClient.session) -> list[Transactions]:
-        return [sanitize(account.__dict__) for account in session.query(Transactions).all()]
+    def insert_batch(cls, session: DBClient.session, rows: list[dict], statements: list = ()) -> int:
+        return upsert_rows(session, Transactions, rows, statements)
+
+    @classmethod
+    def stream(
+        cls,
+        session: DBClient.session,
+        columns: list[str] = None,
+        account_id: str | list[str] = None,
+        since: str = None,
+        until: str = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        as_dicts: bool = False,
+    ) -> Generator[list]:
+        # chunks of transactions (all columns unless given), optionally only those of account_id and created in
+        # [since, until), which the (account_id, created_at) index serves
+        query = filtered(select(*projection(cls, columns)), Transactions.account_id, account_id)
+        if since:
+            query = query.where(Transactions.created_at >= since)
+        if until:
+            query = query.where(Transactions.created_at < until)
+        return stream_rows(session, query, chunk_size, as_dicts)
+
+    @classmethod
+    def all(cls, session: DBClient.session) -> list[dict]:
+        return [row for chunk in cls.stream(session, as_dicts=True) for row in chunk]
 
     @classmethod
     def min_transaction_date_for_account(cls, session: DBClient.session, account_id: str):
         return session.query(func.min(Transactions.created_at)).\
             filter(Transactions.account_id == account_id).scalar().strftime(cls.DATETIME_FORMAT)
 
+    @classmethod
+    def max_transaction_date_query(cls, session: DBClient.session, account_id: str):
+        return session.query(func.max(Transactions.created_at)).filter(Transactions.account_id == account_id)
+
     @classmethod
     def max_transaction_date_for_account(cls, session: DBClient.session, account_id: str):
-        res = session.query(func.max(Transactions.created_at)).\
-            filter(Transactions.account_id == account_id).scalar()
+        res = cls.max_transaction_date_query(session, account_id).scalar()
         if res:
             return res.strftime(cls.DATETIME_FORMAT)
         return (datetime.datetime.now() - datetime.timedelta(days=cls.DEFAULT_LOOKBACK)).strftime(cls.DATETIME_FORMAT)
 
     @classmethod
     def parse_transaction(cls, transaction: dict, account_id: str) -> Transactions:
-        purchase_method = transaction.get("attributes", {}).get("cardPurchaseMethod", {})
-        return Transactions(
-            id=transaction.get("id"),
-            account_id=account_id,
-            status=transaction.get("attributes", {}).get("status"),
-            raw_text=transaction.get("attributes", {}).get("rawText"),
-            description=transaction.get("attributes", {}).get("description"),
-            message=transaction.get("attributes", {}).get("message"),
-            categorizable=transaction.get("attributes", {}).get("isCategorizable"),
-            currency=transaction.get("attributes", {}).get("amount", {}).get("currencyCode"),
-            value_str=transaction.get("attributes", {}).get("amount", {}).get("value"),
-            value_base=transaction.get("attributes", {}).get("amount", {}).get("valueInBaseUnits"),
-            card_purchase_suffix=purchase_method.get("cardNumberSuffix") if purchase_method else None,
-            settled_at=transaction.get("attributes", {}).get("settledAt"),
-            created_at=transaction.get("attributes", {}).get("createdAt"),
-        )
+        return Transactions(**parse_transaction(transaction, account_id)._asdict())
+
+
+@dataclass
+class Categories(base):
+    __tablename__ = "categories"
+
+    id = Column(String, primary_key=True)
+    name = Column(String)
+    parent_id = Column(String)
+    content_hash = Column(String)
+
+    @classmethod
+    def hash_index(cls, session: DBClient.session) -> dict[str, str]:
+        return dict(session.query(Categories.id, Categories.content_hash).all())
+
+
+@dataclass
+class Tags(base):
+    __tablename__ = "tags"
+
+    id = Column(String, primary_key=True)
+
+    @classmethod
+    def hash_index(cls, session: DBClient.session) -> dict[str, None]:
+        return dict.fromkeys(id for id, in session.query(Tags.id).all())
+
+
+@dataclass
+class Attachments(base):
+    __tablename__ = "attachments"
+    __table_args__ = (Index("attachments_transaction_id_idx", "transaction_id"),)
+
+    id = Column(String, primary_key=True)
+    transaction_id = Column(String)
+    created_at = Column(DateTime)
+    file_url = Column(String)
+    file_url_expires_at = Column(DateTime)
+    file_extension = Column(String)
+    file_content_type = Column(String)
+    content_hash = Column(String)
+
+    @classmethod
+    def hash_index(cls, session: DBClient.session) -> dict[str, str]:
+        return dict(session.query(Attachments.id, Attachments.content_hash).all())
+
+
+# Per account and day totals of value_base, so dashboards don't aggregate the whole transactions table
+# on every load. Every transaction write recomputes the days its batch touched in the same commit, which
+# stays right however a row changed (an upsert, a settled amount, a deleted transaction). rebuild()
+# recomputes everything from scratch, check() compares the table against that without writing.
+@dataclass
+class DailyAccountTotals(base):
+    __tablename__ = "daily_account_totals"
+
+    account_id = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    debit_base = Column(BigInteger)
+    credit_base = Column(BigInteger)
+    count = Column(Integer)
+
+    COLUMNS = ("account_id", "day", "debit_base", "credit_base", "count")
+
+    @classmethod
+    def totals(cls, where=None):
+        # (account_id, day, debit_base, credit_base, count) recomputed from transactions
+        transactions = Transactions.__table__
+        day = cast(transactions.c.created_at, Date)
+        query = select(
+            transactions.c.account_id,
+            day,
+            func.sum(func.greatest(-transactions.c.value_base, 0)),
+            func.sum(func.greatest(transactions.c.value_base, 0)),
+            func.count(),
+        ).where(transactions.c.account_id.isnot(None), transactions.c.created_at.isnot(None))
+        if where is not None:
+            query = query.where(where)
+        return query.group_by(transactions.c.account_id, day)
+
+    @classmethod
+    def keys(cls, rows: list) -> set[tuple[str, str]]:
+        # Postgres drops the offset when storing created_at, so the day of Up's local timestamp is its first
+        # 10 characters, the same day created_at::date gives
+        return {(row.account_id, str(row.created_at)[:10]) for row in rows if row.account_id and row.created_at}
+
+    @classmethod
+    def stored_keys(cls, session: DBClient.session, ids: list[str]) -> set[tuple[str, str]]:
+        # the days of stored transactions, for refreshing the days rows are deleted from
+        day = cast(Transactions.created_at, Date)
+        rows = session.query(Transactions.account_id, day).filter(Transactions.id.in_(ids)).distinct().all()
+        return {(account_id, day.isoformat()) for account_id, day in rows if account_id and day}
+
+    @classmethod
+    def refresh(cls, keys: set[tuple[str, str]]) -> list:
+        # statements recomputing the given (account_id, day) totals, run after the batch's own writes. Each
+        # day is a range on the (account_id, created_at) index rather than a created_at::date comparison
+        if not keys:
+            return []
+        table = cls.__table__
+        transactions = Transactions.__table__
+        pairs = sorted((account_id, datetime.date.fromisoformat(day)) for account_id, day in keys)
+        days = or_(*[
+            and_(
+                transactions.c.account_id == account_id,
+                transactions.c.created_at >= day,
+                transactions.c.created_at < day + datetime.timedelta(days=1),
+            )
+            for account_id, day in pairs
+        ])
+        insert = pg_insert(table).from_select(list(cls.COLUMNS), cls.totals(days))
+        return [
+            # days left without any transactions go, the rest are rewritten
+            delete(table).where(tuple_(table.c.account_id, table.c.day).in_(pairs)),
+            # a concurrent writer (webhooks next to a sync) may have recomputed the same day first
+            insert.on_conflict_do_update(
+                index_elements=["account_id", "day"],
+                set_={name: insert.excluded[name] for name in cls.COLUMNS[2:]},
+            ),
+        ]
+
+    @classmethod
+    def refresh_staged_sql(cls, staging: str) -> list[str]:
+        # the same for every day in a COPY staging table, run in the merge's transaction
+        days = f"SELECT DISTINCT account_id, created_at::date AS day FROM {staging} WHERE created_at IS NOT NULL"
+        return [
+            f"DELETE FROM daily_account_totals t USING ({days}) d WHERE t.account_id = d.account_id AND t.day = d.day",
+            "INSERT INTO daily_account_totals (account_id, day, debit_base, credit_base, count) "
+            "SELECT t.account_id, t.created_at::date, SUM(GREATEST(-t.value_base, 0)), SUM(GREATEST(t.value_base, 0)), "
+            f"COUNT(*) FROM transactions t JOIN ({days}) d ON t.account_id = d.account_id "
+            "AND t.created_at >= d.day AND t.created_at < d.day + 1 GROUP BY t.account_id, t.created_at::date "
+            "ON CONFLICT (account_id, day) DO UPDATE SET debit_base = EXCLUDED.debit_base, "
+            "credit_base = EXCLUDED.credit_base, count = EXCLUDED.count",
+        ]
+
+    @classmethod
+    def rebuild(cls, session: DBClient.session) -> int:
+        table = cls.__table__
+        try:
+            session.execute(delete(table))
+            rows = session.execute(pg_insert(table).from_select(list(cls.COLUMNS), cls.totals())).rowcount
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        LOG.info(f"Rebuilt {rows} {cls.__tablename__} rows")
+        return rows
+
+    @classmethod
+    def check(cls, session: DBClient.session) -> list[dict]:
+        # days where the stored totals differ from a full recompute, missing or extra days included
+        expected = {(row[0], row[1]): tuple(row[2:]) for row in session.execute(cls.totals()).all()}
+        stored = {
+            (row.account_id, row.day): (row.debit_base, row.credit_base, row.count)
+            for row in session.execute(select(cls.__table__)).all()
+        }
+        session.rollback()
+        mismatches = []
+        for key in sorted(expected.keys() | stored.keys()):
+            if expected.get(key) != stored.get(key):
+                mismatches.append({
+                    "account_id": key[0],
+                    "day": key[1].isoformat(),
+                    "expected": expected.get(key),
+                    "stored": stored.get(key),
+                })
+        return mismatches
+
+
+# link tables for transaction relationships, no foreign keys since the streams they point at may be
+# synced separately (or not at all with --streams)
+@dataclass
+class TransactionCategories(base):
+    __tablename__ = "transaction_categories"
+    __table_args__ = (Index("transaction_categories_category_id_idx", "category_id"),)
+
+    transaction_id = Column(String, primary_key=True)
+    category_id = Column(String)
+    parent_category_id = Column(String)
+
+
+@dataclass
+class TransactionTags(base):
+    __tablename__ = "transaction_tags"
+    __table_args__ = (Index("transaction_tags_tag_id_idx", "tag_id"),)
+
+    transaction_id = Column(String, primary_key=True)
+    tag_id = Column(String, primary_key=True)
+
+
+@dataclass
+class SyncState(base):
+    # one row per account and stream holding the committed watermark, plus one row per in-flight
+    # cursor (stream "<stream>:<run_id>:<n>") that is deleted once that cursor is exhausted
+    __tablename__ = "sync_state"
+
+    account_id = Column(String, primary_key=True)
+    stream = Column(String, primary_key=True)
+    watermark = Column(DateTime)
+    cursor = Column(String)
+    run_id = Column(String)
+    started_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    completed_at = Column(DateTime)
+
+    @classmethod
+    def get_watermark(cls, session: DBClient.session, account_id: str, stream: str):
+        return session.query(SyncState.watermark).\
+            filter(SyncState.account_id == account_id, SyncState.stream == stream).scalar()
+
+    @classmethod
+    def cursors(cls, session: DBClient.session, account_id: str, stream: str) -> dict:
+        rows = session.query(SyncState.stream, SyncState.cursor).filter(
+            SyncState.account_id == account_id,
+            SyncState.stream.like(f"{stream}:%"),
+            SyncState.cursor.isnot(None),
+        ).all()
+        return {row.stream: row.cursor for row in rows}
+
+    @classmethod
+    def checkpoint(cls, account_id: str, stream: str, run_id: str, started_at: str, **values):
+        # only the given columns are updated, and the watermark never moves backwards
+        row = {
+            "account_id": account_id,
+            "stream": stream,
+            "run_id": run_id,
+            "started_at": started_at,
+            "updated_at": datetime.datetime.now().strftime(Transactions.DATETIME_FORMAT),
+            **values,
+        }
+        stmt = pg_insert(cls.__table__).values(row)
+        set_ = {name: stmt.excluded[name] for name in row if name not in ("account_id", "stream")}
+        if "watermark" in values:
+            set_["watermark"] = func.greatest(cls.__table__.c.watermark, stmt.excluded.watermark)
+        return stmt.on_conflict_do_update(index_elements=["account_id", "stream"], set_=set_)
+
+    @classmethod
+    def finish(cls, account_id: str, stream: str):
+        return delete(cls.__table__).where(cls.account_id == account_id, cls.stream == stream)
+
+    @classmethod
+    def start(
+        cls, session: DBClient.session, account_id: str, stream: str, cursors: dict, run_id: str, started_at: str
+    ):
+        session.execute(cls.checkpoint(account_id, stream, run_id, started_at))
+        for cursor_stream, cursor in cursors.items():
+            session.execute(cls.checkpoint(account_id, cursor_stream, run_id, started_at, cursor=cursor))
+        session.commit()
+
+
+@dataclass
+class HttpCacheMarkers(base):
+    # the marker of each HTTP cache index saved against this database, replaced on every save
+    __tablename__ = "http_cache_markers"
+
+    marker = Column(String, primary_key=True)
+    saved_at = Column(DateTime)
+
+    @classmethod
+    def exists(cls, session: DBClient.session, marker: str) -> bool:
+        return session.query(cls.marker).filter(cls.marker == marker).first() is not None
+
+    @classmethod
+    def replace(cls, session: DBClient.session, old: str | None, new: str):
+        if old is not None:
+            session.execute(delete(cls.__table__).where(cls.marker == old))
+        session.execute(pg_insert(cls.__table__).values(marker=new, saved_at=datetime.datetime.now()))
+        session.commit()
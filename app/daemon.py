@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import signal
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from app.up_sync import UpSync
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 300
+DEFAULT_ACCOUNTS_INTERVAL = 3600
+DEFAULT_JITTER = 0.1
+DEFAULT_SHUTDOWN_TIMEOUT = 30
+# the loop wakes at least this often to record a heartbeat, even when nothing is due
+HEARTBEAT_INTERVAL = 5
+# transactions are synced on every cycle, the slow moving streams only every accounts_interval
+FAST_STREAMS = ("transactions",)
+SLOW_STREAMS = ("accounts", "categories", "tags", "attachments")
+
+
+# Keeps one UpSync, with its HTTP session and DB pool, alive between incremental syncs instead of
+# paying interpreter startup, imports and TLS handshakes on every cron run. Transactions are synced
+# every interval and the other streams every accounts_interval, both jittered so a fleet of daemons
+# doesn't hit the API in lockstep. SIGTERM lets a running sync finish (or, past shutdown_timeout,
+# cancels it once its current batch is written) and then exits.
+class SyncDaemon:
+    def __init__(
+        self,
+        up_sync: UpSync,
+        interval: float = DEFAULT_INTERVAL,
+        accounts_interval: float = DEFAULT_ACCOUNTS_INTERVAL,
+        jitter: float = DEFAULT_JITTER,
+        shutdown_timeout: float = DEFAULT_SHUTDOWN_TIMEOUT,
+        max_cycles: int = None,
+    ):
+        if not up_sync.client.sink.stateful:
+            raise ValueError("daemon mode needs the postgres sink")
+        self.up_sync = up_sync
+        self.client = up_sync.client
+        self.interval = interval
+        self.accounts_interval = accounts_interval
+        self.jitter = jitter
+        self.shutdown_timeout = shutdown_timeout
+        # for tests, stop after this many sync cycles
+        self.max_cycles = max_cycles
+        self.started_at = None
+        self.heartbeat = None
+        self.cycles = 0
+        # epoch seconds of each cadence's last successful sync and next scheduled one
+        self.last_sync = {"transactions": None, "accounts": None}
+        self.next_sync = {"transactions": 0.0, "accounts": 0.0}
+        self.last_error = None
+        self._stopping = None
+        self._cycle = None
+
+    def delay(self, interval: float) -> float:
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def beat(self):
+        self.heartbeat = time.time()
+        self.client.metrics.gauge("daemon_heartbeat_timestamp", self.heartbeat)
+
+    def status(self) -> dict:
+        # served on /healthz next to /metrics. Live while the loop keeps beating and transactions have
+        # synced within three intervals (or it's been under three intervals since starting)
+        now = time.time()
+        beating = self.heartbeat is not None and now - self.heartbeat < 3 * HEARTBEAT_INTERVAL
+        last = self.last_sync["transactions"] or self.started_at or now
+        healthy = beating and now - last < 3 * self.interval
+        return {
+            "status": "ok" if healthy else "unhealthy",
+            "started_at": self.started_at,
+            "heartbeat": self.heartbeat,
+            "cycles": self.cycles,
+            "last_sync": dict(self.last_sync),
+            "next_sync": dict(self.next_sync),
+            "last_error": self.last_error,
+            "stopping": bool(self._stopping and self._stopping.is_set()),
+        }
+
+    def stop(self):
+        if not self._stopping.is_set():
+            LOG.info("Stopping daemon once the running sync is done")
+            self._stopping.set()
+
+    async def run_cycle(self, now: float):
+        streams = list(FAST_STREAMS)
+        slow = now >= self.next_sync["accounts"]
+        if slow:
+            streams = [*SLOW_STREAMS, *streams]
+        try:
+            await self.up_sync.async_sync(streams)
+        except Exception as e:
+            LOG.error(f"Daemon sync of {', '.join(streams)} failed: {e!r}")
+            self.last_error = {"at": time.time(), "streams": streams, "error": repr(e)}
+            self.client.metrics.inc("daemon_sync_errors")
+        else:
+            finished = time.time()
+            self.last_sync["transactions"] = finished
+            self.client.metrics.gauge("last_sync_timestamp", finished, cadence="transactions")
+            if slow:
+                self.last_sync["accounts"] = finished
+                self.client.metrics.gauge("last_sync_timestamp", finished, cadence="accounts")
+        # scheduled from when the cycle finished so a slow sync never overlaps the next one. A failed
+        # cycle is retried on the normal cadence rather than straight away
+        if slow:
+            self.next_sync["accounts"] = time.time() + self.delay(self.accounts_interval)
+        self.next_sync["transactions"] = time.time() + self.delay(self.interval)
+        self.cycles += 1
+
+    async def _wait_for_cycle(self):
+        # SIGTERM arrived mid sync. It gets shutdown_timeout to finish, after which it's cancelled: a
+        # batch already handed to a writer thread still commits, and its checkpoint with it
+        done, _ = await asyncio.wait({self._cycle}, timeout=self.shutdown_timeout)
+        if not done:
+            LOG.warning(f"Sync still running after {self.shutdown_timeout}s, cancelling it")
+            self._cycle.cancel()
+            await asyncio.gather(self._cycle, return_exceptions=True)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # not the main thread (tests), stop() is called directly instead
+                pass
+        self.started_at = time.time()
+        self.client.metrics.health = self.status
+        LOG.info(f"Daemon syncing transactions every ~{self.interval}s, accounts every ~{self.accounts_interval}s")
+        try:
+            # held open for the daemon's lifetime so every sync reuses the warm HTTP connection pool
+            async with self.client:
+                while not self._stopping.is_set():
+                    self.beat()
+                    now = time.time()
+                    if now >= self.next_sync["transactions"]:
+                        self._cycle = asyncio.create_task(self.run_cycle(now))
+                        stopping = asyncio.create_task(self._stopping.wait())
+                        await asyncio.wait({self._cycle, stopping}, return_when=asyncio.FIRST_COMPLETED)
+                        stopping.cancel()
+                        if not self._cycle.done():
+                            await self._wait_for_cycle()
+                        self._cycle = None
+                        if self.max_cycles is not None and self.cycles >= self.max_cycles:
+                            break
+                        continue
+                    timeout = min(self.next_sync["transactions"] - now, HEARTBEAT_INTERVAL)
+                    try:
+                        await asyncio.wait_for(self._stopping.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self.client.metrics.health = None
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                try:
+                    loop.remove_signal_handler(sig)
+                except (NotImplementedError, RuntimeError):
+                    pass
+        LOG.info(f"Daemon stopped after {self.cycles} sync cycles")
+        return self.cycles
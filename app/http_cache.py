@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE_MB = 256
+
+
+def content_hash(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+# On disk cache of GET responses keyed by URL plus params, one body file per entry and an index
+# (validators, content hash and the page's next link) kept in LRU order and bounded by total body
+# size. Only touched from the thread doing the fetching, so there's no locking.
+#
+# The index is only written by save(), which the sync calls once every page has been written (serve mode
+# after every reconciliation and on shutdown). A run
+# that fails part way leaves the previous index behind, so pages it fetched but didn't store are
+# fetched and written again next time instead of being skipped as unchanged.
+#
+# The cache lives apart from the database it's skipping writes to, so the index carries a marker that's
+# also stored in that database when it's saved (see HttpCacheMarkers in app/clients.py). A sync that
+# doesn't find the marker, because the database was reset or restored from an older dump, clears the
+# cache and fetches everything again.
+class HttpCache:
+    INDEX = "index.json"
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_CACHE_SIZE_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.entries = OrderedDict()
+        self.marker = None
+        try:
+            with open(os.path.join(directory, self.INDEX)) as file:
+                index = json.load(file)
+            # indexes from before the marker are just the entries, and never match a database
+            if "entries" in index:
+                self.marker = index.get("marker")
+                index = index["entries"]
+            self.entries.update(index)
+        except (OSError, ValueError):
+            pass
+        self.size = sum(entry["size"] for entry in self.entries.values())
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url: str, params: dict = None) -> str:
+        if params:
+            url = f"{url}?{urlencode(sorted(params.items()))}"
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.body")
+
+    def get(self, key: str) -> dict | None:
+        entry = self.entries.get(key)
+        if entry is not None and not os.path.exists(self._path(key)):
+            self.discard(key)
+            return None
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def conditional_headers(self, entry: dict | None) -> dict:
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def body(self, key: str) -> bytes | None:
+        try:
+            with open(self._path(key), "rb") as file:
+                return file.read()
+        except OSError:
+            self.discard(key)
+            return None
+
+    def put(self, key: str, body: bytes, headers, digest: str, next_page: str = None):
+        self.discard(key)
+        with open(self._path(key), "wb") as file:
+            file.write(body)
+        self.entries[key] = {
+            "etag": (headers or {}).get("ETag"),
+            "last_modified": (headers or {}).get("Last-Modified"),
+            "hash": digest,
+            "next": next_page,
+            "size": len(body),
+        }
+        self.size += len(body)
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            self.discard(next(iter(self.entries)))
+
+    def refresh(self, key: str, headers):
+        # an unchanged body can still come with new validators worth sending next time
+        entry = self.entries[key]
+        entry["etag"] = (headers or {}).get("ETag") or entry["etag"]
+        entry["last_modified"] = (headers or {}).get("Last-Modified") or entry["last_modified"]
+
+    def discard(self, key: str):
+        if (entry := self.entries.pop(key, None)) is not None:
+            self.size -= entry["size"]
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        for key in list(self.entries):
+            self.discard(key)
+
+    def save(self, marker: str = None):
+        path = os.path.join(self.directory, self.INDEX)
+        with open(f"{path}.tmp", "w") as file:
+            json.dump({"marker": marker, "entries": self.entries}, file)
+        os.replace(f"{path}.tmp", path)
+        self.marker = marker
+
+    def stats(self) -> dict:
+        # hits came back 200 with the cached content hash, revalidated came back 304
+        total = self.hits + self.revalidated + self.misses
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.revalidated) / total, 3) if total else None,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
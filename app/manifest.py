@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+from dataclasses import dataclass
+
+# names end up as directories under --output-dir and --http-cache
+NAME = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+class ManifestError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class TokenSpec:
+    name: str
+    token: str
+
+    def __repr__(self) -> str:
+        # specs get logged and pickled over to pool workers, the token never belongs in a log line
+        return f"TokenSpec(name={self.name!r})"
+
+
+def load_manifest(path: str) -> list[TokenSpec]:
+    # {"tokens": [{"name": "alex", "token_env": "UP_TOKEN_ALEX"}, {"name": "sam", "token": "up:yeah:..."}]},
+    # token_env keeps the token itself out of the file
+    with open(path) as file:
+        manifest = json.load(file)
+    entries = manifest.get("tokens") if isinstance(manifest, dict) else manifest
+    if not entries:
+        raise ManifestError(f"{path} doesn't list any tokens")
+    specs = []
+    for i, entry in enumerate(entries):
+        name = entry.get("name") or f"token-{i}"
+        if not NAME.match(name):
+            raise ManifestError(f"Token name {name!r} can only contain letters, digits, '.', '_' and '-'")
+        if "token_env" in entry:
+            token = os.environ.get(entry["token_env"])
+            if not token:
+                raise ManifestError(f"{entry['token_env']} isn't set for token {name!r}")
+        elif entry.get("token"):
+            token = entry["token"]
+        else:
+            raise ManifestError(f"Token {name!r} needs a token or token_env")
+        specs.append(TokenSpec(name, token))
+    names = [spec.name for spec in specs]
+    if len(set(names)) != len(names):
+        raise ManifestError(f"Token names have to be unique, got {', '.join(names)}")
+    return specs
+
+
+def shards(specs: list[TokenSpec], count: int) -> list[list[TokenSpec]]:
+    # round robin, so households listed together don't all land in one process
+    return [shard for shard in (specs[i::count] for i in range(count)) if shard]
+
+
+def summarize(results: list[dict], elapsed: float) -> dict:
+    rows = sum(result["rows"] for result in results)
+    return {
+        "tokens": len(results),
+        "failed": [result["name"] for result in results if result["error"]],
+        "rows": rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(rows / elapsed) if elapsed else None,
+        "requests": sum(result["requests"]["requests"] for result in results),
+        "retries": sum(result["requests"]["retries"] for result in results),
+        "throttled": sum(result["requests"]["throttled"] for result in results),
+        "results": results,
+    }
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import bisect
+import contextlib
+import json
+import logging
+import re
+import threading
+import time
+from typing import TYPE_CHECKING
+from urllib.parse import urlsplit
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+# seconds, roughly doubling from 1ms to 30s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+ID_SEGMENT = re.compile(r"(?:(?<=/accounts/)|(?<=/transactions/))[^/?]+")
+
+
+def endpoint_label(url: str) -> str:
+    # "https://api.up.com.au/api/v1/accounts/abc/transactions?page..." -> "/accounts/{id}/transactions",
+    # ids would make every account its own series
+    path = re.sub(r"/+", "/", urlsplit(url).path)
+    path = re.sub(r"^/api/v\d+", "", path)
+    return ID_SEGMENT.sub("{id}", path) or "/"
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # one count per bucket plus the +Inf overflow
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q: float) -> float | None:
+        # interpolated within the bucket holding the q'th observation, like prometheus' histogram_quantile
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else min(self.min, self.buckets[0])
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                value = lower + (upper - lower) * (rank - seen) / count
+                return min(max(value, self.min), self.max)
+            seen += count
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "min": self.min,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+# Counters, gauges and histograms for a sync run, keyed by name and labels. Shared between the
+# event loop and the writer threads so every update takes the lock, they're all O(1).
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+        # () -> dict with a "status" of "ok" when live, served on /healthz by long running modes
+        self.health = None
+        self._server = None
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if (histogram := self.histograms.get(key)) is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter(self, name: str, **labels) -> float:
+        # summed over every label set that includes the given labels
+        items = labels.items()
+        return sum(
+            v for (n, series_labels), v in self.counters.items() if n == name and items <= dict(series_labels).items()
+        )
+
+    def histogram(self, name: str, **labels) -> Histogram | None:
+        return self.histograms.get(self._key(name, labels))
+
+    @staticmethod
+    def _series(name: str, labels: tuple) -> str:
+        if not labels:
+            return name
+        return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "started": self.started,
+                "counters": {self._series(*key): v for key, v in sorted(self.counters.items())},
+                "gauges": {self._series(*key): v for key, v in sorted(self.gauges.items())},
+                "histograms": {self._series(*key): h.summary() for key, h in sorted(self.histograms.items())},
+            }
+
+    def write_summary(self, path: str, **extra):
+        with open(path, "w") as file:
+            json.dump({**self.summary(), **extra}, file, indent=2, default=str)
+        LOG.info(f"Wrote run metrics to {path}")
+
+    def prometheus(self) -> str:
+        def series(name, labels, extra=()):
+            labels = (*labels, *extra)
+            if not labels:
+                return f"up_sync_{name}"
+            return f"up_sync_{name}{{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{series(name + '_total', labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{series(name, labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip([*histogram.buckets, "+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{series(name + '_bucket', labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{series(name + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{series(name + '_count', labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        # prometheus text format on /metrics, and /healthz when a health check is set, from a daemon
+        # thread so it never holds up exit
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/healthz" and (health := metrics.health) is not None:
+                    status = health()
+                    self.respond(200 if status["status"] == "ok" else 503, json.dumps(status), "application/json")
+                elif path == "/metrics":
+                    self.respond(200, metrics.prometheus(), "text/plain; version=0.0.4")
+                else:
+                    self.send_error(404)
+
+            def respond(self, code: int, text: str, content_type: str):
+                body = text.encode()
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        LOG.info(f"Serving metrics on http://{host}:{self._server.server_port}/metrics")
+        return self._server
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+@contextlib.contextmanager
+def profiled(path: str = None, limit: int = 50):
+    # cProfile only sees the thread it's enabled on, which is the event loop doing the fetching and
+    # parsing; time in the writer threads shows up as db_batch_seconds instead
+    if not path:
+        yield
+        return
+    import cProfile
+    import io
+    import pstats
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        report = io.StringIO()
+        pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(limit)
+        with open(f"{path}.txt", "w") as file:
+            file.write(report.getvalue())
+        LOG.info(f"Wrote profile to {path} ({path}.txt)")
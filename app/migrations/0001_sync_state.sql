@@ -0,0 +1,11 @@
+CREATE TABLE IF NOT EXISTS sync_state (
+    account_id VARCHAR(255),
+    stream VARCHAR(255),
+    watermark TIMESTAMP,
+    cursor VARCHAR(2048),
+    run_id VARCHAR(255),
+    started_at TIMESTAMP,
+    updated_at TIMESTAMP,
+    completed_at TIMESTAMP,
+    PRIMARY KEY (account_id, stream)
+);
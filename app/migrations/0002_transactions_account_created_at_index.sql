@@ -0,0 +1,3 @@
+-- serves the per account watermark (max/min created_at) as an index only scan,
+-- and account scoped date range queries from metabase
+CREATE INDEX IF NOT EXISTS transactions_account_id_created_at_idx ON transactions (account_id, created_at);
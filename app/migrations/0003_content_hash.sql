@@ -0,0 +1,4 @@
+-- hash of each row's synced values, so rows that haven't changed since the last sync can be
+-- dropped before they're written (see app/changes.py)
+ALTER TABLE accounts ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32);
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32);
@@ -0,0 +1,38 @@
+-- categories, tags and attachments streams, plus link tables for the category and tags
+-- relationships of each transaction (see app/streams.py)
+CREATE TABLE IF NOT EXISTS categories (
+    id VARCHAR(255) PRIMARY KEY,
+    name VARCHAR(255),
+    parent_id VARCHAR(255),
+    content_hash VARCHAR(32)
+);
+
+CREATE TABLE IF NOT EXISTS tags (
+    id VARCHAR(255) PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS attachments (
+    id VARCHAR(255) PRIMARY KEY,
+    transaction_id VARCHAR(255),
+    created_at TIMESTAMP,
+    file_url TEXT,
+    file_url_expires_at TIMESTAMP,
+    file_extension VARCHAR(255),
+    file_content_type VARCHAR(255),
+    content_hash VARCHAR(32)
+);
+CREATE INDEX IF NOT EXISTS attachments_transaction_id_idx ON attachments (transaction_id);
+
+CREATE TABLE IF NOT EXISTS transaction_categories (
+    transaction_id VARCHAR(255) PRIMARY KEY,
+    category_id VARCHAR(255),
+    parent_category_id VARCHAR(255)
+);
+CREATE INDEX IF NOT EXISTS transaction_categories_category_id_idx ON transaction_categories (category_id);
+
+CREATE TABLE IF NOT EXISTS transaction_tags (
+    transaction_id VARCHAR(255),
+    tag_id VARCHAR(255),
+    PRIMARY KEY (transaction_id, tag_id)
+);
+CREATE INDEX IF NOT EXISTS transaction_tags_tag_id_idx ON transaction_tags (tag_id);
@@ -0,0 +1,28 @@
+-- per account and day totals in integer cents, kept up to date by the transaction write path for the
+-- days each batch touches (see DailyAccountTotals in app/clients.py). Debits are stored as positive cents
+CREATE TABLE IF NOT EXISTS daily_account_totals (
+    account_id VARCHAR(255) NOT NULL,
+    day DATE NOT NULL,
+    debit_base BIGINT NOT NULL DEFAULT 0,
+    credit_base BIGINT NOT NULL DEFAULT 0,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (account_id, day)
+);
+
+-- transactions synced before the rollups existed
+INSERT INTO daily_account_totals (account_id, day, debit_base, credit_base, count)
+SELECT account_id, created_at::date, SUM(GREATEST(-value_base, 0)), SUM(GREATEST(value_base, 0)), COUNT(*)
+FROM transactions
+WHERE account_id IS NOT NULL AND created_at IS NOT NULL
+GROUP BY account_id, created_at::date
+ON CONFLICT (account_id, day) DO NOTHING;
+
+-- a month is at most 31 daily rows per account, cheap enough to aggregate on read
+CREATE OR REPLACE VIEW monthly_account_totals AS
+SELECT account_id,
+       date_trunc('month', day)::date AS month,
+       SUM(debit_base) AS debit_base,
+       SUM(credit_base) AS credit_base,
+       SUM(count) AS count
+FROM daily_account_totals
+GROUP BY account_id, date_trunc('month', day);
@@ -0,0 +1,7 @@
+-- the marker every HTTP cache index was last saved with (see HttpCache in app/http_cache.py). A cache whose
+-- marker isn't here was saved against another database, or this one before it was reset or restored
+-- from an older dump, and its unchanged pages can't be assumed to be stored
+CREATE TABLE IF NOT EXISTS http_cache_markers (
+    marker VARCHAR(255) PRIMARY KEY,
+    saved_at TIMESTAMP
+);
@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import glob
+import logging
+import os
+
+from sqlalchemy import text
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.dirname(__file__)
+# pg_advisory_xact_lock key, so two syncs starting together don't race on the same migration
+MIGRATIONS_LOCK = 0x75705F73796E63
+
+
+def migrations() -> list[tuple[str, str]]:
+    # "0002_some_change.sql" -> ("0002", path), applied in version order
+    paths = sorted(glob.glob(os.path.join(MIGRATIONS_DIR, "*.sql")))
+    return [(os.path.basename(path).split("_", 1)[0], path) for path in paths]
+
+
+def apply_migrations(engine) -> list[str]:
+    applied = []
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATIONS_LOCK})
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations (version VARCHAR(255) PRIMARY KEY, applied_at TIMESTAMP)"
+        ))
+        done = set(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+        for version, path in migrations():
+            if version in done:
+                continue
+            LOG.info(f"Applying migration {os.path.basename(path)}")
+            with open(path) as file:
+                conn.exec_driver_sql(file.read())
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, applied_at) VALUES (:version, now())"),
+                {"version": version},
+            )
+            applied.append(version)
+    return applied
+
+
+def explain(session, query) -> str:
+    statement = query.statement.compile(session.get_bind(), compile_kwargs={"literal_binds": True})
+    return "\n".join(session.execute(text(f"EXPLAIN {statement}")).scalars())
+
+
+def uses_index(session, query, index_name: str, index_only: bool = True) -> bool:
+    # seq scans are disabled for the check since tiny tables are always cheaper to scan, what we want to
+    # know is whether the planner can answer the query from the index at all
+    session.execute(text("SET LOCAL enable_seqscan = off"))
+    try:
+        plan = explain(session, query)
+    finally:
+        session.rollback()
+    LOG.info(plan)
+    scan = "Index Only Scan" if index_only else "Index"
+    return any(scan in line and index_name in line for line in plan.splitlines())
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import hashlib
+import json
+from typing import NamedTuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(body: bytes | str):
+    # orjson when it's installed, it decodes page bodies several times faster than the stdlib
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+# ingest side records, fields are in table column order so they can be written positionally (COPY)
+# or by name (INSERT). The ORM classes in clients are only needed for querying.
+class AccountRecord(NamedTuple):
+    id: str
+    type: str
+    display_name: str
+    account_type: str
+    ownership_type: str
+    balance: float
+    currency: str
+    value_str: str
+    value_base: int
+    created_at: str
+    content_hash: str
+
+
+class TransactionRecord(NamedTuple):
+    id: str
+    account_id: str
+    status: str
+    raw_text: str
+    description: str
+    message: str
+    categorizable: bool
+    currency: str
+    value_str: str
+    value_base: int
+    card_purchase_suffix: str
+    settled_at: str
+    created_at: str
+    content_hash: str
+
+
+class CategoryRecord(NamedTuple):
+    id: str
+    name: str
+    parent_id: str
+    content_hash: str
+
+
+class TagRecord(NamedTuple):
+    id: str
+
+
+class AttachmentRecord(NamedTuple):
+    id: str
+    transaction_id: str
+    created_at: str
+    file_url: str
+    file_url_expires_at: str
+    file_extension: str
+    file_content_type: str
+    content_hash: str
+
+
+# a transaction's relationships fanned out into the link tables
+class TransactionCategoryRecord(NamedTuple):
+    transaction_id: str
+    category_id: str
+    parent_category_id: str
+
+
+class TransactionTagRecord(NamedTuple):
+    transaction_id: str
+    tag_id: str
+
+
+def row_hash(values: tuple) -> str:
+    # identifies a row's synced values, repr is stable for the str/int/float/bool/None fields records hold
+    return hashlib.blake2b(repr(values).encode(), digest_size=16).hexdigest()
+
+
+def parse_account(account: dict) -> AccountRecord:
+    attributes = account.get("attributes") or {}
+    balance = attributes.get("balance") or {}
+    value = balance.get("value")
+    values = (
+        account.get("id"),
+        account.get("type"),
+        attributes.get("displayName"),
+        attributes.get("accountType"),
+        attributes.get("ownershipType"),
+        float(value) if value is not None else None,
+        balance.get("currencyCode"),
+        value,
+        balance.get("valueInBaseUnits"),
+        attributes.get("createdAt"),
+    )
+    return AccountRecord(*values, row_hash(values))
+
+
+def relationship_id(resource: dict, name: str) -> str | None:
+    # {"relationships": {"category": {"data": {"type": "categories", "id": "pizza"}}}} -> "pizza"
+    data = ((resource.get("relationships") or {}).get(name) or {}).get("data")
+    return data.get("id") if isinstance(data, dict) else None
+
+
+def relationship_ids(resource: dict, name: str) -> list[str]:
+    data = ((resource.get("relationships") or {}).get(name) or {}).get("data") or []
+    return [item["id"] for item in data if isinstance(item, dict) and item.get("id")]
+
+
+def parse_transaction(transaction: dict, account_id: str) -> TransactionRecord:
+    attributes = transaction.get("attributes") or {}
+    amount = attributes.get("amount") or {}
+    purchase_method = attributes.get("cardPurchaseMethod")
+    values = (
+        transaction.get("id"),
+        account_id,
+        attributes.get("status"),
+        attributes.get("rawText"),
+        attributes.get("description"),
+        attributes.get("message"),
+        attributes.get("isCategorizable"),
+        amount.get("currencyCode"),
+        amount.get("value"),
+        amount.get("valueInBaseUnits"),
+        purchase_method.get("cardNumberSuffix") if purchase_method else None,
+        attributes.get("settledAt"),
+        attributes.get("createdAt"),
+    )
+    # the category and tags live in link tables, but recategorising or tagging a transaction still has
+    # to count as a change so its links get rewritten
+    links = (
+        relationship_id(transaction, "category"),
+        relationship_id(transaction, "parentCategory"),
+        tuple(sorted(relationship_ids(transaction, "tags"))),
+    )
+    return TransactionRecord(*values, row_hash(values + links))
+
+
+def parse_transaction_links(transaction: dict) -> tuple[TransactionCategoryRecord | None, list[TransactionTagRecord]]:
+    id = transaction.get("id")
+    category = None
+    if (category_id := relationship_id(transaction, "category")) is not None:
+        category = TransactionCategoryRecord(id, category_id, relationship_id(transaction, "parentCategory"))
+    return category, [TransactionTagRecord(id, tag) for tag in relationship_ids(transaction, "tags")]
+
+
+def parse_category(category: dict) -> CategoryRecord:
+    values = (
+        category.get("id"),
+        (category.get("attributes") or {}).get("name"),
+        relationship_id(category, "parent"),
+    )
+    return CategoryRecord(*values, row_hash(values))
+
+
+def parse_tag(tag: dict) -> TagRecord:
+    return TagRecord(tag.get("id"))
+
+
+def parse_attachment(attachment: dict) -> AttachmentRecord:
+    attributes = attachment.get("attributes") or {}
+    values = (
+        attachment.get("id"),
+        relationship_id(attachment, "transaction"),
+        attributes.get("createdAt"),
+        attributes.get("fileURL"),
+        attributes.get("fileURLExpiresAt"),
+        attributes.get("fileExtension"),
+        attributes.get("fileContentType"),
+    )
+    # the file URL is presigned, a new expiry is a change so the stored URL gets refreshed before it expires
+    return AttachmentRecord(*values, row_hash(values[:3] + values[4:]))
+
+
+def parse_transactions(page: dict, account_id: str) -> list[TransactionRecord]:
+    return [parse_transaction(transaction, account_id) for transaction in page.get("data", [])]
+
+
+def parse_accounts(page: dict) -> list[AccountRecord]:
+    return [parse_account(account) for account in page.get("data", [])]
+
+
+def parse_transaction_page_links(page: dict, ids: set = None) -> dict[str, tuple]:
+    # transaction id -> (category link, tag links), for the given ids only when they're passed
+    return {
+        transaction.get("id"): parse_transaction_links(transaction)
+        for transaction in page.get("data", [])
+        if ids is None or transaction.get("id") in ids
+    }
+
+
+def parse_categories(page: dict) -> list[CategoryRecord]:
+    return [parse_category(category) for category in page.get("data", [])]
+
+
+def parse_tags(page: dict) -> list[TagRecord]:
+    return [parse_tag(tag) for tag in page.get("data", [])]
+
+
+def parse_attachments(page: dict) -> list[AttachmentRecord]:
+    return [parse_attachment(attachment) for attachment in page.get("data", [])]
@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+import datetime
+import logging
+import re
+import threading
+import time
+
+from sqlalchemy import text
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MIGRATION_BATCH_SIZE = 10_000
+# months past the current one given a partition up front by the migration, writes that land while the
+# mirror trigger is installed can't create partitions of their own
+DEFAULT_MONTHS_AHEAD = 3
+# pg_advisory_xact_lock key, so writers reaching a new month together don't race attaching its partition
+PARTITIONS_LOCK = 0x75705F70617274
+# "FOR VALUES FROM ('2024-06-01 00:00:00') TO (...)" -> "2024-06"
+BOUND = re.compile(r"FROM \('(\d{4}-\d{2})")
+PARTKEY = re.compile(r"^RANGE \((\w+)\)$")
+
+
+class PartitionError(Exception):
+    pass
+
+
+def month_of(value) -> str | None:
+    # "2024-06-06T07:20:59+10:00" or a datetime -> "2024-06", the date the timestamp column ends up storing
+    return None if value is None else str(value)[:7]
+
+
+def month_bounds(month: str) -> tuple[str, str]:
+    start = datetime.date.fromisoformat(f"{month}-01")
+    return start.isoformat(), (start + datetime.timedelta(days=32)).replace(day=1).isoformat()
+
+
+def partition_name(table: str, month: str) -> str:
+    return f"{table}_{month.replace('-', '_')}"
+
+
+def partitioned_tables(conn) -> dict[str, str]:
+    # table -> column of every table range partitioned on a single column
+    rows = conn.execute(text(
+        "SELECT c.relname, pg_get_partkeydef(c.oid) FROM pg_partitioned_table p "
+        "JOIN pg_class c ON c.oid = p.partrelid WHERE pg_table_is_visible(c.oid)"
+    ))
+    return {table: match.group(1) for table, key in rows if (match := PARTKEY.match(key))}
+
+
+def attached_months(conn, table: str) -> dict[str, str]:
+    # month -> name of the partition holding it
+    rows = conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = CAST(:table AS regclass)"
+    ), {"table": table})
+    return {match.group(1): name for name, bound in rows if (match := BOUND.search(bound))}
+
+
+def columns(conn, table: str) -> list[str]:
+    return list(conn.execute(text(
+        "SELECT attname FROM pg_attribute WHERE attrelid = CAST(:table AS regclass) AND attnum > 0 "
+        "AND NOT attisdropped ORDER BY attnum"
+    ), {"table": table}).scalars())
+
+
+class MonthlyPartitions:
+    # the monthly partitions of a table range partitioned on column, attached as writes reach new months
+    def __init__(self, engine, table: str, column: str = "created_at"):
+        self.engine = engine
+        self.table = table
+        self.column = column
+        self.lock = threading.Lock()
+        # months with a partition, loaded on first use
+        self.months = None
+
+    def conflict_key(self, key: list[str]) -> list[str]:
+        # a partitioned table's primary key has to include the partition column, upserts conflict on both
+        return key if self.column in key else [*key, self.column]
+
+    def ensure(self, rows: list) -> list[str]:
+        # rows are dicts or app.parsing records, returns the months that had to be created
+        values = (row[self.column] if isinstance(row, dict) else getattr(row, self.column) for row in rows)
+        months = set(map(month_of, values)) - {None}
+        with self.lock:
+            if self.months is None:
+                with self.engine.connect() as conn:
+                    self.months = set(attached_months(conn, self.table))
+            missing = sorted(months - self.months)
+            for month in missing:
+                self.create(month)
+                self.months.add(month)
+        return missing
+
+    def create(self, month: str):
+        name = partition_name(self.table, month)
+        start, end = month_bounds(month)
+        with self.engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": PARTITIONS_LOCK})
+            if month in attached_months(conn, self.table):
+                # another writer got there first
+                return
+            # created on its own and then attached, as ATTACH PARTITION only takes a SHARE UPDATE EXCLUSIVE lock
+            # on the parent. CREATE TABLE ... PARTITION OF would queue behind every open transaction reading it
+            conn.exec_driver_sql(f"CREATE TABLE {name} (LIKE {self.table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+            conn.exec_driver_sql(
+                f"ALTER TABLE {self.table} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')"
+            )
+        LOG.info(f"Created partition {name} of {self.table} for {month}")
+
+
+def create_partitioned_table(conn, name: str, source: str, foreign_keys: bool = True):
+    # source's columns, range partitioned by month on created_at. The BRIN index is a few pages per partition
+    # and serves date range scans, as rows arrive roughly in created_at order. The btree keeps the per
+    # account watermark lookups and account scoped ranges index only
+    fk = ", CONSTRAINT fk_accounts FOREIGN KEY (account_id) REFERENCES accounts(id)" if foreign_keys else ""
+    conn.exec_driver_sql(
+        f"CREATE TABLE {name} (LIKE {source} INCLUDING DEFAULTS, PRIMARY KEY (id, created_at){fk}) "
+        "PARTITION BY RANGE (created_at)"
+    )
+    conn.exec_driver_sql(f"CREATE INDEX {name}_account_id_created_at_idx ON {name} (account_id, created_at)")
+    conn.exec_driver_sql(f"CREATE INDEX {name}_created_at_brin ON {name} USING brin (created_at)")
+
+
+def stored_months(conn, table: str) -> list[str]:
+    return [month_of(month) for month in conn.execute(text(
+        f"SELECT DISTINCT date_trunc('month', created_at) FROM {table} WHERE created_at IS NOT NULL"
+    )).scalars()]
+
+
+def upcoming_months(months_ahead: int) -> list[str]:
+    month = datetime.date.today().replace(day=1)
+    months = []
+    for _ in range(months_ahead + 1):
+        months.append(month.isoformat()[:7])
+        month = (month + datetime.timedelta(days=32)).replace(day=1)
+    return months
+
+
+def copy_rows(engine, source: str, target: str, batch_size: int) -> int:
+    # in id order, each batch its own transaction so syncs keep writing to source in between. Rows the mirror
+    # trigger already wrote are newer than the batch's snapshot and win
+    copied, last = 0, ""
+    while True:
+        with engine.begin() as conn:
+            count, last_id = conn.execute(text(
+                f"WITH batch AS (SELECT * FROM {source} WHERE id > :last ORDER BY id LIMIT :limit), "
+                f"copied AS (INSERT INTO {target} SELECT * FROM batch ON CONFLICT DO NOTHING) "
+                "SELECT count(*), max(id) FROM batch"
+            ), {"last": last, "limit": batch_size}).one()
+        if not count:
+            return copied
+        copied += count
+        last = last_id
+        LOG.info(f"Copied {copied} rows into {target}")
+
+
+def install_mirror(conn, source: str, target: str):
+    # keeps target in step with writes to source while it's being backfilled. An update deletes the old version
+    # first in case created_at (and with it the partition) changed
+    names = columns(conn, source)
+    updates = ", ".join(f"{name} = EXCLUDED.{name}" for name in names if name not in ("id", "created_at"))
+    conn.exec_driver_sql(f"""
+        CREATE OR REPLACE FUNCTION {source}_partition_mirror() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM {target} WHERE id = OLD.id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO {target} SELECT NEW.* ON CONFLICT (id, created_at) DO UPDATE SET {updates};
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {source}_partition_mirror ON {source}")
+    conn.exec_driver_sql(
+        f"CREATE TRIGGER {source}_partition_mirror AFTER INSERT OR UPDATE OR DELETE ON {source} "
+        f"FOR EACH ROW EXECUTE FUNCTION {source}_partition_mirror()"
+    )
+
+
+def partition_transactions(
+    engine, batch_size: int = DEFAULT_MIGRATION_BATCH_SIZE, months_ahead: int = DEFAULT_MONTHS_AHEAD
+) -> int:
+    # Moves transactions onto a month partitioned table while syncs keep running against it: the new table is
+    # filled in batches with a trigger mirroring concurrent writes, then the two are swapped by renaming them
+    # under a brief ACCESS EXCLUSIVE lock. The old table is kept as transactions_unpartitioned until dropped by
+    # hand. Opt in, it isn't one of the numbered migrations applied at startup. Returns the rows copied
+    target = "transactions_partitioned"
+    with engine.begin() as conn:
+        if "transactions" in partitioned_tables(conn):
+            LOG.info("transactions is already partitioned")
+            return 0
+        nulls = conn.execute(text("SELECT count(*) FROM transactions WHERE created_at IS NULL")).scalar()
+        if nulls:
+            raise PartitionError(f"{nulls} transactions have no created_at, which can't be partitioned")
+        # left over from an interrupted run
+        conn.execute(text("DROP TRIGGER IF EXISTS transactions_partition_mirror ON transactions"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {target}"))
+        create_partitioned_table(conn, target, "transactions")
+        months = sorted(set(stored_months(conn, "transactions")) | set(upcoming_months(months_ahead)))
+    partitions = MonthlyPartitions(engine, target)
+    for month in months:
+        partitions.create(month)
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        install_mirror(conn, "transactions", target)
+    copied = copy_rows(engine, "transactions", target, batch_size)
+    with engine.begin() as conn:
+        # rows deleted while the batch holding them was being copied
+        conn.execute(text(
+            f"DELETE FROM {target} p WHERE NOT EXISTS (SELECT 1 FROM transactions t WHERE t.id = p.id)"
+        ))
+    with engine.begin() as conn:
+        conn.execute(text(f"ANALYZE {target}"))
+    with engine.begin() as conn:
+        conn.execute(text("LOCK TABLE transactions IN ACCESS EXCLUSIVE MODE"))
+        conn.execute(text("DROP TRIGGER transactions_partition_mirror ON transactions"))
+        conn.execute(text("DROP FUNCTION transactions_partition_mirror()"))
+        for statement in (
+            "ALTER TABLE transactions RENAME TO transactions_unpartitioned",
+            "ALTER TABLE transactions_unpartitioned "
+            "RENAME CONSTRAINT transactions_pkey TO transactions_unpartitioned_pkey",
+            # only a backup from here on, it mustn't stop accounts being deleted
+            "ALTER TABLE transactions_unpartitioned DROP CONSTRAINT IF EXISTS fk_accounts",
+            "ALTER INDEX IF EXISTS transactions_account_id_created_at_idx "
+            "RENAME TO transactions_unpartitioned_account_id_created_at_idx",
+            f"ALTER TABLE {target} RENAME TO transactions",
+            f"ALTER TABLE transactions RENAME CONSTRAINT {target}_pkey TO transactions_pkey",
+            f"ALTER INDEX {target}_account_id_created_at_idx RENAME TO transactions_account_id_created_at_idx",
+            f"ALTER INDEX {target}_created_at_brin RENAME TO transactions_created_at_brin",
+        ):
+            conn.exec_driver_sql(statement)
+        for month, name in attached_months(conn, "transactions").items():
+            conn.exec_driver_sql(f"ALTER TABLE {name} RENAME TO {partition_name('transactions', month)}")
+    LOG.info(
+        f"Moved {copied} transactions onto {len(months)} monthly partitions in {time.perf_counter() - start:.1f}s, "
+        "the old table is kept as transactions_unpartitioned"
+    )
+    return copied
@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import logging
+import random
+import time
+from typing import Awaitable, Callable
+
+import aiohttp
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_EXCEPTIONS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+DEFAULT_RATE_LIMIT = 10.0
+DEFAULT_MAX_RETRIES = 5
+
+# (status, headers, body) as returned by the send callables
+Response = tuple[int, dict, bytes]
+
+
+def blocking_retry_exceptions() -> tuple:
+    # requests is only imported once something actually makes a blocking request
+    import requests
+
+    return requests.ConnectionError, requests.Timeout
+
+
+def retry_after_seconds(headers) -> float | None:
+    value = (headers or {}).get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Shared by every request an UpClient makes. A token bucket caps the global request rate, an AIMD
+# window caps requests in flight (growing while responses are fast, halving on throttling) and
+# 429/5xx responses or connection errors are retried honouring Retry-After, else with jittered backoff.
+class RequestScheduler:
+    def __init__(
+        self,
+        rate: float = DEFAULT_RATE_LIMIT,
+        burst: int = None,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        min_concurrency: int = 1,
+        max_concurrency: int = 16,
+        initial_concurrency: int = 4,
+        target_latency: float = 1.0,
+    ):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.concurrency = initial_concurrency
+        self.target_latency = target_latency
+
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.successes = 0
+        self.in_flight = 0
+        self._condition = None
+        self._loop = None
+
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.throttle_seconds = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "throttle_seconds": round(self.throttle_seconds, 3),
+            "concurrency": self.concurrency,
+        }
+
+    def _reserve(self) -> float:
+        # takes a token (possibly on credit) and returns how long the caller has to wait for it
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = max(-self.tokens / self.rate if self.tokens < 0 else 0.0, self.paused_until - now)
+        self.requests += 1
+        self.throttle_seconds += wait
+        return wait
+
+    def _backoff(self, attempt: int, headers=None) -> float:
+        delay = retry_after_seconds(headers)
+        if delay is None:
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        else:
+            # Retry-After applies to the whole token, not just this request
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.retries += 1
+        self.throttle_seconds += delay
+        return delay
+
+    def _on_throttle(self):
+        self.throttled += 1
+        now = time.monotonic()
+        # a burst of concurrent 429s should only halve the window once
+        if now - self.last_decrease > self.target_latency:
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+            self.last_decrease = now
+            self.successes = 0
+
+    def _on_success(self, elapsed: float):
+        if elapsed > self.target_latency:
+            return
+        self.successes += 1
+        if self.successes >= self.concurrency:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.successes = 0
+
+    def _on_response(self, status: int, headers, elapsed: float, attempt: int) -> float | None:
+        # returns the delay before retrying, or None when the response should be handed back
+        if status in RETRY_STATUSES:
+            self._on_throttle()
+            if attempt < self.max_retries:
+                LOG.warning(f"Received {status}, retrying (attempt {attempt + 1} of {self.max_retries})")
+                return self._backoff(attempt, headers)
+            return None
+        if status < 400:
+            self._on_success(elapsed)
+        return None
+
+    def _on_error(self, error: Exception, attempt: int) -> float:
+        if attempt >= self.max_retries:
+            raise error
+        LOG.warning(f"Request failed with {error!r}, retrying (attempt {attempt + 1} of {self.max_retries})")
+        return self._backoff(attempt)
+
+    def request(self, send: Callable[[], Response]) -> Response:
+        attempt = 0
+        while True:
+            time.sleep(self._reserve())
+            start = time.monotonic()
+            try:
+                status, headers, body = send()
+            except blocking_retry_exceptions() as e:
+                delay = self._on_error(e, attempt)
+            else:
+                delay = self._on_response(status, headers, time.monotonic() - start, attempt)
+                if delay is None:
+                    return status, headers, body
+            attempt += 1
+            time.sleep(delay)
+
+    def _condition_for_loop(self) -> asyncio.Condition:
+        # clients outlive event loops (one asyncio.run per sync), so the condition is rebuilt per loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+            self.in_flight = 0
+        return self._condition
+
+    async def async_request(self, send: Callable[[], Awaitable[Response]]) -> Response:
+        condition = self._condition_for_loop()
+        attempt = 0
+        while True:
+            async with condition:
+                await condition.wait_for(lambda: self.in_flight < self.concurrency)
+                self.in_flight += 1
+            try:
+                await asyncio.sleep(self._reserve())
+                start = time.monotonic()
+                try:
+                    status, headers, body = await send()
+                except RETRY_EXCEPTIONS as e:
+                    delay = self._on_error(e, attempt)
+                else:
+                    delay = self._on_response(status, headers, time.monotonic() - start, attempt)
+                    if delay is None:
+                        return status, headers, body
+            finally:
+                async with condition:
+                    self.in_flight -= 1
+                    condition.notify_all()
+            attempt += 1
+            await asyncio.sleep(delay)
@@ -0,0 +1,350 @@
+from __future__ import annotations
+
+import contextlib
+import csv
+import gzip
+import io
+import logging
+import os
+import threading
+
+from sqlalchemy import Boolean, DateTime, Integer, Numeric, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import sessionmaker
+
+from app.partitions import MonthlyPartitions, partitioned_tables
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_DIR = "output"
+DEFAULT_ROW_GROUP_SIZE = 65_536
+# the UTC offset at the end of an API timestamp, e.g. +10:00 or Z
+OFFSET = r"(Z|[+-]\d\d:?\d\d)$"
+
+
+class BatchWriteError(Exception):
+    pass
+
+
+def columns(model) -> list[str]:
+    return [column.name for column in model.__table__.columns]
+
+
+def row_dict(row) -> dict:
+    # batches hold either dicts or the ingest records from app.parsing
+    return row if isinstance(row, dict) else row._asdict()
+
+
+def primary_key(model) -> list[str]:
+    return [column.name for column in model.__table__.primary_key.columns]
+
+
+def upsert_rows(session, model, rows: list[dict], statements: list = (), key: list[str] = None) -> int:
+    # one INSERT ... ON CONFLICT (primary key, or key) DO UPDATE per batch, later duplicates of a key win.
+    # statements (e.g. sync checkpoints) are committed in the same transaction as the rows
+    key = key or primary_key(model)
+    rows = list({tuple(row[name] for name in key): row for row in map(row_dict, rows)}.values())
+    if not rows and not statements:
+        return 0
+    try:
+        if rows:
+            stmt = pg_insert(model.__table__).values(rows)
+            set_ = {name: stmt.excluded[name] for name in rows[0] if name not in key}
+            # rows carrying a content hash only rewrite the stored row when it actually changed
+            where = None
+            if "content_hash" in rows[0]:
+                where = or_(
+                    stmt.excluded.content_hash.is_(None),
+                    model.__table__.c.content_hash.is_distinct_from(stmt.excluded.content_hash),
+                )
+            if set_:
+                stmt = stmt.on_conflict_do_update(index_elements=key, set_=set_, where=where)
+            else:
+                # nothing but the key (tags, link tables), an existing row is already up to date
+                stmt = stmt.on_conflict_do_nothing(index_elements=key)
+            session.execute(stmt)
+        for statement in statements:
+            session.execute(statement)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise BatchWriteError(f"Failed to write batch of {len(rows)} {model.__tablename__}: {e}") from e
+    return len(rows)
+
+
+def copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class CopyLoader:
+    # streams rows into a temp staging table with COPY FROM STDIN on a dedicated connection,
+    # so other batches committing on the shared session can't drop or roll back the staged rows
+    def __init__(self, session, model, key: list[str] = None, partitions: MonthlyPartitions = None):
+        self.model = model
+        self.table = model.__tablename__
+        self.staging = f"{self.table}_staging"
+        self.columns = [column.name for column in model.__table__.columns]
+        self.key = key or primary_key(model)
+        # a partitioned table gets the partitions for the staged rows before they're merged
+        self.partitions = partitions
+        self.rows = 0
+        self.connection = session.get_bind().raw_connection()
+        self.cursor = self.connection.cursor()
+        with self._guard():
+            self.cursor.execute(
+                f"CREATE TEMP TABLE {self.staging} (LIKE {self.table} INCLUDING DEFAULTS, _seq BIGSERIAL) "
+                "ON COMMIT DROP"
+            )
+
+    @contextlib.contextmanager
+    def _guard(self):
+        try:
+            yield
+        except Exception as e:
+            self.connection.rollback()
+            self.connection.close()
+            raise BatchWriteError(f"Failed to stage {self.rows} {self.table}: {e}") from e
+
+    def copy(self, rows: list[dict]) -> int:
+        buffer = io.StringIO()
+        for row in rows:
+            values = row if isinstance(row, tuple) else (row[name] for name in self.columns)
+            buffer.write("\t".join(map(copy_value, values)))
+            buffer.write("\n")
+        buffer.seek(0)
+        self.rows += len(rows)
+        with self._guard():
+            if self.partitions is not None:
+                self.partitions.ensure(rows)
+            self.cursor.copy_expert(f"COPY {self.staging} ({', '.join(self.columns)}) FROM STDIN", buffer)
+        return len(rows)
+
+    def merge(self, statements: list[str] = ()) -> int:
+        # statements run after the merge in its transaction, and can read the staging table
+        columns = ", ".join(self.columns)
+        key = ", ".join(self.key)
+        updates = ", ".join(f"{name} = EXCLUDED.{name}" for name in self.columns if name not in self.key)
+        if "content_hash" in self.columns:
+            updates += (
+                f" WHERE EXCLUDED.content_hash IS NULL"
+                f" OR {self.table}.content_hash IS DISTINCT FROM EXCLUDED.content_hash"
+            )
+        with self._guard():
+            self.cursor.execute(
+                f"INSERT INTO {self.table} ({columns}) "
+                f"SELECT DISTINCT ON ({key}) {columns} FROM {self.staging} ORDER BY {key}, _seq DESC "
+                f"ON CONFLICT ({key}) DO UPDATE SET {updates}"
+            )
+            merged = self.cursor.rowcount
+            for statement in statements:
+                self.cursor.execute(statement)
+            self.connection.commit()
+        self.connection.close()
+        return merged
+
+
+# Sinks receive batches of rows (dicts or app.parsing records) per model from the sync writers.
+# Only the Postgres sink is stateful, i.e. keeps sync_state checkpoints and can be read back from.
+class Sink:
+    name = None
+    stateful = False
+
+    def write(self, model, rows: list, statements: list = ()) -> int:
+        raise NotImplementedError
+
+    def copy_loader(self, model) -> CopyLoader | None:
+        # a loader for bulk backfills, None when the sink has nothing faster than write
+        return None
+
+    def close(self):
+        pass
+
+
+class PostgresSink(Sink):
+    name = "postgres"
+    stateful = True
+
+    def __init__(self, engine, session_per_batch: bool = False):
+        self.engine = engine
+        # bounded memory syncs write every batch in a session of its own, closed once it's committed so
+        # nothing the batch loaded outlives it. Otherwise there's one long lived session per writer thread
+        self.session_per_batch = session_per_batch
+        self._sessionmaker = sessionmaker(engine)
+        self._local = threading.local()
+        self._sessions = []
+        # table -> MonthlyPartitions of the range partitioned tables, looked up on the first write
+        self._partitions = None
+        self._partitions_lock = threading.Lock()
+
+    @property
+    def session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = self._sessionmaker()
+            self._sessions.append(self._local.session)
+        return self._local.session
+
+    def partitions(self, model) -> MonthlyPartitions | None:
+        with self._partitions_lock:
+            if self._partitions is None:
+                with self.engine.connect() as conn:
+                    self._partitions = {
+                        table: MonthlyPartitions(self.engine, table, column)
+                        for table, column in partitioned_tables(conn).items()
+                    }
+            return self._partitions.get(model.__tablename__)
+
+    def write(self, model, rows: list, statements: list = ()) -> int:
+        key = None
+        try:
+            if (partitions := self.partitions(model)) is not None:
+                partitions.ensure(rows)
+                key = partitions.conflict_key(primary_key(model))
+        except Exception as e:
+            raise BatchWriteError(f"Failed to create partitions for {model.__tablename__}: {e}") from e
+        try:
+            if self.session_per_batch:
+                with self._sessionmaker() as session:
+                    return upsert_rows(session, model, rows, statements, key)
+            return upsert_rows(self.session, model, rows, statements, key)
+        except BatchWriteError:
+            # looked up again next write, in case the table was partitioned while this sink was running
+            self._partitions = None
+            raise
+
+    def copy_loader(self, model) -> CopyLoader:
+        if (partitions := self.partitions(model)) is not None:
+            return CopyLoader(self.session, model, partitions.conflict_key(primary_key(model)), partitions)
+        return CopyLoader(self.session, model)
+
+    def close(self):
+        for session in self._sessions:
+            session.close()
+        self._sessions = []
+        self._local = threading.local()
+
+
+class FileSink(Sink):
+    # one file per table under output_dir, rewritten every run and shared by all writer threads
+    extension = None
+
+    def __init__(self, output_dir: str = DEFAULT_OUTPUT_DIR):
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+        self.writers = {}
+
+    def path(self, model) -> str:
+        return os.path.join(self.output_dir, f"{model.__tablename__}.{self.extension}")
+
+    def write(self, model, rows: list, statements: list = ()) -> int:
+        # statements are sync_state checkpoints, which only mean something to a stateful sink
+        if not rows:
+            return 0
+        try:
+            with self.lock:
+                if model not in self.writers:
+                    os.makedirs(self.output_dir, exist_ok=True)
+                    self.writers[model] = self._open(model)
+                self._write(self.writers[model], model, rows)
+        except Exception as e:
+            raise BatchWriteError(f"Failed to write batch of {len(rows)} {model.__tablename__}: {e}") from e
+        return len(rows)
+
+    def close(self):
+        with self.lock:
+            for model, writer in self.writers.items():
+                self._close(writer)
+                LOG.info(f"Wrote {self.path(model)}")
+            self.writers = {}
+
+    def _open(self, model):
+        raise NotImplementedError
+
+    def _write(self, writer, model, rows: list):
+        raise NotImplementedError
+
+    def _close(self, writer):
+        raise NotImplementedError
+
+
+class CsvSink(FileSink):
+    name = "csv"
+    extension = "csv.gz"
+
+    def _open(self, model):
+        file = gzip.open(self.path(model), "wt", newline="")
+        writer = csv.writer(file)
+        writer.writerow(columns(model))
+        return file, writer
+
+    def _write(self, writer, model, rows: list):
+        names = columns(model)
+        writer[1].writerows(row if isinstance(row, tuple) else [row[name] for name in names] for row in rows)
+
+    def _close(self, writer):
+        writer[0].close()
+
+
+class ParquetSink(FileSink):
+    # rows are buffered up to row_group_size and then written out as one row group,
+    # so memory stays flat however many rows go through
+    name = "parquet"
+    extension = "parquet"
+
+    def __init__(self, output_dir: str = DEFAULT_OUTPUT_DIR, row_group_size: int = DEFAULT_ROW_GROUP_SIZE):
+        try:
+            import pyarrow
+            import pyarrow.compute
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("The parquet sink needs pyarrow, pip install pyarrow") from e
+        super().__init__(output_dir)
+        self.pa = pyarrow
+        self.pc = pyarrow.compute
+        self.pq = pyarrow.parquet
+        self.row_group_size = row_group_size
+
+    def schema(self, model):
+        pa = self.pa
+        types = {Boolean: pa.bool_(), Integer: pa.int64(), Numeric: pa.float64(), DateTime: pa.timestamp("us")}
+
+        def arrow_type(column):
+            return next((t for sql_type, t in types.items() if isinstance(column.type, sql_type)), pa.string())
+
+        return pa.schema([(column.name, arrow_type(column)) for column in model.__table__.columns])
+
+    def _open(self, model):
+        schema = self.schema(model)
+        return {"schema": schema, "writer": self.pq.ParquetWriter(self.path(model), schema), "buffer": []}
+
+    def _write(self, writer, model, rows: list):
+        writer["buffer"].extend(rows)
+        while len(writer["buffer"]) >= self.row_group_size:
+            self._flush(writer, self.row_group_size)
+
+    def _flush(self, writer, size: int = None):
+        size = size or len(writer["buffer"])
+        rows, writer["buffer"] = writer["buffer"][:size], writer["buffer"][size:]
+        if not rows:
+            return
+        schema = writer["schema"]
+        arrays = []
+        for i, field in enumerate(schema):
+            values = [row[i] if isinstance(row, tuple) else row[field.name] for row in rows]
+            if self.pa.types.is_timestamp(field.type):
+                # ISO 8601 strings with offsets straight from the API. The offset is dropped and the local wall
+                # time kept, like postgres does storing them in a timestamp without time zone
+                local = self.pc.replace_substring_regex(self.pa.array(values, self.pa.string()), OFFSET, "")
+                arrays.append(local.cast(field.type))
+            else:
+                arrays.append(self.pa.array(values, field.type))
+        writer["writer"].write_table(self.pa.Table.from_arrays(arrays, schema=schema))
+
+    def _close(self, writer):
+        self._flush(writer)
+        writer["writer"].close()
+
+
+FILE_SINKS = {sink.name: sink for sink in (CsvSink, ParquetSink)}
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import asyncio
+import graphlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from app.archive import PageArchive
+from app.changes import ChangeIndex
+from app.clients import Accounts, Attachments, Categories, Tags, Transactions, UpClient
+from app.parsing import (
+    parse_accounts,
+    parse_attachments,
+    parse_categories,
+    parse_tags,
+    parse_transaction_page_links,
+    parse_transactions,
+)
+from app.sinks import BatchWriteError
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+
+# A stream declares where its rows come from, how a page is parsed, the table they're written to and
+# the streams that have to finish first. Streams without a sync of their own page through endpoint.
+@dataclass(frozen=True)
+class Stream:
+    name: str
+    endpoint: str
+    model: type
+    parse: Callable
+    depends_on: tuple[str, ...] = ()
+    # session -> {id: content_hash} of stored rows, for skipping unchanged ones
+    hashes: Callable = None
+    sync: Callable[[UpClient, Stream], Awaitable[int]] = None
+
+    class DependencyFailed(Exception):
+        pass
+
+
+async def sync_pages(client: UpClient, stream: Stream, on_rows: Callable = None, skip_unchanged: bool = None) -> int:
+    # fetching stays on the event loop, writes go to a thread of the stream's own so they don't block
+    # the streams running alongside it. Unchanged pages are skipped with a stateful sink unless told otherwise
+    if skip_unchanged is None:
+        skip_unchanged = client.sink.stateful
+    loop = asyncio.get_running_loop()
+    table = stream.model.__tablename__
+    changes = None
+    if stream.hashes is not None and client.detect_changes and client.sink.stateful:
+        changes = client.changes[table] = ChangeIndex(table, stream.hashes(client.session), client.metrics)
+    count = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        async for page in client.async_get_request(endpoint=stream.endpoint, skip_unchanged=skip_unchanged):
+            rows = stream.parse(page)
+            client.metrics.inc("rows_parsed", len(rows), stream=stream.name)
+            if on_rows is not None:
+                on_rows(rows)
+            if changes is not None:
+                rows = changes.filter(rows)
+            for start in range(0, len(rows), client.batch_size):
+                batch = rows[start:start + client.batch_size]
+                try:
+                    count += await loop.run_in_executor(executor, client.write, stream.model, batch)
+                except BatchWriteError as e:
+                    LOG.error(e)
+                    failed += len(batch)
+                    if changes is not None:
+                        changes.forget(row.id for row in batch)
+    LOG.info(f"Successfully synced {count} {stream.name}")
+    if failed:
+        LOG.error(f"Failed to sync {failed} {stream.name}")
+    return count
+
+
+async def sync_accounts(client: UpClient, stream: Stream) -> int:
+    # transactions are fetched for the accounts kept here. A manifest sync needs this token's own accounts
+    # so the page is always parsed, otherwise an unchanged page is skipped and transactions fall back to
+    # the stored accounts
+    skip_unchanged = client.sink.stateful and client.claimed is None
+    client.accounts = []
+    count = await sync_pages(client, stream, client.accounts.extend, skip_unchanged=skip_unchanged)
+    if skip_unchanged and not client.accounts:
+        client.accounts = None
+    return count
+
+
+async def sync_transactions(client: UpClient, stream: Stream) -> int:
+    return await Transactions.sync_transactions(client)
+
+
+STREAMS = {
+    stream.name: stream
+    for stream in (
+        Stream("accounts", "/accounts", Accounts, parse_accounts, hashes=Accounts.hash_index, sync=sync_accounts),
+        Stream("categories", "/categories", Categories, parse_categories, hashes=Categories.hash_index),
+        Stream("tags", "/tags", Tags, parse_tags, hashes=Tags.hash_index),
+        Stream(
+            "transactions",
+            "/accounts/{id}/transactions",
+            Transactions,
+            parse_transactions,
+            depends_on=("accounts",),
+            sync=sync_transactions,
+        ),
+        Stream(
+            "attachments",
+            "/attachments",
+            Attachments,
+            parse_attachments,
+            depends_on=("transactions",),
+            hashes=Attachments.hash_index,
+        ),
+    )
+}
+
+
+def plan(names: list[str] = None, with_dependencies: bool = False) -> list[Stream]:
+    # the selected streams in dependency order. Dependencies outside the selection are assumed to have
+    # been synced already, unless with_dependencies pulls them in too
+    names = list(STREAMS) if names is None else names
+    unknown = set(names) - set(STREAMS)
+    if unknown:
+        raise ValueError(f"Unknown streams: {', '.join(sorted(unknown))}, choose from {', '.join(STREAMS)}")
+    selected = set(names)
+    pending = list(names)
+    while with_dependencies and pending:
+        for dependency in STREAMS[pending.pop()].depends_on:
+            if dependency not in selected:
+                selected.add(dependency)
+                pending.append(dependency)
+    graph = graphlib.TopologicalSorter({name: STREAMS[name].depends_on for name in STREAMS})
+    return [STREAMS[name] for name in graph.static_order() if name in selected]
+
+
+async def run_streams(client: UpClient, streams: list[Stream]) -> dict[str, int]:
+    # every stream starts as soon as the streams it depends on are done, so independent ones (categories
+    # and tags alongside accounts) share the connection pool and request scheduler concurrently. A failed
+    # stream fails its dependents but the rest still run to completion
+    tasks = {}
+
+    async def run(stream: Stream) -> int:
+        for dependency in stream.depends_on:
+            if dependency in tasks:
+                try:
+                    await tasks[dependency]
+                except Exception as e:
+                    raise Stream.DependencyFailed(f"Skipped {stream.name}, {dependency} failed: {e!r}") from e
+        LOG.info(f"Syncing {stream.name}")
+        with client.metrics.timer("stream_seconds", stream=stream.name):
+            return await (stream.sync or sync_pages)(client, stream)
+
+    async with client:
+        for stream in streams:
+            tasks[stream.name] = asyncio.create_task(run(stream))
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+    errors = []
+    for name, result in zip(tasks, results):
+        if isinstance(result, Exception):
+            LOG.error(f"Failed to sync {name}: {result!r}")
+            errors.append(result)
+    if errors:
+        raise errors[0]
+    return dict(zip(tasks, results))
+
+
+def replay(
+    client: UpClient,
+    archive: PageArchive,
+    names: list[str] = None,
+    accounts: list[str] = None,
+    since: str = None,
+    until: str = None,
+) -> dict[str, int]:
+    # archived pages go through the same parsing and writes as fetched ones, stream by stream in dependency
+    # order and each stream's pages in the order they were fetched, so the latest copy of a row wins. Nothing
+    # is checkpointed, a replay doesn't move where the next sync picks up from
+    counts = {}
+    for stream in plan(names):
+        count = failed = pages = 0
+        for page in archive.pages_of(stream.name, accounts, since, until):
+            pages += 1
+            if stream.model is Transactions:
+                rows = parse_transactions(page.body, page.account_id)
+                links = parse_transaction_page_links(page.body)
+            else:
+                rows = stream.parse(page.body)
+            client.metrics.inc("rows_parsed", len(rows), stream=stream.name)
+            for start in range(0, len(rows), client.batch_size):
+                batch = rows[start:start + client.batch_size]
+                try:
+                    if stream.model is Transactions:
+                        count += Transactions.write_batch(client, batch, Transactions.batch_links(links, batch))
+                    else:
+                        count += client.write(stream.model, batch)
+                except BatchWriteError as e:
+                    LOG.error(e)
+                    failed += len(batch)
+        LOG.info(f"Replayed {count} {stream.name} from {pages} archived pages")
+        if failed:
+            LOG.error(f"Failed to replay {failed} {stream.name}")
+        counts[stream.name] = count
+    return counts
@@ -4,17 +4,31 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
 
 from sqlalchemy import MetaData, Table
+from sqlalchemy.orm import close_all_sessions
 
 from app.clients import Accounts, DBClient, Transactions
+from app.migrations import apply_migrations
 
 
 def delete_all_from_tables():
+    # sessions left idle in a transaction by earlier tests each hold one of the process' shared pool
+    # connections, and would block the deletes below
+    close_all_sessions()
     session = DBClient().session
+    apply_migrations(session.get_bind())
     accounts = Table('accounts', MetaData())
     transactions = Table('transactions', MetaData())
+    sync_state = Table('sync_state', MetaData())
+    for table in (
+        'daily_account_totals', 'transaction_tags', 'transaction_categories', 'attachments', 'tags', 'categories',
+        'http_cache_markers',
+    ):
+        session.execute(Table(table, MetaData()).delete())
+    session.execute(sync_state.delete())
     session.execute(transactions.delete())
     session.execute(accounts.delete())
     session.commit()
+    session.close()
 
 def setup_test_db():
     session = DBClient().session
@@ -0,0 +1,102 @@
+import datetime
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from app import up_sync
+from app.analytics import (
+    TransactionArrays,
+    period_starts,
+    period_totals,
+    reconcile,
+    report,
+    running_balances,
+)
+from app.bench import bench_analytics
+from app.clients import Accounts, DBClient, Transactions
+from app.test.helpers import delete_all_from_tables
+from app.test.test_rollups import record
+
+
+class TestVectorized:
+    def test_matches_the_per_row_loops(self):
+        args = bench_analytics.parse_args(["--rows", "3000", "--accounts", "5", "--days", "800", "--chunk-size", "700"])
+        for period in ("day", "week", "month", "year"):
+            args.period = period
+            assert bench_analytics.run(args)["agree"]
+
+    def test_rows_without_an_account_or_date_are_left_out(self):
+        data = TransactionArrays.from_chunks([
+            [("b", -100, 2_000_000), (None, 5, 1_000_000), ("a", None, 3_000_000)],
+            [],
+            [("a", 50, None), ("b", 300, 1_000_000)],
+        ])
+        assert data.account_ids == ["a", "b"]
+        assert data.account.tolist() == [0, 1, 1]
+        assert data.value_base.tolist() == [0, 300, -100]
+        assert running_balances(data).tolist() == [0, 300, 200]
+        assert len(TransactionArrays.from_chunks([])) == 0
+        assert period_totals(TransactionArrays.from_chunks([])).rows() == []
+
+    def test_weeks_start_on_monday(self):
+        days = np.array(["2024-06-02", "2024-06-03", "2024-06-09T23:59"], dtype="datetime64[us]")
+        assert period_starts(days, "week").astype(str).tolist() == ["2024-05-27", "2024-06-03", "2024-06-03"]
+        with pytest.raises(ValueError):
+            period_starts(days, "fortnight")
+
+
+class TestAnalytics:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+        self.session.add(Accounts(id="123", value_base=1000))
+        self.session.add(Accounts(id="456", balance=2.5))
+        self.session.commit()
+        Transactions.write_batch(up_sync.UpSync(os.environ["UP_TOKEN"]).client, [
+            record("t1", -500, "2024-05-31T23:59:59+10:00"),
+            record("t2", 2000, "2024-06-01T00:00:00+10:00"),
+            record("t3", -300, "2024-06-20T12:00:00+10:00"),
+        ], {})
+
+    def teardown_method(self):
+        self.session.rollback()
+        delete_all_from_tables()
+
+    def test_loads_in_chunks_and_reconciles(self):
+        data = TransactionArrays.load(self.session, chunk_size=1)
+        assert running_balances(data).tolist() == [-500, 1500, 1200]
+        assert [row["period"] for row in period_totals(data).rows()] == [
+            datetime.date(2024, 5, 1), datetime.date(2024, 6, 1)
+        ]
+        assert period_totals(data).rows()[1] == {
+            "account_id": "123",
+            "period": datetime.date(2024, 6, 1),
+            "debit_base": 300,
+            "credit_base": 2000,
+            "count": 2,
+            "closing_base": 1200,
+        }
+        assert reconcile(data, {"123": 1000, "456": 250}) == [
+            {"account_id": "123", "balance_base": 1000, "transactions_base": 1200, "count": 3, "drift_base": -200},
+            {"account_id": "456", "balance_base": 250, "transactions_base": 0, "count": 0, "drift_base": 250},
+        ]
+        assert len(TransactionArrays.load(self.session, since="2024-06-01")) == 2
+        assert len(TransactionArrays.load(self.session, account_id=["456"])) == 0
+
+    def test_report_mode_writes_json(self, tmp_path):
+        expected = report(self.session, "day")
+        assert [row["drift_base"] for row in expected["reconciliation"]] == [-200, 250]
+        output = tmp_path / "analytics.json"
+        up_sync.UpSync("").analytics("day", str(output))
+        with open(output) as file:
+            written = json.load(file)
+        assert written["transactions"] == 3
+        assert [row["period"] for row in written["periods"]] == ["2024-05-31", "2024-06-01", "2024-06-20"]
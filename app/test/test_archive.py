@@ -0,0 +1,138 @@
+import glob
+import gzip
+import json
+import os
+import sys
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from app import up_sync
+from app.archive import PageArchive
+from app.clients import Accounts, DailyAccountTotals, DBClient, SyncState, Transactions
+from app.http_cache import HttpCache
+from app.sinks import CsvSink
+from app.test.helpers import delete_all_from_tables
+
+BASE = "http://up.test/api/v1"
+
+
+def page(transactions: list[dict]) -> bytes:
+    # pretty printed, newlines in the raw body don't break the NDJSON lines
+    return json.dumps({"data": transactions, "links": {"prev": None, "next": None}}, indent=2).encode()
+
+
+def transaction(id: str, value_base: int) -> dict:
+    return {
+        "type": "transactions",
+        "id": id,
+        "attributes": {
+            "status": "SETTLED",
+            "rawText": None,
+            "description": "desc",
+            "message": None,
+            "isCategorizable": True,
+            "amount": {"currencyCode": "AUD", "value": str(value_base / 100), "valueInBaseUnits": value_base},
+            "cardPurchaseMethod": None,
+            "settledAt": "2024-06-06T07:20:59+10:00",
+            "createdAt": "2024-06-06T07:20:59+10:00",
+        },
+        "relationships": {},
+    }
+
+
+class TestPageArchive:
+    def test_segments_are_laid_out_by_stream_account_and_date(self, tmp_path):
+        archive = PageArchive(str(tmp_path), segment_size=1)
+        assert archive.append(f"{BASE}/accounts/a1/transactions?filter[since]=x", page([transaction("t1", 1)]))
+        assert archive.append(f"{BASE}/accounts/a1/transactions?page[after]=y", page([transaction("t2", 2)]))
+        assert archive.append(f"{BASE}/accounts", b'{"data": [], "links": {}}')
+        assert not archive.append(f"{BASE}/util/ping", b"{}")
+        archive.close()
+        # a segment per page at this size, each a valid gzip file of one line
+        segments = archive.segment_paths("transactions")
+        assert len(segments) == 2
+        assert segments[0].split(os.sep)[-4:-1][:2] == ["transactions", "a1"]
+        assert [page.body["data"][0]["id"] for page in archive.pages_of("transactions")] == ["t1", "t2"]
+        assert [page.account_id for page in archive.pages_of("transactions")] == ["a1", "a1"]
+        assert archive.segment_paths("transactions", accounts=["a2"]) == []
+        assert archive.segment_paths("transactions", since="2999-01-01") == []
+        assert len(archive.segment_paths("transactions", until="2999-01-01")) == 2
+        assert len(archive.segment_paths("accounts")) == 1
+
+    def test_truncated_segments_keep_the_pages_flushed(self, tmp_path):
+        archive = PageArchive(str(tmp_path))
+        for i in range(3):
+            archive.append(f"{BASE}/accounts/a1/transactions?page={i}", page([transaction(f"t{i}", i)]))
+        (segment,) = archive.segment_paths("transactions")
+        # a killed run never writes the gzip trailer
+        with open(segment, "rb") as file:
+            data = file.read()
+        with open(segment, "wb") as file:
+            file.write(data)
+        assert [page.body["data"][0]["id"] for page in archive.pages_of("transactions")] == ["t0", "t1", "t2"]
+        with open(segment, "wb") as file:
+            file.write(gzip.compress(b'{"url": "x", "fetched_at": "x", "account_id": "a1", "body": {}}\n')[:-8])
+        assert len(list(archive.pages_of("transactions"))) == 1
+
+
+class TestReplay:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+        self.mockserver_url = os.environ["MOCKSERVER_URL"]
+
+    def teardown_method(self):
+        os.environ["MOCKSERVER_URL"] = self.mockserver_url
+        delete_all_from_tables()
+
+    def test_sync_archives_pages_that_replay_without_the_api(self, tmp_path):
+        sync = up_sync.UpSync(os.environ["UP_TOKEN"], archive=PageArchive(str(tmp_path)))
+        sync.sync()
+        transactions = sorted(row["id"] for row in Transactions.all(self.session))
+        accounts = sorted(row["id"] for row in Accounts.all(self.session))
+        assert transactions
+        assert sync.client.metrics.counter("pages_archived", endpoint="/accounts") == 1
+        assert {os.path.basename(path) for path in glob.glob(str(tmp_path / "transactions" / "*"))} == set(accounts)
+
+        delete_all_from_tables()
+        # nothing listening there, a request would fail the replay
+        os.environ["MOCKSERVER_URL"] = "http://127.0.0.1:9"
+        counts = up_sync.UpSync("", archive=PageArchive(str(tmp_path))).replay()
+        # the overlapping date slices fetched some transactions twice
+        assert counts["transactions"] >= len(transactions)
+        assert sorted(row["id"] for row in Transactions.all(self.session)) == transactions
+        assert sorted(row["id"] for row in Accounts.all(self.session)) == accounts
+        assert DailyAccountTotals.check(self.session) == []
+        # replays don't checkpoint
+        assert self.session.query(SyncState).count() == 0
+        assert up_sync.UpSync("", archive=PageArchive(str(tmp_path))).replay(["transactions"], ["nope"]) == {
+            "transactions": 0
+        }
+
+    def test_later_pages_win_and_file_sinks_replay_too(self, tmp_path):
+        archive = PageArchive(str(tmp_path / "archive"))
+        archive.append(f"{BASE}/accounts", json.dumps({"data": [], "links": {}}).encode())
+        archive.append(f"{BASE}/accounts/a1/transactions", page([transaction("t1", -500)]))
+        archive.append(f"{BASE}/accounts/a1/transactions?page=2", page([transaction("t1", -450)]))
+        archive.close()
+        self.session.add(Accounts(id="a1"))
+        self.session.commit()
+        up_sync.UpSync("", archive=archive).replay(["transactions"])
+        assert [(row["id"], row["value_base"]) for row in Transactions.all(self.session)] == [("t1", -450)]
+        sink = CsvSink(str(tmp_path / "csv"))
+        assert up_sync.UpSync("", sink=sink, archive=archive).replay(["transactions"]) == {"transactions": 2}
+        assert os.path.exists(tmp_path / "csv" / "transactions.csv.gz")
+
+    def test_unchanged_pages_arent_archived_again(self, tmp_path):
+        def sync():
+            archive = PageArchive(str(tmp_path / "archive"))
+            cache = HttpCache(str(tmp_path / "cache"))
+            # a fixed lookback keeps the request URLs, and with them the cache keys, the same
+            up_sync.UpSync(os.environ["UP_TOKEN"], lookback=3, cache=cache, archive=archive).sync()
+            return archive.pages
+
+        assert sync() > 0
+        assert sync() == 0
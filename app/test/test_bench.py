@@ -0,0 +1,87 @@
+import argparse
+import json
+import os
+import sys
+import urllib.request
+
+import pytest
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from app import up_sync
+from app.bench import bench_startup, bench_sync
+from app.bench.fake_up_api import ATTACHMENT_EVERY, CATEGORIES, TAGS, FakeUpConfig, start_in_process
+from app.clients import DailyAccountTotals, DBClient, Transactions, UpClient
+from app.scheduler import RequestScheduler
+from app.test.helpers import delete_all_from_tables
+
+
+class TestFakeUpApi:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+        self.mockserver_url = os.environ.get("MOCKSERVER_URL")
+
+    def teardown_method(self):
+        os.environ["MOCKSERVER_URL"] = self.mockserver_url
+        delete_all_from_tables()
+
+    def test_full_sync_survives_paging_slices_and_errors(self):
+        config = FakeUpConfig(accounts=2, transactions=250, page_size=20, days=90, error_rate=0.1, seed=1)
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(config)
+        try:
+            scheduler = RequestScheduler(rate=1000, max_retries=10, backoff_base=0.01)
+            sync = up_sync.UpSync("bench_token", lookback=91, slice_days=30, scheduler=scheduler)
+            rows = sync.sync()
+        finally:
+            process.terminate()
+            process.join()
+        attachments = 2 * len(range(0, 250, ATTACHMENT_EVERY))
+        assert rows == 2 + 2 * 250 + len(CATEGORIES) + len(TAGS) + attachments
+        assert len(Transactions.all(self.session)) == 2 * 250
+        assert scheduler.retries > 0
+
+    def test_first_request_authenticates(self):
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(FakeUpConfig(accounts=2, transactions=10))
+
+        def requests():
+            with urllib.request.urlopen(f"{os.environ['MOCKSERVER_URL']}/_stats") as res:
+                return json.load(res)["requests"]
+
+        try:
+            sync = up_sync.UpSync("bench_token")
+            assert requests() == 0
+            sync.sync(["accounts", "categories", "tags"])
+            assert requests() == 3
+            assert sync.client.authenticated
+            # concurrent streams wait on the first request instead of each getting a 401
+            with pytest.raises(UpClient.UpAuthError):
+                up_sync.UpSync("bad_token").sync(["accounts", "categories", "tags"])
+            assert requests() == 4
+        finally:
+            process.terminate()
+            process.join()
+
+    def test_startup_bench(self, tmp_path):
+        args = argparse.Namespace(runs=1, sink="csv", output_dir=str(tmp_path), stream="tags", port=0)
+        result = bench_startup.run(args)
+        assert result["requests_per_run"] == 1
+        assert result["deferred_modules_imported"] == []
+        assert result["import_seconds"] > 0
+
+    def test_reset_leaves_only_real_rows(self):
+        config = FakeUpConfig(accounts=1, transactions=20, days=3)
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(config)
+        try:
+            up_sync.UpSync("bench_token", lookback=4, scheduler=RequestScheduler(rate=1000)).sync()
+        finally:
+            process.terminate()
+            process.join()
+        self.session.add(DailyAccountTotals(account_id="real", day="2024-06-06", debit_base=0, credit_base=0, count=0))
+        self.session.commit()
+        bench_sync.reset_bench_rows()
+        assert self.session.query(DailyAccountTotals.account_id).all() == [("real",)]
+        assert Transactions.all(self.session) == []
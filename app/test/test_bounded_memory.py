@@ -0,0 +1,110 @@
+import os
+import sys
+import threading
+import tracemalloc
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from sqlalchemy import text
+
+from app import up_sync
+from app.bench.fake_up_api import FakeUpConfig, start_in_process
+from app.clients import DBClient, Transactions
+from app.scheduler import RequestScheduler
+from app.test.helpers import delete_all_from_tables
+
+DAYS = 30
+
+
+def resync_peak(transactions: int, bounded_memory: bool, max_tracked_ids: int = 500) -> tuple[int, up_sync.UpSync]:
+    # peak traced memory of a resync over everything a first sync stored, with the lookback covering it all
+    process, os.environ["MOCKSERVER_URL"] = start_in_process(
+        FakeUpConfig(accounts=2, transactions=transactions, days=DAYS)
+    )
+    try:
+        up_sync.UpSync("bench_token", lookback=DAYS + 1, scheduler=RequestScheduler(rate=1000)).sync()
+        sync = up_sync.UpSync(
+            "bench_token", lookback=DAYS + 1, scheduler=RequestScheduler(rate=1000), bounded_memory=bounded_memory,
+            max_pages_in_flight=2 if bounded_memory else None,
+        )
+        if bounded_memory:
+            sync.client.max_tracked_ids = max_tracked_ids
+        tracemalloc.start()
+        try:
+            sync.sync()
+            return tracemalloc.get_traced_memory()[1], sync
+        finally:
+            tracemalloc.stop()
+    finally:
+        process.terminate()
+        process.join()
+        delete_all_from_tables()
+
+
+class TestBoundedMemory:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+        self.mockserver_url = os.environ.get("MOCKSERVER_URL")
+
+    def teardown_method(self):
+        os.environ["MOCKSERVER_URL"] = self.mockserver_url
+        delete_all_from_tables()
+        # the resyncs leave thousands of dead rows behind, which throw off the planner in later tests
+        with DBClient.engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM ANALYZE transactions"))
+
+    def test_peak_memory_stays_flat_as_the_window_grows(self):
+        small, _ = resync_peak(1000, bounded_memory=True)
+        large, sync = resync_peak(8000, bounded_memory=True)
+        unbounded, _ = resync_peak(8000, bounded_memory=False)
+        assert sync.client.changes["transactions"].stats() == {"inserted": 0, "updated": 0, "skipped": 16000}
+        assert len(sync.client.changes["transactions"]) <= 500
+        # 8x the rows in the window, the stored hashes are what an unbounded resync holds on to
+        assert large < small * 1.5
+        assert large < 10 * 1024 * 1024
+        assert unbounded > large * 1.5
+
+    def test_bounded_sync_writes_everything(self):
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(FakeUpConfig(accounts=2, transactions=300, days=3))
+        try:
+            sync = up_sync.UpSync(
+                "bench_token", lookback=4, scheduler=RequestScheduler(rate=1000), slice_days=1, bounded_memory=True,
+                max_pages_in_flight=1,
+            )
+            sync.client.max_tracked_ids = 10
+            sync.sync()
+        finally:
+            process.terminate()
+            process.join()
+        assert len(Transactions.all(self.session)) == 600
+        assert sync.client.changes["transactions"].stats()["inserted"] >= 600
+        # every slot taken was handed back
+        assert sync.client.page_slots._value == 1
+
+    def test_stored_hashes_are_looked_up_off_the_event_loop(self, monkeypatch):
+        threads = []
+        stored_hashes = Transactions.stored_hashes
+
+        def recording(cls, session, ids):
+            threads.append(threading.current_thread())
+            return stored_hashes(session, ids)
+
+        monkeypatch.setattr(Transactions, "stored_hashes", classmethod(recording))
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(FakeUpConfig(accounts=2, transactions=100, days=3))
+        try:
+            for _ in range(2):
+                sync = up_sync.UpSync(
+                    "bench_token", lookback=4, scheduler=RequestScheduler(rate=1000), bounded_memory=True
+                )
+                sync.sync()
+        finally:
+            process.terminate()
+            process.join()
+        assert sync.client.changes["transactions"].stats() == {"inserted": 0, "updated": 0, "skipped": 200}
+        # the event loop runs on the main thread
+        assert threads and threading.main_thread() not in threads
+        assert sync.client.lookups is None
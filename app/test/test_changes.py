@@ -0,0 +1,118 @@
+import os
+import sys
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from sqlalchemy import text
+
+from app import up_sync
+from app.bench.fake_up_api import FakeUpConfig, start_in_process
+from app.changes import ChangeIndex
+from app.clients import Accounts, DBClient, Transactions
+from app.parsing import TransactionRecord
+from app.test.helpers import delete_all_from_tables
+
+
+def record(id: str, status: str = "SETTLED", content_hash: str = "h") -> TransactionRecord:
+    return TransactionRecord(
+        id, "123", status, None, "desc", None, True, "AUD", "-1.00", -100, None, None,
+        "2024-06-06T07:20:59+00:00", content_hash,
+    )
+
+
+class TestChangeIndex:
+    def test_filter_classifies_rows(self):
+        changes = ChangeIndex("transactions", {"same": "h", "changed": "old", "unhashed": None})
+        rows = [record("same"), record("changed"), record("unhashed"), record("new"), record("new")]
+        assert [row.id for row in changes.filter(rows)] == ["changed", "unhashed", "new"]
+        assert changes.stats() == {"inserted": 1, "updated": 2, "skipped": 2}
+        assert changes.metrics.counter("rows_skipped", table="transactions") == 2
+        # a row that failed to write isn't skipped when it's fetched again
+        changes.forget(["new"])
+        assert changes.filter([record("new")]) == [record("new")]
+
+    def test_lookups_only_keep_the_most_recent_ids(self):
+        stored = {"same": "h", "changed": "old"}
+        looked_up = []
+
+        def lookup(ids):
+            looked_up.append(ids)
+            return {id: stored[id] for id in ids if id in stored}
+
+        changes = ChangeIndex("transactions", {}, lookup=lookup, max_size=2)
+        assert [row.id for row in changes.filter([record("same"), record("changed"), record("new")])] == [
+            "changed", "new"
+        ]
+        assert looked_up == [["same", "changed", "new"]]
+        assert list(changes.hashes) == ["changed", "new"]
+        # forgotten, so looked up again
+        assert changes.filter([record("new"), record("same")]) == []
+        assert looked_up[1:] == [["same"]]
+        assert changes.stats() == {"inserted": 1, "updated": 1, "skipped": 3}
+
+    def test_hashes_looked_up_by_the_caller(self):
+        changes = ChangeIndex("transactions", {}, lookup=lambda ids: 1 / 0)
+        assert changes.unknown([record("same"), record("new")]) == ["same", "new"]
+        assert changes.filter([record("new", content_hash="newer")], {}) == [record("new", content_hash="newer")]
+        # "new" was filtered while its lookup ran, the stored hash it comes back with is older
+        assert changes.filter([record("same"), record("new")], {"same": "h", "new": "old"}) == [record("new")]
+        assert changes.hashes == {"new": "h", "same": "h"}
+        assert ChangeIndex("transactions", {}).unknown([record("new")]) == []
+
+
+class TestChangeDetection:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+        self.session.add(Accounts(id="123"))
+        self.session.commit()
+
+    def teardown_method(self):
+        delete_all_from_tables()
+
+    def xmin(self, id: str) -> str:
+        return self.session.execute(text("SELECT xmin::text FROM transactions WHERE id = :id"), {"id": id}).scalar()
+
+    def test_upsert_leaves_unchanged_rows_alone(self):
+        Transactions.insert_batch(self.session, [record("t1"), record("t2", "HELD", "held")])
+        before = self.xmin("t1"), self.xmin("t2")
+        Transactions.insert_batch(self.session, [record("t1"), record("t2", "SETTLED", "settled")])
+        assert self.xmin("t1") == before[0]
+        assert self.xmin("t2") != before[1]
+        assert self.session.query(Transactions.status).filter(Transactions.id == "t2").scalar() == "SETTLED"
+
+
+class TestChangeDetectionSync:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+        self.mockserver_url = os.environ.get("MOCKSERVER_URL")
+
+    def teardown_method(self):
+        os.environ["MOCKSERVER_URL"] = self.mockserver_url
+        delete_all_from_tables()
+
+    def test_resync_skips_unchanged_rows(self):
+        config = FakeUpConfig(accounts=2, transactions=120, page_size=25, days=30)
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(config)
+        try:
+            first = up_sync.UpSync("bench_token", lookback=31)
+            first.sync()
+            second = up_sync.UpSync("bench_token", lookback=31)
+            second.sync()
+            full = up_sync.UpSync("bench_token", lookback=31, detect_changes=False)
+            full.sync()
+        finally:
+            process.terminate()
+            process.join()
+        assert first.client.changes["transactions"].stats() == {"inserted": 240, "updated": 0, "skipped": 0}
+        assert second.client.changes["transactions"].stats() == {"inserted": 0, "updated": 0, "skipped": 240}
+        assert second.client.changes["accounts"].stats()["skipped"] == 2
+        assert second.client.metrics.counter("rows_written") == 0
+        assert full.client.changes == {}
+        assert full.client.metrics.counter("rows_written", table="transactions") == 240
+        assert len(Transactions.all(self.session)) == 240
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from app import up_sync
+from app.bench.fake_up_api import FakeUpConfig, start_in_process
+from app.clients import Accounts, DBClient, Transactions
+from app.daemon import SyncDaemon
+from app.sinks import CsvSink
+from app.test.helpers import delete_all_from_tables
+
+UP_SYNC = os.path.join(os.path.dirname(__file__), "../up_sync.py")
+
+
+class TestSyncDaemon:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+        self.mockserver_url = os.environ.get("MOCKSERVER_URL")
+        self.process, os.environ["MOCKSERVER_URL"] = start_in_process(FakeUpConfig(accounts=2, transactions=20, days=1))
+
+    def teardown_method(self):
+        self.process.terminate()
+        self.process.join()
+        os.environ["MOCKSERVER_URL"] = self.mockserver_url
+        delete_all_from_tables()
+
+    def test_cycles_reuse_the_client_and_sync_accounts_less_often(self):
+        sync = up_sync.UpSync("bench_token")
+        daemon = SyncDaemon(sync, interval=0.05, accounts_interval=60, jitter=0, max_cycles=3)
+        sessions = set()
+        async_sync = sync.async_sync
+
+        async def record_session(streams):
+            sessions.add(id(sync.client.http_session))
+            return await async_sync(streams)
+
+        sync.async_sync = record_session
+        assert asyncio.run(daemon.run()) == 3
+        assert len(Transactions.all(self.session)) == 2 * 20
+        assert len(Accounts.all(self.session)) == 2
+        # one warm HTTP session for every cycle, accounts only fetched on the first
+        assert len(sessions) == 1
+        assert sync.client.metrics.counter("pages", endpoint="/accounts") == 1
+        assert sync.client.metrics.counter("pages", endpoint="/accounts/{id}/transactions") >= 3 * 2
+        assert daemon.last_sync["accounts"] <= daemon.last_sync["transactions"]
+        assert daemon.next_sync["accounts"] - daemon.last_sync["accounts"] > 50
+        assert daemon.status()["status"] == "ok"
+
+    def test_stop_waits_for_the_running_sync(self):
+        daemon = SyncDaemon(up_sync.UpSync("bench_token"), interval=60, jitter=0)
+
+        async def run():
+            task = asyncio.create_task(daemon.run())
+            while daemon._cycle is None:
+                await asyncio.sleep(0.001)
+            # mid sync, the cycle still finishes and the 60s wait for the next one is skipped
+            daemon.stop()
+            return await asyncio.wait_for(task, 10)
+
+        assert asyncio.run(run()) == 1
+        assert daemon.last_sync["transactions"] is not None
+        assert len(Transactions.all(self.session)) == 2 * 20
+
+    def test_status_goes_stale_and_is_served_on_healthz(self):
+        sync = up_sync.UpSync("bench_token")
+        daemon = SyncDaemon(sync, interval=1, jitter=0, max_cycles=1)
+        asyncio.run(daemon.run())
+        server = sync.client.metrics.serve(0, host="127.0.0.1")
+        url = f"http://127.0.0.1:{server.server_port}/healthz"
+        try:
+            # no health check outside of a running daemon
+            with pytest.raises(urllib.error.HTTPError):
+                urllib.request.urlopen(url)
+            sync.client.metrics.health = daemon.status
+            with urllib.request.urlopen(url) as res:
+                assert json.load(res)["last_sync"]["transactions"] == daemon.last_sync["transactions"]
+            daemon.last_sync["transactions"] -= 10
+            with pytest.raises(urllib.error.HTTPError) as e:
+                urllib.request.urlopen(url)
+            assert e.value.code == 503
+            assert json.load(e.value)["status"] == "unhealthy"
+        finally:
+            sync.client.metrics.stop()
+
+    def test_needs_postgres(self, tmp_path):
+        with pytest.raises(ValueError):
+            SyncDaemon(up_sync.UpSync("bench_token", sink=CsvSink(str(tmp_path))))
+
+    def test_sigterm_exits_cleanly(self):
+        process = subprocess.Popen(
+            [sys.executable, UP_SYNC, "daemon", "--interval", "0.1"],
+            env={**os.environ, "UP_TOKEN": "bench_token"},
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        try:
+            deadline = time.time() + 20
+            while len(Transactions.all(self.session)) < 2 * 20 and time.time() < deadline:
+                time.sleep(0.1)
+                self.session.rollback()
+            process.send_signal(signal.SIGTERM)
+            _, stderr = process.communicate(timeout=20)
+        finally:
+            process.kill()
+        assert process.returncode == 0
+        assert "Daemon stopped after" in stderr
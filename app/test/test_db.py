@@ -1,14 +1,22 @@
+import asyncio
 import os
 import sys
 import datetime
+import tracemalloc
 from unittest.mock import patch
 
+import pytest
+
 # makes it access the test db instead
 os.environ["env"] = "dev"
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
 
-from app.clients import Accounts, DBClient, Transactions, UpClient
+from sqlalchemy import text
+
+from app.clients import Accounts, DBClient, Transactions, UpClient, as_row
+from app.migrations import apply_migrations, uses_index
+from app.sinks import CopyLoader, CsvSink
 from app.test.helpers import delete_all_from_tables, setup_test_db
 
 
@@ -92,6 +100,40 @@ class TestDB:
         assert q.settled_at.__str__() == "2024-06-06 07:20:59"
         assert q.created_at.__str__() == "2024-06-06 07:20:59"
 
+    def test_insert_batch_upserts(self):
+        rows = [
+            as_row(Transactions(id="b1", account_id="123", status="HELD", created_at="2024-06-06T07:20:59+00:00")),
+            as_row(Transactions(id="b2", account_id="123", status="HELD", created_at="2024-06-06T07:20:59+00:00")),
+        ]
+        assert Transactions.insert_batch(self.session, rows) == 2
+        rows[0]["status"] = "SETTLED"
+        assert Transactions.insert_batch(self.session, rows) == 2
+        q = self.session.query(Transactions).filter(Transactions.id == "b1").first()
+        assert q.status == "SETTLED"
+
+    def test_insert_batch_failure_is_isolated(self):
+        rows = [
+            as_row(Transactions(id="b3", account_id="123", created_at="2024-06-06T07:20:59+00:00")),
+            as_row(Transactions(id="b4", account_id="missing", created_at="2024-06-06T07:20:59+00:00")),
+        ]
+        with pytest.raises(DBClient.BatchWriteError):
+            Transactions.insert_batch(self.session, rows)
+        assert self.session.query(Transactions).filter(Transactions.id == "b3").first() is None
+        assert Transactions.insert_batch(self.session, rows[:1]) == 1
+
+    def test_copy_loader_merges_staged_rows(self):
+        loader = CopyLoader(self.session, Transactions)
+        loader.copy([
+            as_row(Transactions(id="c1", account_id="123", status="HELD", message="tab\there")),
+            as_row(Transactions(id="c2", account_id="123", status="HELD", message=None)),
+        ])
+        loader.copy([as_row(Transactions(id="c1", account_id="123", status="SETTLED", message="tab\there"))])
+        assert loader.merge() == 2
+        q = self.session.query(Transactions).filter(Transactions.id == "c1").first()
+        assert q.status == "SETTLED"
+        assert q.message == "tab\there"
+        assert self.session.query(Transactions).filter(Transactions.id == "c2").first().message is None
+
 
 class TestTransactions:
     def test_max_transaction_date_for_account_no_transactions(self):
@@ -139,6 +181,11 @@ class TestTransactions:
             == "2022-01-01T00:00:00+00:00"
         )
 
+    def test_max_transaction_date_uses_index(self):
+        setup_test_db()
+        query = Transactions.max_transaction_date_query(self.session, "123")
+        assert uses_index(self.session, query, "transactions_account_id_created_at_idx")
+
     def test_determine_account_filter_since_param(self):
         "Use days ago if present"
         setup_test_db()
@@ -151,6 +198,16 @@ class TestTransactions:
             datetime.datetime.today() - datetime.timedelta(days=lookback)
         ).strftime("%Y-%m-%d")
 
+    def test_time_slices(self):
+        since = (datetime.datetime.now() - datetime.timedelta(days=100)).strftime(Transactions.DATETIME_FORMAT)
+        slices = Transactions.time_slices(since, slice_days=30, max_slices=10)
+        assert len(slices) == 4
+        assert slices[0][0] == since
+        assert slices[-1][1] is None
+        assert all(a[1] == b[0] for a, b in zip(slices, slices[1:]))
+        assert len(Transactions.time_slices(since, slice_days=30, max_slices=2)) == 2
+        assert Transactions.time_slices(since, slice_days=365, max_slices=10) == [(since, None)]
+
     def test_determine_account_filter_since_param_no_lookback(self):
         "Use days ago if present, else check the earliest date for the account"
         setup_test_db()
@@ -161,6 +218,95 @@ class TestTransactions:
         assert date_result == "2024-01-01T00:00:00+00:00"
 
 
+class TestStreaming:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+        self.session.add_all([Accounts(id="a1", created_at="2024-01-01"), Accounts(id="a2", created_at="2024-02-01")])
+        self.session.commit()
+
+    def teardown_method(self):
+        self.session.rollback()
+        delete_all_from_tables()
+
+    def fill(self, count: int):
+        # alternating accounts, a minute apart from 2024-01-01
+        self.session.execute(text(
+            "INSERT INTO transactions (id, account_id, status, description, value_base, created_at) "
+            "SELECT 'tx-' || lpad(i::text, 8, '0'), CASE WHEN mod(i, 2) = 0 THEN 'a1' ELSE 'a2' END, 'SETTLED', "
+            "repeat('x', 200), i, TIMESTAMP '2024-01-01' + make_interval(mins => i) FROM generate_series(1, :count) i"
+        ), {"count": count})
+        self.session.commit()
+
+    def test_chunks_projection_and_filters(self):
+        self.fill(10)
+        chunks = list(Transactions.stream(self.session, ["id", "value_base"], chunk_size=4))
+        assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+        assert sorted(row for chunk in chunks for row in chunk)[0] == ("tx-00000001", 1)
+        rows = [
+            row for chunk in Transactions.stream(
+                self.session, ["id"], account_id="a1", since="2024-01-01T00:03:00", until="2024-01-01T00:08:00",
+                as_dicts=True,
+            ) for row in chunk
+        ]
+        assert sorted(row["id"] for row in rows) == ["tx-00000004", "tx-00000006"]
+        assert len([row for chunk in Transactions.stream(self.session, account_id=["a1", "a2"]) for row in chunk]) == 10
+        assert [list(chunk) for chunk in Accounts.stream(self.session, ["id"], since="2024-01-15")] == [[("a2",)]]
+        assert {row["id"] for row in Accounts.all(self.session)} == {"a1", "a2"}
+        assert set(Transactions.all(self.session)[0]) == {column.name for column in Transactions.__table__.columns}
+        with pytest.raises(ValueError):
+            Transactions.stream(self.session, ["nope"])
+
+    def peak(self, scan) -> int:
+        tracemalloc.start()
+        try:
+            scan()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            self.session.rollback()
+
+    def test_full_scan_memory_doesnt_grow_with_the_table(self):
+        def stream():
+            for chunk in Transactions.stream(self.session, chunk_size=500):
+                assert len(chunk) <= 500
+
+        self.fill(2_000)
+        small = self.peak(stream)
+        delete_all_from_tables()
+        self.setup_method()
+        self.fill(20_000)
+        large = self.peak(stream)
+        loaded = self.peak(lambda: self.session.query(Transactions).all())
+        assert large < small * 1.5
+        assert loaded > large * 5
+
+
+class TestMigrations:
+    session = DBClient().session
+
+    def test_apply_migrations_is_idempotent(self):
+        apply_migrations(self.session.get_bind())
+        assert apply_migrations(self.session.get_bind()) == []
+
+
+class TestEngineRegistry:
+    def test_sessions_share_one_engine_per_pool_size(self):
+        engine = DBClient().session.get_bind()
+        assert DBClient().session.get_bind() is engine
+        assert DBClient.engine() is engine
+        small = DBClient(pool_size=2).session.get_bind()
+        assert small is not engine
+        assert small.pool.size() == 2
+
+    def test_client_only_opens_a_session_when_needed(self, tmp_path):
+        client = UpClient(os.environ["UP_TOKEN"], sink=CsvSink(str(tmp_path)))
+        assert client._session is None
+        assert client._requests_session is None
+        assert client.session.get_bind() is DBClient.engine()
+
+
 class TestUpClient:
     def test_authenticate(self):
         UpClient(os.environ["UP_TOKEN"], lookback=7).authenticate()
@@ -171,3 +317,18 @@ class TestUpClient:
         except UpClient.UpAuthError:
             return
         assert False
+
+    def test_async_requests_share_one_session(self):
+        client = UpClient(os.environ["UP_TOKEN"])
+
+        async def fetch():
+            async with client:
+                session = client.http_session
+                for _ in range(2):
+                    async for _ in client.async_get_request(endpoint="util/ping"):
+                        assert client.http_session is session
+                assert not session.closed
+            assert client.http_session is None
+            assert session.closed
+
+        asyncio.run(fetch())
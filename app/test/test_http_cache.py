@@ -0,0 +1,150 @@
+import glob
+import json
+import os
+import sys
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from app import up_sync
+from app.bench.fake_up_api import FakeUpConfig, start_in_process
+from app.clients import DBClient, HttpCacheMarkers, Transactions
+from app.http_cache import HttpCache, content_hash
+from app.sinks import CsvSink
+from app.test.helpers import delete_all_from_tables
+
+
+class TestHttpCache:
+    def test_key_includes_params(self):
+        assert HttpCache.key("http://up/accounts") != HttpCache.key("http://up/accounts", {"page[size]": 10})
+        assert HttpCache.key("http://up/a", {"x": 1, "y": 2}) == HttpCache.key("http://up/a", {"y": 2, "x": 1})
+
+    def test_put_get_and_persist(self, tmp_path):
+        cache = HttpCache(str(tmp_path))
+        body = b'{"data": []}'
+        cache.put("a", body, {"ETag": '"v1"'}, content_hash(body), "http://up/next")
+        assert cache.body("a") == body
+        assert cache.conditional_headers(cache.get("a")) == {"If-None-Match": '"v1"'}
+        cache.save()
+        reloaded = HttpCache(str(tmp_path))
+        assert reloaded.get("a")["next"] == "http://up/next"
+        assert reloaded.size == len(body)
+        assert reloaded.marker is None
+        cache.save("m1")
+        assert HttpCache(str(tmp_path)).marker == "m1"
+
+    def test_indexes_without_a_marker_still_load(self, tmp_path):
+        with open(tmp_path / HttpCache.INDEX, "w") as file:
+            json.dump({"a": {"etag": None, "last_modified": None, "hash": "h", "next": None, "size": 2}}, file)
+        (tmp_path / "a.body").write_bytes(b"{}")
+        cache = HttpCache(str(tmp_path))
+        assert cache.marker is None
+        assert cache.get("a")["hash"] == "h"
+
+    def test_lru_eviction(self, tmp_path):
+        cache = HttpCache(str(tmp_path), max_bytes=25)
+        for key in "abc":
+            cache.put(key, b"x" * 10, {}, key)
+            # touching "a" keeps it as the most recently used
+            cache.get("a")
+        assert set(cache.entries) == {"a", "c"}
+        assert cache.size == 20
+        assert not os.path.exists(os.path.join(str(tmp_path), "b.body"))
+
+
+class TestCachedSync:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+        self.mockserver_url = os.environ.get("MOCKSERVER_URL")
+
+    def teardown_method(self):
+        os.environ["MOCKSERVER_URL"] = self.mockserver_url
+        delete_all_from_tables()
+
+    def sync(self, cache_dir: str) -> up_sync.UpSync:
+        sync = up_sync.UpSync("bench_token", lookback=31, cache=HttpCache(cache_dir))
+        sync.sync()
+        return sync
+
+    def test_unchanged_pages_skip_parsing_and_writes(self, tmp_path):
+        config = FakeUpConfig(accounts=2, transactions=120, page_size=25, days=30, etags=True)
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(config)
+        try:
+            first = self.sync(str(tmp_path))
+            second = self.sync(str(tmp_path))
+        finally:
+            process.terminate()
+            process.join()
+        assert first.client.cache.stats()["misses"] > 0
+        assert first.client.metrics.counter("rows_written", table="transactions") == 240
+        stats = second.client.cache.stats()
+        assert stats["misses"] == 0
+        assert stats["revalidated"] == first.client.cache.stats()["misses"]
+        assert second.client.metrics.counter("rows_parsed") == 0
+        assert second.client.metrics.counter("rows_written") == 0
+        assert len(Transactions.all(self.session)) == 240
+
+    def test_missing_bodies_are_fetched_again(self, tmp_path):
+        config = FakeUpConfig(accounts=2, transactions=60, page_size=25, days=30, etags=True)
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(config)
+
+        def sync(cache: HttpCache) -> up_sync.UpSync:
+            # file sinks parse unchanged pages, a 304 is answered from the cached body
+            sync = up_sync.UpSync("bench_token", lookback=31, sink=CsvSink(str(tmp_path / "csv")), cache=cache)
+            sync.sync()
+            return sync
+
+        cache_dir = str(tmp_path / "cache")
+        try:
+            first = sync(HttpCache(cache_dir))
+            os.remove(sorted(glob.glob(os.path.join(cache_dir, "*.body")))[0])
+            second = sync(HttpCache(cache_dir))
+            # gone after the validators were sent, before the 304 came back
+            cache = HttpCache(cache_dir)
+            get = cache.get
+
+            def get_then_delete(key: str) -> dict | None:
+                if (entry := get(key)) is not None:
+                    os.remove(cache._path(key))
+                return entry
+
+            cache.get = get_then_delete
+            third = sync(cache)
+        finally:
+            process.terminate()
+            process.join()
+        pages = first.client.cache.stats()["misses"]
+        assert second.client.cache.stats()["misses"] == 1
+        assert second.client.cache.stats()["revalidated"] == pages - 1
+        assert third.client.cache.stats()["misses"] == pages
+        assert third.client.cache.stats()["revalidated"] == 0
+        parsed = first.client.metrics.counter("rows_parsed")
+        assert second.client.metrics.counter("rows_parsed") == parsed
+        assert third.client.metrics.counter("rows_parsed") == parsed
+
+    def test_a_reset_or_restored_database_clears_the_cache(self, tmp_path):
+        config = FakeUpConfig(accounts=2, transactions=120, page_size=25, days=30, etags=True)
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(config)
+        try:
+            self.sync(str(tmp_path))
+            delete_all_from_tables()
+            reset = self.sync(str(tmp_path))
+            marker = reset.client.cache.marker
+            self.sync(str(tmp_path))
+            # back to a dump taken before the last save, which only knows the older marker
+            delete_all_from_tables()
+            self.session.add(HttpCacheMarkers(marker=marker))
+            self.session.commit()
+            restored = self.sync(str(tmp_path))
+            unchanged = self.sync(str(tmp_path))
+        finally:
+            process.terminate()
+            process.join()
+        for sync in (reset, restored):
+            assert sync.client.metrics.counter("rows_written", table="transactions") == 240
+            assert sync.client.cache.stats()["revalidated"] == 0
+        assert unchanged.client.metrics.counter("rows_written") == 0
+        assert len(Transactions.all(self.session)) == 240
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from app import up_sync
+from app.bench.fake_up_api import FakeUpConfig, start_in_process
+from app.clients import Accounts, AccountSync, DBClient, Transactions, UpClient
+from app.manifest import ManifestError, TokenSpec, load_manifest, shards, summarize
+from app.test.helpers import delete_all_from_tables
+
+
+def write_manifest(tmp_path, manifest) -> str:
+    path = tmp_path / "tokens.json"
+    path.write_text(json.dumps(manifest))
+    return str(path)
+
+
+def result(name: str, rows: int, error: str = None) -> dict:
+    return {"name": name, "rows": rows, "error": error, "requests": {"requests": 3, "retries": 1, "throttled": 0}}
+
+
+class TestLoadManifest:
+    def test_tokens_from_env_and_inline(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("UP_TOKEN_ALEX", "up:yeah:alex")
+        tokens = [{"name": "alex", "token_env": "UP_TOKEN_ALEX"}, {"name": "sam", "token": "up:yeah:sam"}]
+        path = write_manifest(tmp_path, {"tokens": tokens})
+        assert load_manifest(path) == [TokenSpec("alex", "up:yeah:alex"), TokenSpec("sam", "up:yeah:sam")]
+        assert "up:yeah" not in repr(load_manifest(path))
+
+    def test_bare_list_names_missing_entries(self, tmp_path):
+        assert load_manifest(write_manifest(tmp_path, [{"token": "a"}, {"token": "b"}])) == [
+            TokenSpec("token-0", "a"), TokenSpec("token-1", "b")
+        ]
+
+    @pytest.mark.parametrize("manifest", [
+        {"tokens": []},
+        [{"name": "alex"}],
+        [{"name": "alex", "token_env": "UP_TOKEN_UNSET"}],
+        [{"name": "alex", "token": "a"}, {"name": "alex", "token": "b"}],
+        [{"name": "../alex", "token": "a"}],
+    ])
+    def test_invalid_manifests(self, tmp_path, manifest):
+        with pytest.raises(ManifestError):
+            load_manifest(write_manifest(tmp_path, manifest))
+
+
+class TestSummary:
+    def test_shards_round_robin(self):
+        specs = [TokenSpec(str(i), "token") for i in range(5)]
+        assert [[spec.name for spec in shard] for shard in shards(specs, 2)] == [["0", "2", "4"], ["1", "3"]]
+        assert len(shards(specs[:1], 4)) == 1
+
+    def test_summarize(self):
+        summary = summarize([result("alex", 10), result("sam", 0, "UpAuthError()")], 2)
+        assert summary["tokens"] == 2
+        assert summary["failed"] == ["sam"]
+        assert summary["rows"] == 10
+        assert summary["rows_per_sec"] == 5
+        assert (summary["requests"], summary["retries"], summary["throttled"]) == (6, 2, 0)
+
+
+class TestClaims:
+    client = UpClient(os.environ["UP_TOKEN"])
+
+    def test_failed_claim_is_synced_by_the_next_token(self, monkeypatch):
+        calls = []
+
+        async def sync_account(client, account, queue):
+            calls.append(account.id)
+            await asyncio.sleep(0.01)
+            if len(calls) == 1:
+                raise UpClient.UpRequestError("500 error")
+            return AccountSync(account.id, count=5)
+
+        monkeypatch.setattr(Transactions, "_sync_transactions_for_account", staticmethod(sync_account))
+        account = Accounts(id="joint", display_name="Joint")
+
+        async def run():
+            self.client.claimed = {}
+            return await asyncio.gather(
+                Transactions._sync_claimed_account(self.client, account, None),
+                Transactions._sync_claimed_account(self.client, account, None),
+                Transactions._sync_claimed_account(self.client, account, None),
+                return_exceptions=True,
+            )
+
+        first, second, third = asyncio.run(run())
+        assert isinstance(first, UpClient.UpRequestError)
+        assert (second.count, third.count) == (5, 0)
+        assert calls == ["joint", "joint"]
+
+
+class TestManifestSync:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+        self.mockserver_url = os.environ.get("MOCKSERVER_URL")
+
+    def teardown_method(self):
+        os.environ["MOCKSERVER_URL"] = self.mockserver_url
+        delete_all_from_tables()
+
+    def test_tokens_sync_concurrently_and_fail_independently(self):
+        # every token of the fake API sees the same accounts, like a household's joint accounts
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(FakeUpConfig(accounts=2, transactions=30, days=3))
+        try:
+            specs = [TokenSpec("alex", "token_alex"), TokenSpec("sam", "token_sam"), TokenSpec("bad", "bad_token")]
+            summary = up_sync.sync_manifest(specs, vars(up_sync.parse_args(["sync"])))
+        finally:
+            process.terminate()
+            process.join()
+        assert summary["tokens"] == 3
+        assert summary["failed"] == ["bad"]
+        results = {result["name"]: result for result in summary["results"]}
+        assert "UpAuthError" in results["bad"]["error"]
+        # the joint accounts' transactions are only fetched by one of the tokens
+        assert results["alex"]["streams"]["transactions"] + results["sam"]["streams"]["transactions"] == 2 * 30
+        assert len(Transactions.all(self.session)) == 2 * 30
+        # each token paid for its own requests
+        assert results["alex"]["requests"]["requests"] > 0
+        assert results["sam"]["requests"]["requests"] > 0
+
+    def test_tokens_sharded_over_processes(self, tmp_path):
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(FakeUpConfig(accounts=2, transactions=30, days=3))
+        try:
+            options = vars(up_sync.parse_args(["sync", "--sink", "csv", "--output-dir", str(tmp_path)]))
+            specs = [TokenSpec("alex", "token_alex"), TokenSpec("sam", "token_sam")]
+            summary = up_sync.sync_manifest(specs, options, 2)
+        finally:
+            process.terminate()
+            process.join()
+        assert summary["failed"] == []
+        assert len({result["pid"] for result in summary["results"]}) == 2
+        # separate processes can't share claims, so both tokens fetch the joint accounts
+        assert [result["streams"]["transactions"] for result in summary["results"]] == [2 * 30, 2 * 30]
+        assert (tmp_path / "alex" / "transactions.csv.gz").exists()
+        assert (tmp_path / "sam" / "transactions.csv.gz").exists()
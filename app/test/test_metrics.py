@@ -0,0 +1,87 @@
+import json
+import os
+import sys
+import urllib.request
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+
+from app import up_sync
+from app.metrics import Histogram, Metrics, endpoint_label, profiled
+from app.test.helpers import delete_all_from_tables
+
+
+class TestMetrics:
+    def test_endpoint_label(self):
+        assert endpoint_label("https://api.up.com.au/api/v1/accounts/abc-123/transactions?page[after]=x") == \
+            "/accounts/{id}/transactions"
+        assert endpoint_label("http://mockserver:1080//util/ping") == "/util/ping"
+        assert endpoint_label("http://mockserver:1080/accounts") == "/accounts"
+        assert endpoint_label("https://api.up.com.au/api/v1/transactions/abc") == "/transactions/{id}"
+
+    def test_histogram_quantiles(self):
+        histogram = Histogram()
+        for i in range(1, 101):
+            histogram.observe(i / 1000)
+        assert histogram.count == 100
+        assert 0.025 <= histogram.quantile(0.5) <= 0.05
+        assert 0.05 <= histogram.quantile(0.99) <= 0.1
+        assert histogram.quantile(1.0) == 0.1
+        assert Histogram().quantile(0.5) is None
+
+    def test_counters_and_prometheus(self):
+        metrics = Metrics()
+        metrics.inc("pages", endpoint="/accounts")
+        metrics.inc("pages", 2, endpoint="/accounts/{id}/transactions")
+        metrics.observe("db_batch_seconds", 0.02, table="transactions")
+        assert metrics.counter("pages") == 3
+        assert metrics.counter("pages", endpoint="/accounts") == 1
+        text = metrics.prometheus()
+        assert 'up_sync_pages_total{endpoint="/accounts"} 1' in text
+        assert 'up_sync_db_batch_seconds_bucket{table="transactions",le="0.025"} 1' in text
+        assert 'up_sync_db_batch_seconds_count{table="transactions"} 1' in text
+
+    def test_serve(self):
+        metrics = Metrics()
+        metrics.inc("pages")
+        server = metrics.serve(0, host="127.0.0.1")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}/metrics") as res:
+                assert "up_sync_pages_total 1" in res.read().decode()
+        finally:
+            metrics.stop()
+
+    def test_profiled(self, tmp_path):
+        path = str(tmp_path / "sync.prof")
+        with profiled(path):
+            sum(range(1000))
+        assert os.path.exists(path)
+        assert "function calls" in open(f"{path}.txt").read()
+
+
+class TestSyncMetrics:
+    def setup_method(self):
+        delete_all_from_tables()
+
+    def teardown_method(self):
+        delete_all_from_tables()
+
+    def test_sync_records_metrics(self, tmp_path):
+        sync = up_sync.UpSync(os.environ["UP_TOKEN"])
+        rows = sync.sync()
+        metrics = sync.client.metrics
+        assert metrics.counter("pages", endpoint="/accounts") == 1
+        assert metrics.counter("rows_parsed", stream="accounts") == 2
+        assert metrics.counter("rows_written") == rows
+        assert metrics.counter("db_commits") > 0
+        assert metrics.counter("http_bytes_received") > 0
+        assert metrics.histogram("db_batch_seconds", table="transactions").count > 0
+
+        path = str(tmp_path / "metrics.json")
+        sync.write_metrics(path)
+        summary = json.load(open(path))
+        assert summary["counters"]["rows_synced"] == rows
+        assert summary["histograms"]["http_request_seconds{endpoint=/accounts}"]["count"] == 1
+        assert summary["scheduler"]["requests"] > 0
@@ -0,0 +1,98 @@
+import json
+import os
+import sys
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+
+from app import parsing
+from app.clients import Accounts, Attachments, Categories, Tags, TransactionCategories, Transactions, TransactionTags
+
+
+def fixture(name: str) -> list[dict]:
+    with open(os.path.join(os.path.dirname(__file__), f"../../config/mockserver/{name}.json")) as file:
+        return [exp["httpResponse"]["body"] for exp in json.load(file)]
+
+
+class TestParsing:
+    def test_records_match_table_columns(self):
+        assert parsing.TransactionRecord._fields == tuple(c.name for c in Transactions.__table__.columns)
+        assert parsing.AccountRecord._fields == tuple(c.name for c in Accounts.__table__.columns)
+        assert parsing.CategoryRecord._fields == tuple(c.name for c in Categories.__table__.columns)
+        assert parsing.TagRecord._fields == tuple(c.name for c in Tags.__table__.columns)
+        assert parsing.AttachmentRecord._fields == tuple(c.name for c in Attachments.__table__.columns)
+        columns = tuple(c.name for c in TransactionCategories.__table__.columns)
+        assert parsing.TransactionCategoryRecord._fields == columns
+        assert parsing.TransactionTagRecord._fields == tuple(c.name for c in TransactionTags.__table__.columns)
+
+    def test_content_hash_tracks_synced_values(self):
+        transaction = fixture("transactions")[0]["data"][0]
+        record = parsing.parse_transaction(transaction, "123")
+        assert record.content_hash == parsing.parse_transaction(json.loads(json.dumps(transaction)), "123").content_hash
+        held = {**transaction, "attributes": {**transaction["attributes"], "status": "HELD"}}
+        assert parsing.parse_transaction(held, "123").content_hash != record.content_hash
+        assert parsing.parse_transaction(transaction, "321").content_hash != record.content_hash
+
+    def test_content_hash_tracks_relationships(self):
+        transaction = fixture("transactions")[2]["data"][0]
+        record = parsing.parse_transaction(transaction, "1234")
+        retagged = json.loads(json.dumps(transaction))
+        retagged["relationships"]["tags"]["data"].reverse()
+        assert parsing.parse_transaction(retagged, "1234").content_hash == record.content_hash
+        retagged["relationships"]["tags"]["data"].pop()
+        assert parsing.parse_transaction(retagged, "1234").content_hash != record.content_hash
+
+    def test_parse_transaction_links(self):
+        category, tags = parsing.parse_transaction_links(fixture("transactions")[2]["data"][0])
+        assert category == ("1", "takeaway", "good-life")
+        assert tags == [("1", "Pizza Night"), ("1", "Holiday")]
+        assert parsing.parse_transaction_links(fixture("transactions")[0]["data"][0]) == (None, [])
+        assert parsing.parse_transaction_links({"id": "1"}) == (None, [])
+
+    def test_parse_categories_tags_and_attachments(self):
+        categories = parsing.parse_categories(fixture("categories")[0])
+        assert [(c.id, c.parent_id) for c in categories][:2] == [("good-life", None), ("takeaway", "good-life")]
+        assert [tag.id for tag in parsing.parse_tags(fixture("tags")[0])] == ["Holiday", "Pizza Night"]
+        attachment = parsing.parse_attachments(fixture("attachments")[0])[0]
+        assert attachment.transaction_id == "1"
+        assert attachment.file_content_type == "image/jpeg"
+        # a presigned URL for the same expiry isn't a change, a new expiry is so the stored URL gets refreshed
+        resigned = json.loads(json.dumps(fixture("attachments")[0]["data"][0]))
+        resigned["attributes"]["fileURL"] += "?signature=new"
+        assert parsing.parse_attachment(resigned).content_hash == attachment.content_hash
+        resigned["attributes"]["fileURLExpiresAt"] = "2099-01-01T00:00:00+10:00"
+        assert parsing.parse_attachment(resigned).content_hash != attachment.content_hash
+
+    def test_parse_transactions(self):
+        record = parsing.parse_transactions(fixture("transactions")[0], "123")[0]
+        assert record.id == "o4fpqff"
+        assert record.account_id == "123"
+        assert record.status == "SETTLED"
+        assert record.categorizable is True
+        assert record.value_str == "-59.98"
+        assert record.value_base == -5998
+        assert record.card_purchase_suffix == "1234"
+        assert record.created_at == "2024-06-06T07:20:59+00:00"
+
+    def test_parse_transaction_without_optional_attributes(self):
+        record = parsing.parse_transaction({"id": "1", "attributes": {"cardPurchaseMethod": None}}, "123")
+        assert record.card_purchase_suffix is None
+        assert record.value_base is None
+
+    def test_parse_accounts(self):
+        record = parsing.parse_accounts(fixture("accounts")[0])[1]
+        assert record.id == "1234"
+        assert record.display_name == "test1234"
+        assert record.balance == 1.0
+        assert record.value_base == 100
+
+    def test_orm_parser_matches_records(self):
+        transaction = fixture("transactions")[0]["data"][0]
+        orm = Transactions.parse_transaction(transaction, "123")
+        assert orm.id == "o4fpqff"
+        assert orm.value_base == -5998
+
+    def test_loads_falls_back_to_stdlib(self):
+        with patch.object(parsing, "orjson", None):
+            assert parsing.loads(b'{"data": []}') == {"data": []}
+        assert parsing.loads(b'{"data": []}') == {"data": []}
@@ -0,0 +1,146 @@
+import os
+import sys
+
+import pytest
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from sqlalchemy import text
+
+from app import up_sync
+from app.clients import Accounts, DailyAccountTotals, DBClient, Transactions
+from app.partitions import (
+    MonthlyPartitions,
+    PartitionError,
+    attached_months,
+    copy_rows,
+    create_partitioned_table,
+    install_mirror,
+    month_bounds,
+    partition_transactions,
+    partitioned_tables,
+    upcoming_months,
+)
+from app.test.helpers import delete_all_from_tables
+from app.test.test_rollups import record
+from app.webhooks import WebhookReceiver
+
+
+def unpartition(engine):
+    # puts the test database back the way the other tests expect it
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP TRIGGER IF EXISTS transactions_partition_mirror ON transactions")
+        conn.exec_driver_sql("DROP TABLE IF EXISTS transactions_partitioned")
+        if "transactions" not in partitioned_tables(conn):
+            return
+        conn.exec_driver_sql("DROP TABLE transactions")
+        for statement in (
+            "ALTER TABLE transactions_unpartitioned RENAME TO transactions",
+            "ALTER TABLE transactions RENAME CONSTRAINT transactions_unpartitioned_pkey TO transactions_pkey",
+            "ALTER INDEX transactions_unpartitioned_account_id_created_at_idx "
+            "RENAME TO transactions_account_id_created_at_idx",
+            "DELETE FROM transactions",
+            "ALTER TABLE transactions ADD CONSTRAINT fk_accounts FOREIGN KEY (account_id) REFERENCES accounts(id)",
+        ):
+            conn.exec_driver_sql(statement)
+
+
+class TestMonths:
+    def test_month_bounds(self):
+        assert month_bounds("2024-06") == ("2024-06-01", "2024-07-01")
+        assert month_bounds("2024-12") == ("2024-12-01", "2025-01-01")
+
+    def test_upcoming_months(self):
+        months = upcoming_months(3)
+        assert len(months) == 4
+        assert months == sorted(months)
+
+
+class TestPartitionedTransactions:
+    session = DBClient().session
+    engine = DBClient.engine()
+
+    def setup_method(self):
+        unpartition(self.engine)
+        delete_all_from_tables()
+        self.session.add(Accounts(id="123"))
+        self.session.commit()
+        Transactions.write_batch(up_sync.UpSync(os.environ["UP_TOKEN"]).client, [
+            record("t1", -500, "2024-05-31T23:59:59+10:00"),
+            record("t2", 200, "2024-06-01T00:00:00+10:00"),
+        ], {})
+
+    def teardown_method(self):
+        self.session.rollback()
+        unpartition(self.engine)
+        delete_all_from_tables()
+
+    def test_migration_moves_rows_and_writes_create_partitions(self):
+        assert partition_transactions(self.engine, batch_size=1, months_ahead=0) == 2
+        self.session.rollback()
+        with self.engine.connect() as conn:
+            assert partitioned_tables(conn) == {"transactions": "created_at"}
+            months = attached_months(conn, "transactions")
+            indexes = set(conn.execute(
+                text("SELECT indexname FROM pg_indexes WHERE tablename = 'transactions'")
+            ).scalars())
+        assert {"2024-05", "2024-06", *upcoming_months(0)} == set(months)
+        assert months["2024-05"] == "transactions_2024_05"
+        assert indexes >= {
+            "transactions_pkey", "transactions_created_at_brin", "transactions_account_id_created_at_idx"
+        }
+        assert self.session.execute(text("SELECT count(*) FROM transactions_unpartitioned")).scalar() == 2
+        # a second run is a no-op
+        assert partition_transactions(self.engine) == 0
+
+        client = up_sync.UpSync(os.environ["UP_TOKEN"]).client
+        Transactions.write_batch(client, [
+            record("t1", -450, "2024-05-31T23:59:59+10:00", "b"),
+            record("t3", -100, "2023-01-15T10:00:00+10:00"),
+        ], {})
+        with self.engine.connect() as conn:
+            assert "2023-01" in attached_months(conn, "transactions")
+        rows = {row["id"]: row["value_base"] for row in Transactions.all(self.session)}
+        assert rows == {"t1": -450, "t2": 200, "t3": -100}
+        WebhookReceiver(client, "secret")._write([], {}, ["t3"])
+        assert {row["id"] for row in Transactions.all(self.session)} == {"t1", "t2"}
+        assert DailyAccountTotals.check(self.session) == []
+
+    def test_syncs_write_into_partitions(self):
+        partition_transactions(self.engine)
+        up_sync.UpSync(os.environ["UP_TOKEN"]).sync()
+        synced = len(Transactions.all(self.session))
+        assert synced > 2
+        delete_all_from_tables()
+        # the COPY backfill merges on the partitioned table's key too
+        up_sync.UpSync(os.environ["UP_TOKEN"], copy_threshold=0).sync()
+        assert len(Transactions.all(self.session)) == synced - 2
+        assert DailyAccountTotals.check(self.session) == []
+
+    def test_writes_during_the_copy_are_mirrored(self):
+        with self.engine.begin() as conn:
+            create_partitioned_table(conn, "transactions_partitioned", "transactions")
+        partitions = MonthlyPartitions(self.engine, "transactions_partitioned")
+        partitions.ensure([record("t", 0, "2024-05-01"), record("t", 0, "2024-06-01")])
+        with self.engine.begin() as conn:
+            install_mirror(conn, "transactions", "transactions_partitioned")
+        client = up_sync.UpSync(os.environ["UP_TOKEN"]).client
+        # written after the trigger went in, before or while the rows are copied
+        Transactions.write_batch(client, [
+            record("t2", 300, "2024-06-01T00:00:00+10:00", "b"),
+            record("t4", -1, "2024-06-02T00:00:00+10:00"),
+        ], {})
+        WebhookReceiver(client, "secret")._write([], {}, ["t1"])
+        assert copy_rows(self.engine, "transactions", "transactions_partitioned", 1) == 2
+        copied = self.session.execute(text("SELECT id, value_base FROM transactions_partitioned ORDER BY id")).all()
+        assert copied == [("t2", 300), ("t4", -1)]
+
+    def test_undated_transactions_block_the_migration(self):
+        self.session.execute(text("UPDATE transactions SET created_at = NULL WHERE id = 't1'"))
+        self.session.commit()
+        with pytest.raises(PartitionError):
+            partition_transactions(self.engine)
+        with self.engine.connect() as conn:
+            assert partitioned_tables(conn) == {}
@@ -0,0 +1,86 @@
+import datetime
+import os
+import sys
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from sqlalchemy import update
+
+from app import up_sync
+from app.clients import Accounts, DailyAccountTotals, DBClient, Transactions
+from app.parsing import TransactionRecord
+from app.test.helpers import delete_all_from_tables
+from app.webhooks import WebhookReceiver
+
+DAY = datetime.date(2024, 6, 6)
+NEXT_DAY = datetime.date(2024, 6, 7)
+
+
+def record(id: str, value_base: int, created_at: str, content_hash: str = "a") -> TransactionRecord:
+    return TransactionRecord(
+        id, "123", "SETTLED", None, "desc", None, True, "AUD", str(value_base / 100), value_base, None, None,
+        created_at, content_hash,
+    )
+
+
+class TestDailyAccountTotals:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+        self.session.add(Accounts(id="123"))
+        self.session.commit()
+        self.client = up_sync.UpSync(os.environ["UP_TOKEN"]).client
+
+    def teardown_method(self):
+        delete_all_from_tables()
+
+    def totals(self) -> dict:
+        self.session.expire_all()
+        return {
+            row.day: (row.debit_base, row.credit_base, row.count)
+            for row in self.session.query(DailyAccountTotals).filter(DailyAccountTotals.account_id == "123")
+        }
+
+    def test_batches_only_update_the_days_they_touch(self):
+        Transactions.write_batch(self.client, [
+            record("t1", -500, "2024-06-06T07:20:59+10:00"),
+            record("t2", 200, "2024-06-06T23:59:59+10:00"),
+            record("t3", -100, "2024-06-07T00:00:00+10:00"),
+        ], {})
+        assert self.totals() == {DAY: (500, 200, 2), NEXT_DAY: (100, 0, 1)}
+        self.session.execute(update(DailyAccountTotals.__table__).where(DailyAccountTotals.day == NEXT_DAY).values(
+            count=99
+        ))
+        self.session.commit()
+        Transactions.write_batch(self.client, [record("t4", -50, "2024-06-06T12:00:00+10:00")], {})
+        # the next day wasn't written to, so it's still wrong until checked and rebuilt
+        assert self.totals() == {DAY: (550, 200, 3), NEXT_DAY: (100, 0, 99)}
+        assert DailyAccountTotals.check(self.session) == [
+            {"account_id": "123", "day": "2024-06-07", "expected": (100, 0, 1), "stored": (100, 0, 99)}
+        ]
+        assert DailyAccountTotals.rebuild(self.session) == 2
+        assert DailyAccountTotals.check(self.session) == []
+
+    def test_changed_and_deleted_transactions(self):
+        Transactions.write_batch(self.client, [
+            record("t1", -500, "2024-06-06T07:20:59+10:00"),
+            record("t2", -100, "2024-06-07T07:20:59+10:00"),
+        ], {})
+        # a held amount settling for a different value
+        Transactions.write_batch(self.client, [record("t1", -450, "2024-06-06T07:20:59+10:00", "b")], {})
+        assert self.totals() == {DAY: (450, 0, 1), NEXT_DAY: (100, 0, 1)}
+        WebhookReceiver(self.client, "secret")._write([], {}, ["t2"])
+        assert self.totals() == {DAY: (450, 0, 1)}
+        assert DailyAccountTotals.check(self.session) == []
+
+    def test_sync_and_copy_backfill_keep_totals_consistent(self):
+        up_sync.UpSync(os.environ["UP_TOKEN"]).sync()
+        assert self.session.query(DailyAccountTotals).count() > 0
+        assert DailyAccountTotals.check(self.session) == []
+        delete_all_from_tables()
+        up_sync.UpSync(os.environ["UP_TOKEN"], copy_threshold=0).sync()
+        assert self.session.query(DailyAccountTotals).count() > 0
+        assert DailyAccountTotals.check(self.session) == []
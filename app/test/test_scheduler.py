@@ -0,0 +1,89 @@
+import asyncio
+import os
+import sys
+
+import pytest
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+
+from app.scheduler import RequestScheduler, retry_after_seconds
+
+
+def responses(*statuses, headers=None):
+    calls = []
+
+    def send():
+        calls.append(1)
+        status = statuses[min(len(calls), len(statuses)) - 1]
+        return status, headers or {}, b"{}"
+
+    return send, calls
+
+
+class TestRequestScheduler:
+    def test_retry_after_seconds(self):
+        assert retry_after_seconds({"Retry-After": "2"}) == 2.0
+        assert retry_after_seconds({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0.0
+        assert retry_after_seconds({}) is None
+        assert retry_after_seconds({"Retry-After": "soon"}) is None
+
+    def test_retries_throttled_requests(self):
+        scheduler = RequestScheduler(rate=1000, backoff_base=0.001)
+        send, calls = responses(429, 503, 200, headers={"Retry-After": "0"})
+        assert scheduler.request(send)[0] == 200
+        assert len(calls) == 3
+        assert scheduler.retries == 2
+        assert scheduler.throttled == 2
+
+    def test_gives_up_after_max_retries(self):
+        scheduler = RequestScheduler(rate=1000, max_retries=2, backoff_base=0.001)
+        send, calls = responses(500)
+        assert scheduler.request(send)[0] == 500
+        assert len(calls) == 3
+
+    def test_client_errors_are_not_retried(self):
+        scheduler = RequestScheduler(rate=1000)
+        send, calls = responses(401)
+        assert scheduler.request(send)[0] == 401
+        assert len(calls) == 1
+
+    def test_connection_errors_are_retried_then_raised(self):
+        scheduler = RequestScheduler(rate=1000, max_retries=1, backoff_base=0.001)
+
+        def send():
+            raise requests.ConnectionError("boom")
+
+        with pytest.raises(requests.ConnectionError):
+            scheduler.request(send)
+        assert scheduler.retries == 1
+
+    def test_concurrency_backs_off_and_ramps_up(self):
+        scheduler = RequestScheduler(rate=1000, initial_concurrency=8, backoff_base=0.001)
+        send, _ = responses(429, 200)
+        scheduler.request(send)
+        assert scheduler.concurrency == 4
+        for _ in range(4):
+            scheduler.request(responses(200)[0])
+        assert scheduler.concurrency == 5
+
+    def test_token_bucket_limits_rate(self):
+        scheduler = RequestScheduler(rate=1000, burst=1)
+        scheduler._reserve()
+        assert scheduler._reserve() > 0
+
+    def test_async_requests_respect_concurrency(self):
+        scheduler = RequestScheduler(rate=1000, initial_concurrency=2, max_concurrency=2)
+        in_flight = []
+
+        async def send():
+            in_flight.append(scheduler.in_flight)
+            await asyncio.sleep(0.01)
+            return 200, {}, b"{}"
+
+        async def run():
+            await asyncio.gather(*[scheduler.async_request(send) for _ in range(6)])
+
+        asyncio.run(run())
+        assert max(in_flight) == 2
+        assert scheduler.requests == 6
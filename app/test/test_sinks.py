@@ -0,0 +1,86 @@
+import csv
+import gzip
+import os
+import sys
+
+import pytest
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+
+from app.clients import Accounts, DBClient, Transactions
+from app.parsing import TransactionRecord
+from app.sinks import CsvSink, ParquetSink
+from app.test.helpers import delete_all_from_tables
+
+
+def transactions(count: int) -> list[TransactionRecord]:
+    return [
+        TransactionRecord(
+            str(i), "123", "SETTLED", None, "desc", "msg, with comma", True, "AUD", "-1.00", -100, None,
+            "2024-06-06T07:20:59+10:00", "2024-06-06T07:20:59+10:00", f"hash{i}",
+        )
+        for i in range(count)
+    ]
+
+
+class TestCsvSink:
+    def test_writes_gzipped_csv(self, tmp_path):
+        sink = CsvSink(str(tmp_path))
+        assert sink.write(Transactions, transactions(3)) == 3
+        sink.write(Transactions, [{**transactions(1)[0]._asdict(), "id": "dict"}])
+        sink.close()
+        with gzip.open(tmp_path / "transactions.csv.gz", "rt") as file:
+            rows = list(csv.DictReader(file))
+        assert [row["id"] for row in rows] == ["0", "1", "2", "dict"]
+        assert rows[0]["message"] == "msg, with comma"
+        assert rows[0]["value_base"] == "-100"
+
+
+class TestParquetSink:
+    def test_writes_row_groups(self, tmp_path):
+        pq = pytest.importorskip("pyarrow.parquet")
+        sink = ParquetSink(str(tmp_path), row_group_size=4)
+        for _ in range(3):
+            sink.write(Transactions, transactions(3))
+        sink.write(Accounts, [])
+        sink.close()
+        file = pq.ParquetFile(tmp_path / "transactions.parquet")
+        assert file.metadata.num_rows == 9
+        assert file.metadata.num_row_groups == 3
+        table = file.read()
+        assert table.column("value_base").to_pylist()[0] == -100
+        assert str(table.column("created_at").to_pylist()[0]) == "2024-06-06 07:20:59"
+        assert not (tmp_path / "accounts.parquet").exists()
+
+
+class TestTimestamps:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+
+    def teardown_method(self):
+        delete_all_from_tables()
+
+    def test_sinks_keep_the_local_wall_time(self, tmp_path):
+        pq = pytest.importorskip("pyarrow.parquet")
+        rows = transactions(1)
+        rows.append(rows[0]._replace(id="utc", created_at="2024-06-06T07:20:59.5Z"))
+        self.session.add(Accounts(id="123"))
+        self.session.commit()
+        Transactions.insert_batch(self.session, rows)
+        stored = dict(self.session.query(Transactions.id, Transactions.created_at).all())
+        for sink in (CsvSink(str(tmp_path)), ParquetSink(str(tmp_path))):
+            sink.write(Transactions, rows)
+            sink.close()
+        with gzip.open(tmp_path / "transactions.csv.gz", "rt") as file:
+            written = {row["id"]: row["created_at"] for row in csv.DictReader(file)}
+        parquet = pq.read_table(tmp_path / "transactions.parquet").to_pydict()
+        assert dict(zip(parquet["id"], parquet["created_at"])) == stored
+        assert str(stored["0"]) == "2024-06-06 07:20:59"
+        # csv keeps the API's strings, offset and all
+        assert written["0"] == "2024-06-06T07:20:59+10:00"
+        assert str(stored["utc"]) == "2024-06-06 07:20:59.500000"
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from app import streams, up_sync
+from app.clients import (
+    Accounts,
+    Attachments,
+    Categories,
+    DBClient,
+    Tags,
+    TransactionCategories,
+    Transactions,
+    TransactionTags,
+    UpClient,
+)
+from app.parsing import TransactionCategoryRecord, TransactionRecord, TransactionTagRecord
+from app.sinks import CsvSink
+from app.test.helpers import delete_all_from_tables
+
+
+def stream(name: str, depends_on: tuple = (), sync=None) -> streams.Stream:
+    return streams.Stream(name, f"/{name}", Tags, None, depends_on=depends_on, sync=sync)
+
+
+def record(id: str, content_hash: str) -> TransactionRecord:
+    return TransactionRecord(
+        id, "123", "SETTLED", None, "desc", None, True, "AUD", "-1.00", -100, None, None,
+        "2024-06-06T07:20:59+00:00", content_hash,
+    )
+
+
+class TestPlan:
+    def test_plan_orders_streams_by_dependency(self):
+        names = [s.name for s in streams.plan()]
+        assert set(names) == {"accounts", "categories", "tags", "transactions", "attachments"}
+        assert names.index("accounts") < names.index("transactions") < names.index("attachments")
+
+    def test_plan_subset(self):
+        assert [s.name for s in streams.plan(["attachments", "tags"])] == ["tags", "attachments"]
+        with_dependencies = streams.plan(["attachments"], with_dependencies=True)
+        assert [s.name for s in with_dependencies] == ["accounts", "transactions", "attachments"]
+        with pytest.raises(ValueError):
+            streams.plan(["budgets"])
+
+
+class TestRunStreams:
+    client = UpClient(os.environ["UP_TOKEN"])
+
+    def test_independent_streams_run_concurrently(self):
+        events = []
+
+        def sync(delay):
+            async def run(client, stream):
+                events.append(f"start {stream.name}")
+                await asyncio.sleep(delay)
+                events.append(f"end {stream.name}")
+                return 1
+            return run
+
+        plan = [stream("a", sync=sync(0.05)), stream("b", sync=sync(0.01)), stream("c", ("a",), sync(0))]
+        assert asyncio.run(streams.run_streams(self.client, plan)) == {"a": 1, "b": 1, "c": 1}
+        assert events.index("start b") < events.index("end a") < events.index("start c")
+
+    def test_failed_stream_skips_dependents_only(self):
+        ran = []
+
+        async def fail(client, stream):
+            raise UpClient.UpRequestError("500 error")
+
+        async def succeed(client, stream):
+            ran.append(stream.name)
+            return 1
+
+        plan = [stream("a", sync=fail), stream("b", sync=succeed), stream("c", ("a",), succeed)]
+        with pytest.raises(UpClient.UpRequestError):
+            asyncio.run(streams.run_streams(self.client, plan))
+        assert ran == ["b"]
+
+
+class TestStreamSync:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+
+    def teardown_method(self):
+        delete_all_from_tables()
+
+    def test_sync_writes_every_stream_and_transaction_links(self):
+        sync = up_sync.UpSync(os.environ["UP_TOKEN"])
+        counts = sync.sync_streams()
+        assert counts == {"accounts": 2, "categories": 4, "tags": 2, "transactions": 3, "attachments": 1}
+        assert self.session.query(Categories.parent_id).filter(Categories.id == "takeaway").scalar() == "good-life"
+        assert self.session.query(Attachments.transaction_id).filter(Attachments.id == "a1").scalar() == "1"
+        links = self.session.query(TransactionCategories).all()
+        assert [(link.transaction_id, link.category_id, link.parent_category_id) for link in links] == [
+            ("1", "takeaway", "good-life")
+        ]
+        tags = self.session.query(TransactionTags.tag_id).filter(TransactionTags.transaction_id == "1").all()
+        assert sorted(tag for tag, in tags) == ["Holiday", "Pizza Night"]
+
+    def test_sync_subset_of_streams(self):
+        sync = up_sync.UpSync(os.environ["UP_TOKEN"])
+        assert sync.sync(["categories", "tags"]) == 6
+        assert self.session.query(Accounts).count() == 0
+        assert self.session.query(Tags).count() == 2
+
+    def test_file_sink_subset_pulls_in_dependencies(self, tmp_path):
+        sync = up_sync.UpSync(os.environ["UP_TOKEN"], sink=CsvSink(str(tmp_path)))
+        assert sync.sync(["transactions"]) == 2 + 3
+        assert (tmp_path / "transaction_tags.csv.gz").exists()
+
+    def test_links_are_replaced_when_a_transaction_changes(self):
+        client = up_sync.UpSync(os.environ["UP_TOKEN"]).client
+        self.session.add(Accounts(id="123"))
+        self.session.commit()
+        category = TransactionCategoryRecord("t1", "takeaway", "good-life")
+        tagged = {"t1": (category, [TransactionTagRecord("t1", "Work")])}
+        Transactions.write_batch(client, [record("t1", "a")], tagged)
+        Transactions.write_batch(client, [record("t1", "b")], {"t1": (None, [TransactionTagRecord("t1", "Holiday")])})
+        assert self.session.query(TransactionCategories).count() == 0
+        assert [tag for tag, in self.session.query(TransactionTags.tag_id).all()] == ["Holiday"]
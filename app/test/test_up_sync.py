@@ -1,3 +1,4 @@
+import gzip
 import os
 import secrets
 import sys
@@ -7,7 +8,8 @@ os.environ["env"] = "dev"
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
 from app import up_sync
-from app.clients import Accounts, DBClient, Transactions, UpClient
+from app.clients import Accounts, DBClient, SyncState, Transactions, UpClient
+from app.sinks import CsvSink
 from app.test.test_db import delete_all_from_tables
 
 ACTION_DATE = "2024-06-06T07:20:59+00:00"
@@ -79,3 +81,74 @@ class TestSync:
                     "statusEmoji": "⚡️",
                 },
             }
+
+    def test_transaction_sync_with_single_writer_and_queue_slot(self):
+        synced = up_sync.UpSync(os.environ["UP_TOKEN"], writers=1, queue_size=1).sync_transactions()
+        assert synced == 3
+        assert len(self.session.query(Transactions).all()) == 3
+
+    def test_transaction_sync_with_date_slices_deduplicates(self):
+        # the mockserver returns the same pages for every slice
+        synced = up_sync.UpSync(os.environ["UP_TOKEN"], lookback=100, slice_days=30).sync_transactions()
+        assert synced == 3
+        assert len(self.session.query(Transactions).all()) == 3
+
+    def test_transaction_sync_records_sync_state(self):
+        client = up_sync.UpSync(os.environ["UP_TOKEN"]).client
+        up_sync.asyncio.run(Transactions.sync_transactions(client))
+        state = self.session.query(SyncState).filter(
+            SyncState.account_id == "1234", SyncState.stream == Transactions.STREAM
+        ).one()
+        assert state.watermark.__str__() == "2024-06-06 07:20:59"
+        assert state.run_id == client.run_id
+        assert state.completed_at is not None
+        # finished cursors are cleaned up
+        assert SyncState.cursors(self.session, "1234", Transactions.STREAM) == {}
+        client.lookback = None
+        assert Transactions.determine_account_filter_since_param(
+            client, "1234", self.session
+        ) == "2024-06-06T07:20:59+00:00"
+
+    def test_failed_batch_isnt_checkpointed_past(self, monkeypatch):
+        write_batch = Transactions.write_batch
+        written = []
+
+        def fail_first_batch(client, rows, links, statements=()):
+            if rows and not written:
+                written.append(rows)
+                raise DBClient.BatchWriteError("batch failed")
+            return write_batch(client, rows, links, statements)
+
+        monkeypatch.setattr(Transactions, "write_batch", fail_first_batch)
+        client = up_sync.UpSync(os.environ["UP_TOKEN"], batch_size=1, max_pages_in_flight=1).client
+        up_sync.asyncio.run(Transactions.sync_transactions(client, [Accounts(id="1234", display_name="Spending")]))
+        state = self.session.query(SyncState).filter(
+            SyncState.account_id == "1234", SyncState.stream == Transactions.STREAM
+        ).one()
+        # the later batches were written, and the failed row again when the other date slice fetched it,
+        # but neither the watermark nor the cursor moved past the failed batch
+        assert self.session.query(Transactions).count() == 2
+        assert sorted(client.changes["transactions"].hashes) == ["1", "2"]
+        assert state.watermark is None
+        assert state.completed_at is None
+        cursors = SyncState.cursors(self.session, "1234", Transactions.STREAM).values()
+        assert cursors and not any("page=" in cursor for cursor in cursors)
+
+    def test_transaction_sync_resumes_unfinished_cursor(self):
+        # a previous run died after committing the first page of account 1234
+        self.session.execute(SyncState.checkpoint(
+            "1234", f"{Transactions.STREAM}:crashed:0", "crashed", "2024-06-06T07:20:59+00:00",
+            cursor=f"{os.environ['MOCKSERVER_URL']}/accounts/1234/transactions?page=2",
+        ))
+        self.session.commit()
+        up_sync.UpSync(os.environ["UP_TOKEN"]).sync_transactions()
+        assert self.session.query(Transactions).filter(Transactions.id == "2").first() is not None
+        assert SyncState.cursors(self.session, "1234", Transactions.STREAM) == {}
+
+    def test_sync_to_csv_sink(self, tmp_path):
+        sync = up_sync.UpSync(os.environ["UP_TOKEN"], sink=CsvSink(str(tmp_path)))
+        sync.sync()
+        with gzip.open(tmp_path / "transactions.csv.gz", "rt") as file:
+            assert len(file.read().splitlines()) == 4
+        with gzip.open(tmp_path / "accounts.csv.gz", "rt") as file:
+            assert len(file.read().splitlines()) == 3
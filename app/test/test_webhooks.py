@@ -0,0 +1,121 @@
+import asyncio
+import os
+import sys
+
+# makes it access the test db instead
+os.environ["env"] = "dev"
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+import aiohttp
+from aiohttp.test_utils import TestServer
+
+from app.bench.fake_up_api import FakeUpConfig, start_in_process
+from app.clients import Accounts, DBClient, Transactions, UpClient
+from app.http_cache import HttpCache
+from app.test.helpers import delete_all_from_tables
+from app.webhooks import SIGNATURE_HEADER, WebhookReceiver, sign, signed_request, verify, webhook_event
+
+SECRET = "webhook_secret"
+
+
+class TestSignatures:
+    def test_verify(self):
+        body, headers = signed_request(SECRET, webhook_event("t1"))
+        assert verify(SECRET, body, headers[SIGNATURE_HEADER])
+        assert not verify(SECRET, body + b" ", headers[SIGNATURE_HEADER])
+        assert not verify("other", body, headers[SIGNATURE_HEADER])
+        assert not verify(SECRET, body, None)
+        assert sign(SECRET, b"{}") == sign(SECRET, b"{}")
+
+
+class TestWebhookReceiver:
+    session = DBClient().session
+
+    def setup_method(self):
+        delete_all_from_tables()
+        self.mockserver_url = os.environ.get("MOCKSERVER_URL")
+
+    def teardown_method(self):
+        os.environ["MOCKSERVER_URL"] = self.mockserver_url
+        delete_all_from_tables()
+
+    async def post_events(self, receiver: WebhookReceiver, events: list[tuple[dict, str]]) -> list[int]:
+        server = TestServer(receiver.app())
+        await server.start_server()
+        statuses = []
+        try:
+            async with aiohttp.ClientSession() as session:
+                for event, secret in events:
+                    body, headers = signed_request(secret, event)
+                    async with session.post(server.make_url("/webhook"), data=body, headers=headers) as res:
+                        statuses.append(res.status)
+            await asyncio.wait_for(receiver.queue.join(), 10)
+        finally:
+            await server.close()
+        return statuses
+
+    def test_upserts_pushed_transactions(self):
+        config = FakeUpConfig(accounts=2, transactions=10)
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(config)
+        try:
+            client = UpClient("bench_token")
+            receiver = WebhookReceiver(client, SECRET, batch_size=10, flush_interval=0.2, reconcile_interval=0)
+            statuses = asyncio.run(self.post_events(receiver, [
+                (webhook_event("bench-account-0-1"), SECRET),
+                (webhook_event("bench-account-0-2"), SECRET),
+                (webhook_event("bench-account-0-2", "TRANSACTION_SETTLED"), SECRET),
+                (webhook_event("bench-account-1-3"), SECRET),
+                (webhook_event("bench-account-1-4"), "wrong_secret"),
+                (webhook_event(event_type="PING"), SECRET),
+            ]))
+        finally:
+            process.terminate()
+            process.join()
+        assert statuses == [200, 200, 200, 200, 401, 200]
+        ids = sorted(t["id"] for t in Transactions.all(self.session))
+        assert ids == ["bench-account-0-1", "bench-account-0-2", "bench-account-1-3"]
+        # the accounts weren't synced yet, the failed batch synced them and retried
+        assert len(Accounts.all(self.session)) == 2
+        assert client.metrics.counter("webhook_events", result="invalid_signature") == 1
+        # the burst was coalesced into one batch, with one fetch per distinct transaction
+        assert client.metrics.histogram("webhook_batch_size").count == 1
+        assert client.metrics.counter("pages", endpoint="/transactions/{id}") == 3
+
+    def test_deletes_transactions(self):
+        config = FakeUpConfig(accounts=1, transactions=10)
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(config)
+        try:
+            client = UpClient("bench_token")
+            receiver = WebhookReceiver(client, SECRET, flush_interval=0.05, reconcile_interval=0)
+            asyncio.run(self.post_events(receiver, [(webhook_event("bench-account-0-1"), SECRET)]))
+            assert len(Transactions.all(self.session)) == 1
+            receiver = WebhookReceiver(client, SECRET, flush_interval=0.05, reconcile_interval=0)
+            deleted = webhook_event("bench-account-0-1", "TRANSACTION_DELETED")
+            asyncio.run(self.post_events(receiver, [(deleted, SECRET)]))
+        finally:
+            process.terminate()
+            process.join()
+        self.session.expire_all()
+        assert Transactions.all(self.session) == []
+
+    def test_reconcile_saves_http_cache(self, tmp_path):
+        process, os.environ["MOCKSERVER_URL"] = start_in_process(FakeUpConfig(accounts=1, transactions=5, days=1))
+        try:
+            client = UpClient("bench_token", cache=HttpCache(str(tmp_path)))
+            # a write that failed before this run doesn't keep its index from being saved
+            client.metrics.inc("db_batch_errors", table="transactions")
+            receiver = WebhookReceiver(client, SECRET, reconcile_interval=0)
+
+            async def reconcile():
+                await receiver.start()
+                try:
+                    await receiver.reconcile()
+                finally:
+                    await receiver.stop()
+
+            asyncio.run(reconcile())
+        finally:
+            process.terminate()
+            process.join()
+        assert len(Transactions.all(self.session)) == 5
+        assert len(HttpCache(str(tmp_path)).entries) == len(client.cache.entries) > 0
@@ -1,22 +1,137 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
 
 import argparse
 import asyncio
+import json
 import logging
+import multiprocessing
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
 
-from app.clients import Accounts, Transactions, UpClient
+from app.archive import PageArchive
+from app.clients import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_COPY_THRESHOLD,
+    DEFAULT_MAX_PAGES_IN_FLIGHT,
+    DEFAULT_MAX_SLICES,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_QUEUE_SIZE,
+    DEFAULT_SLICE_DAYS,
+    DEFAULT_WRITERS,
+    DailyAccountTotals,
+    Transactions,
+    UpClient,
+    http_connector,
+)
+from app.daemon import (
+    DEFAULT_ACCOUNTS_INTERVAL,
+    DEFAULT_INTERVAL,
+    DEFAULT_JITTER,
+    DEFAULT_SHUTDOWN_TIMEOUT,
+    SyncDaemon,
+)
+from app.http_cache import DEFAULT_CACHE_SIZE_MB, HttpCache
+from app.manifest import TokenSpec, load_manifest, shards, summarize
+from app.metrics import Metrics, profiled
+from app.migrations import apply_migrations
+from app.partitions import partition_transactions
+from app.scheduler import DEFAULT_MAX_RETRIES, DEFAULT_RATE_LIMIT, RequestScheduler
+from app.sinks import DEFAULT_OUTPUT_DIR, FILE_SINKS, PostgresSink, Sink
+from app.streams import STREAMS, plan, replay, run_streams, sync_accounts
+from app.webhooks import (
+    DEFAULT_FLUSH_INTERVAL,
+    DEFAULT_RECONCILE_INTERVAL,
+    DEFAULT_WEBHOOK_BATCH_SIZE,
+    WebhookReceiver,
+)
 
 logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
 class UpSync:
-    def __init__(self, token: str, lookback: int = None):
-        self.client = UpClient(token, lookback)
+    def __init__(
+        self,
+        token: str,
+        lookback: int = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        copy_threshold: int = DEFAULT_COPY_THRESHOLD,
+        writers: int = DEFAULT_WRITERS,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        scheduler: RequestScheduler = None,
+        slice_days: int = DEFAULT_SLICE_DAYS,
+        max_slices: int = DEFAULT_MAX_SLICES,
+        sink: Sink = None,
+        metrics: Metrics = None,
+        cache: HttpCache = None,
+        detect_changes: bool = True,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        archive: PageArchive = None,
+        bounded_memory: bool = False,
+        max_pages_in_flight: int = None,
+    ):
+        self.client = UpClient(
+            token,
+            lookback,
+            batch_size,
+            copy_threshold,
+            writers,
+            queue_size,
+            scheduler,
+            slice_days,
+            max_slices,
+            sink,
+            metrics,
+            cache,
+            detect_changes,
+            pool_size,
+            archive,
+            bounded_memory,
+            max_pages_in_flight,
+        )
+        self.counts = {}
+        if self.client.sink.stateful:
+            apply_migrations(self.client.session.get_bind())
+            self.client.verify_cache()
+
+    @classmethod
+    def from_options(cls, token: str, options: dict, name: str = None, metrics: Metrics = None) -> UpSync:
+        # options are the parsed command line arguments. Named syncs (one per token of a manifest) get a
+        # directory of their own under --output-dir and --http-cache, as both are keyed by table and URL only
+        def directory(path: str) -> str:
+            return os.path.join(path, name) if path and name else path
+
+        sink = None
+        if options["sink"] in FILE_SINKS:
+            sink = FILE_SINKS[options["sink"]](directory(options["output_dir"]))
+        cache = None
+        if options["http_cache"]:
+            cache = HttpCache(directory(options["http_cache"]), options["http_cache_size"] * 1024 * 1024)
+        return cls(
+            token,
+            options["lookback"],
+            options["batch_size"],
+            options["copy_threshold"],
+            options["writers"],
+            options["queue_size"],
+            # Up rate limits each token separately, so every sync gets a request budget of its own
+            RequestScheduler(rate=options["rate_limit"], max_retries=options["max_retries"]),
+            options["slice_days"],
+            options["max_slices"],
+            sink,
+            metrics,
+            cache,
+            not options["full_refresh"],
+            options["db_pool_size"],
+            PageArchive(directory(options["archive"])) if options["archive"] else None,
+            options["bounded_memory"],
+            options["max_pages_in_flight"],
+        )
 
     def authenticate(self):
         try:
@@ -26,19 +141,253 @@ class UpSync:
             sys.exit(1)
 
     def sync_transactions(self, account_ids=None):
-        asyncio.run(Transactions.sync_transactions(self.client, account_ids))
+        return asyncio.run(Transactions.sync_transactions(self.client, account_ids))
 
     def sync_accounts(self):
-        Accounts.sync_accounts(self.client)
+        return asyncio.run(sync_accounts(self.client, STREAMS["accounts"]))
+
+    def plan(self, streams: list[str] = None, with_dependencies: bool = False) -> list:
+        # file sinks can't be read back, so a stream's dependencies have to be fetched in the same run
+        selected = plan(streams, with_dependencies=with_dependencies or not self.client.sink.stateful)
+        LOG.info(f"Syncing streams: {', '.join(stream.name for stream in selected)}")
+        return selected
 
-    def sync(self):
+    def sync_streams(self, streams: list[str] = None) -> dict[str, int]:
+        return asyncio.run(run_streams(self.client, self.plan(streams)))
+
+    def sync(self, streams: list[str] = None):
+        return asyncio.run(self.async_sync(streams))
+
+    async def async_sync(self, streams: list[str] = None, with_dependencies: bool = False):
         LOG.info("Starting Sync")
-        self.sync_accounts()
-        self.sync_transactions()
-        LOG.info("Sync Complete")
+        start = time.perf_counter()
+        errors = self.client.metrics.counter("db_batch_errors")
+        try:
+            self.counts = await run_streams(self.client, self.plan(streams, with_dependencies))
+            rows = sum(self.counts.values())
+        finally:
+            # file sinks only write their footers here
+            self.client.sink.close()
+            self.client.release_session()
+            if self.client.archive is not None:
+                self.client.archive.close()
+        elapsed = time.perf_counter() - start
+        LOG.info(f"Sync Complete: {rows} rows in {elapsed:.2f}s ({rows / elapsed:.0f} rows/sec)")
+        LOG.info(f"Rows per stream: {self.counts}")
+        LOG.info(f"Request stats: {self.client.scheduler.stats()}")
+        for table, changes in self.client.changes.items():
+            LOG.info(f"{table} changes: {changes.stats()}")
+        if (cache := self.client.cache) is not None:
+            LOG.info(f"HTTP cache: {cache.stats()}")
+            self.client.save_cache(errors)
+        self.client.metrics.observe("sync_seconds", elapsed)
+        self.client.metrics.inc("rows_synced", rows)
+        return rows
+
+    def serve(
+        self,
+        secret: str,
+        host: str = "0.0.0.0",
+        port: int = 8000,
+        batch_size: int = DEFAULT_WEBHOOK_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        reconcile_interval: float = DEFAULT_RECONCILE_INTERVAL,
+    ):
+        # webhooks only carry ids, so pushed transactions are upserted into postgres as they arrive
+        from aiohttp import web
+
+        if not self.client.sink.stateful:
+            raise ValueError("serve mode needs the postgres sink")
+        LOG.info(f"Listening for Up webhooks on http://{host}:{port}/webhook")
+        receiver = WebhookReceiver(self.client, secret, batch_size, flush_interval, reconcile_interval)
+        web.run_app(receiver.app(), host=host, port=port, print=None, access_log=None)
+
+    def rebuild_rollups(self) -> int:
+        return DailyAccountTotals.rebuild(self.client.session)
+
+    def check_rollups(self) -> list[dict]:
+        mismatches = DailyAccountTotals.check(self.client.session)
+        for mismatch in mismatches[:20]:
+            LOG.error(f"Daily totals mismatch: {mismatch}")
+        if mismatches:
+            LOG.error(f"{len(mismatches)} daily totals differ from a full recompute, run rebuild-rollups")
+        else:
+            LOG.info("Daily totals match a full recompute")
+        return mismatches
+
+    def partition_transactions(self) -> int:
+        if not self.client.sink.stateful:
+            raise ValueError("partitioning needs the postgres sink")
+        return partition_transactions(self.client.session.get_bind())
+
+    def analytics(self, period: str = "month", output: str = None) -> dict:
+        # numpy is only imported by this mode
+        from app import analytics
+
+        if not self.client.sink.stateful:
+            raise ValueError("analytics needs the postgres sink")
+        try:
+            report = analytics.report(self.client.session, period)
+        finally:
+            self.client.release_session()
+        for row in report["reconciliation"]:
+            if row["drift_base"]:
+                LOG.warning(
+                    f"Account {row['account_id']}: balance {row['balance_base']} but its {row['count']} transactions "
+                    f"sum to {row['transactions_base']} (drift {row['drift_base']})"
+                )
+        LOG.info(f"{len(report['periods'])} account {period}s with transactions")
+        if output:
+            with open(output, "w") as file:
+                json.dump(report, file, indent=2, default=str)
+            LOG.info(f"Wrote analytics report to {output}")
+        return report
+
+    def replay(
+        self, streams: list[str] = None, accounts: list[str] = None, since: str = None, until: str = None
+    ) -> dict[str, int]:
+        # re-ingests the pages in the client's archive, no requests are made
+        if self.client.archive is None:
+            raise ValueError("replay needs an archive")
+        start = time.perf_counter()
+        try:
+            self.counts = replay(self.client, self.client.archive, streams, accounts, since, until)
+        finally:
+            self.client.sink.close()
+            self.client.release_session()
+        rows = sum(self.counts.values())
+        elapsed = time.perf_counter() - start
+        LOG.info(f"Replay Complete: {rows} rows in {elapsed:.2f}s ({rows / elapsed:.0f} rows/sec)")
+        return self.counts
+
+    def daemon(
+        self,
+        interval: float = DEFAULT_INTERVAL,
+        accounts_interval: float = DEFAULT_ACCOUNTS_INTERVAL,
+        jitter: float = DEFAULT_JITTER,
+        shutdown_timeout: float = DEFAULT_SHUTDOWN_TIMEOUT,
+    ) -> int:
+        daemon = SyncDaemon(self, interval, accounts_interval, jitter, shutdown_timeout)
+        return asyncio.run(daemon.run())
+
+    def write_metrics(self, path: str):
+        extra = {"scheduler": self.client.scheduler.stats()}
+        extra["changes"] = {table: changes.stats() for table, changes in self.client.changes.items()}
+        if self.client.cache is not None:
+            extra["http_cache"] = self.client.cache.stats()
+        if self.client.archive is not None:
+            extra["archive"] = self.client.archive.stats()
+        self.client.metrics.write_summary(path, **extra)
+
+async def sync_tokens(specs: list[TokenSpec], options: dict) -> list[dict]:
+    # every token gets a client, scheduler and metrics of its own, but they all share one HTTP connector and
+    # the process' DB pool. A failing token is reported in its result and doesn't stop the others
+    connector = http_connector(len(specs))
+    claimed = {}
+
+    async def sync_token(spec: TokenSpec) -> dict:
+        start = time.perf_counter()
+        up_sync = None
+        error = None
+        try:
+            up_sync = UpSync.from_options(spec.token, options, name=spec.name)
+            up_sync.client.connector = connector
+            up_sync.client.claimed = claimed
+            # every token needs its own account list, so accounts always run
+            await up_sync.async_sync(options["streams"], with_dependencies=True)
+        except Exception as e:
+            LOG.error(f"Sync for token {spec.name} failed: {e!r}")
+            error = repr(e)
+        client = up_sync.client if up_sync else None
+        return {
+            "name": spec.name,
+            "pid": os.getpid(),
+            "rows": sum(up_sync.counts.values()) if up_sync else 0,
+            "streams": up_sync.counts if up_sync else {},
+            "seconds": round(time.perf_counter() - start, 3),
+            "error": error,
+            "requests": client.scheduler.stats() if client else RequestScheduler().stats(),
+            "changes": {table: changes.stats() for table, changes in client.changes.items()} if client else {},
+            "metrics": client.metrics.summary() if client else None,
+        }
 
-def parse_args():
+    try:
+        return await asyncio.gather(*[sync_token(spec) for spec in specs])
+    finally:
+        await connector.close()
+
+def sync_shard(specs: list[TokenSpec], options: dict) -> list[dict]:
+    return asyncio.run(sync_tokens(specs, options))
+
+def sync_manifest(specs: list[TokenSpec], options: dict, processes: int = 0) -> dict:
+    # tokens run concurrently on one event loop, or sharded over a pool of processes when parsing is what
+    # holds a sync back. Joint accounts are only deduplicated between the tokens of one process
+    start = time.perf_counter()
+    if processes > 1:
+        # spawned rather than forked so workers don't inherit open pools, each builds its own
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+            futures = [pool.submit(sync_shard, shard, options) for shard in shards(specs, processes)]
+            results = [result for future in futures for result in future.result()]
+    else:
+        results = sync_shard(specs, options)
+    summary = summarize(results, time.perf_counter() - start)
+    LOG.info(
+        f"Manifest sync complete: {summary['rows']} rows for {summary['tokens']} tokens in {summary['seconds']}s"
+    )
+    for result in results:
+        status = f"failed: {result['error']}" if result["error"] else f"{result['rows']} rows"
+        LOG.info(f"  {result['name']}: {status} in {result['seconds']}s, requests {result['requests']}")
+    return summary
+
+def stream_names(value: str) -> list[str]:
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    if (unknown := [name for name in names if name not in STREAMS]):
+        raise argparse.ArgumentTypeError(f"unknown streams {', '.join(unknown)}, choose from {', '.join(STREAMS)}")
+    return names
+
+def parse_args(argv: list[str] = None):
     parser = argparse.ArgumentParser(description="Sync Up data")
+    parser.add_argument(
+        "mode",
+        nargs="?",
+        choices=[
+            "sync",
+            "serve",
+            "daemon",
+            "replay",
+            "rebuild-rollups",
+            "check-rollups",
+            "partition-transactions",
+            "analytics",
+        ],
+        default="sync",
+        help="sync once (default), serve an Up webhook endpoint that upserts transactions as they happen, "
+             "run as a daemon syncing on an interval, replay the pages in --archive without fetching anything, "
+             "rebuild/check the daily_account_totals rollups, move transactions onto monthly partitions or "
+             "report running balances, per period totals and balance drift with numpy"
+    )
+    parser.add_argument(
+        "--streams",
+        type=stream_names,
+        required=False,
+        default=None,
+        help=f"Comma separated streams to sync (default all: {','.join(STREAMS)}), e.g. accounts,transactions"
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        required=False,
+        default=None,
+        help="JSON manifest of Up tokens to sync concurrently instead of UP_TOKEN, see the README"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        required=False,
+        default=0,
+        help="Shard the manifest's tokens over this many worker processes, by default they share one"
+    )
     parser.add_argument(
         "--lookback",
         type=int,
@@ -46,10 +395,298 @@ def parse_args():
         default=None,
         help="Number of days to look back for transactions"
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        required=False,
+        default=DEFAULT_BATCH_SIZE,
+        help="Maximum number of rows written per INSERT ... ON CONFLICT statement"
+    )
+    parser.add_argument(
+        "--copy-threshold",
+        type=int,
+        required=False,
+        default=DEFAULT_COPY_THRESHOLD,
+        help="Rows per account after which transactions are loaded with COPY into a staging table"
+    )
+    parser.add_argument(
+        "--writers",
+        type=int,
+        required=False,
+        default=DEFAULT_WRITERS,
+        help="Number of DB writer threads draining fetched transaction pages"
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        required=False,
+        default=DEFAULT_QUEUE_SIZE,
+        help="Maximum number of fetched pages buffered per writer before fetchers wait"
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        required=False,
+        default=DEFAULT_RATE_LIMIT,
+        help="Maximum requests per second sent to the Up API"
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        required=False,
+        default=DEFAULT_MAX_RETRIES,
+        help="Number of times a throttled, failed or 5xx request is retried"
+    )
+    parser.add_argument(
+        "--slice-days",
+        type=int,
+        required=False,
+        default=DEFAULT_SLICE_DAYS,
+        help="Days of transactions fetched per concurrent date slice of an account"
+    )
+    parser.add_argument(
+        "--max-slices",
+        type=int,
+        required=False,
+        default=DEFAULT_MAX_SLICES,
+        help="Maximum number of date slices fetched concurrently per account"
+    )
+    parser.add_argument(
+        "--sink",
+        choices=[PostgresSink.name, *FILE_SINKS],
+        required=False,
+        default=PostgresSink.name,
+        help="Where synced rows are written, file sinks write one file per table"
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        required=False,
+        default=DEFAULT_OUTPUT_DIR,
+        help="Directory the csv and parquet sinks write to"
+    )
+    parser.add_argument(
+        "--db-pool-size",
+        type=int,
+        required=False,
+        default=DEFAULT_POOL_SIZE,
+        help="Postgres connections kept open for the writers, shared by everything in the process"
+    )
+    parser.add_argument(
+        "--http-cache",
+        type=str,
+        required=False,
+        default=None,
+        help="Directory for an on disk cache of API responses, unchanged pages are then neither parsed nor written"
+    )
+    parser.add_argument(
+        "--http-cache-size",
+        type=int,
+        required=False,
+        default=DEFAULT_CACHE_SIZE_MB,
+        help="Maximum size of the http cache in MB, least recently used responses are evicted first"
+    )
+    parser.add_argument(
+        "--archive",
+        type=str,
+        required=False,
+        default=None,
+        help="Directory to archive the raw pages fetched in, as gzipped NDJSON segments, and that replay reads"
+    )
+    parser.add_argument(
+        "--replay-accounts",
+        type=lambda value: [account for account in value.split(",") if account],
+        required=False,
+        default=None,
+        help="Comma separated account ids whose archived transaction pages are replayed, all by default"
+    )
+    parser.add_argument(
+        "--replay-since",
+        type=str,
+        required=False,
+        default=None,
+        help="Only replay pages archived on or after this date (YYYY-MM-DD)"
+    )
+    parser.add_argument(
+        "--replay-until",
+        type=str,
+        required=False,
+        default=None,
+        help="Only replay pages archived before this date (YYYY-MM-DD)"
+    )
+    parser.add_argument(
+        "--period",
+        choices=["day", "week", "month", "year"],
+        required=False,
+        default="month",
+        help="Period the analytics mode totals each account's debits and credits by"
+    )
+    parser.add_argument(
+        "--analytics-output",
+        type=str,
+        required=False,
+        default=None,
+        help="Write the analytics report (reconciliation drift and per period totals) as JSON to this file"
+    )
+    parser.add_argument(
+        "--full-refresh",
+        action="store_true",
+        help="Write every fetched row, instead of skipping rows whose content hash matches the stored one"
+    )
+    parser.add_argument(
+        "--bounded-memory",
+        action="store_true",
+        help="Keep peak memory flat however long the lookback: a DB session per batch, stored hashes looked up "
+        "per page instead of loaded upfront and a cap on the pages in flight"
+    )
+    parser.add_argument(
+        "--max-pages-in-flight",
+        type=int,
+        required=False,
+        default=None,
+        help=f"Maximum fetched transaction pages not yet written, across all accounts "
+        f"(default {DEFAULT_MAX_PAGES_IN_FLIGHT} with --bounded-memory, otherwise only --queue-size applies)"
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        required=False,
+        default="0.0.0.0",
+        help="Address the serve mode webhook endpoint listens on"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        required=False,
+        default=8000,
+        help="Port the serve mode webhook endpoint listens on"
+    )
+    parser.add_argument(
+        "--webhook-batch-size",
+        type=int,
+        required=False,
+        default=DEFAULT_WEBHOOK_BATCH_SIZE,
+        help="Maximum number of webhook events coalesced into one fetch and upsert"
+    )
+    parser.add_argument(
+        "--webhook-flush-interval",
+        type=float,
+        required=False,
+        default=DEFAULT_FLUSH_INTERVAL,
+        help="Seconds a burst of webhook events is collected for before it's written"
+    )
+    parser.add_argument(
+        "--reconcile-interval",
+        type=float,
+        required=False,
+        default=DEFAULT_RECONCILE_INTERVAL,
+        help="Seconds between the full syncs serve mode runs as a safety net, 0 turns them off"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        required=False,
+        default=DEFAULT_INTERVAL,
+        help="Seconds between the daemon's incremental transaction syncs"
+    )
+    parser.add_argument(
+        "--accounts-interval",
+        type=float,
+        required=False,
+        default=DEFAULT_ACCOUNTS_INTERVAL,
+        help="Seconds between the daemon's syncs of accounts, categories, tags and attachments"
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        required=False,
+        default=DEFAULT_JITTER,
+        help="Fraction the daemon's intervals are randomly stretched or shrunk by, e.g. 0.1 is +-10%%"
+    )
+    parser.add_argument(
+        "--shutdown-timeout",
+        type=float,
+        required=False,
+        default=DEFAULT_SHUTDOWN_TIMEOUT,
+        help="Seconds a running daemon sync gets to finish on SIGTERM before it's cancelled between batches"
+    )
+    parser.add_argument(
+        "--metrics-output",
+        type=str,
+        required=False,
+        default=None,
+        help="Write a JSON summary of the run's counters and latency histograms to this file"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        required=False,
+        default=None,
+        help="Serve Prometheus text metrics on this port at /metrics while the sync runs, daemon mode adds /healthz"
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        required=False,
+        default=None,
+        help="Run under cProfile, writing the stats to this file and a text report next to it"
+    )
+    return parser.parse_args(argv)
+
+def main_manifest(args) -> int:
+    if args.mode != "sync":
+        sys.exit("--manifest only works with sync mode")
+    if args.metrics_port is not None:
+        # every token has metrics of its own, they're reported per token through --metrics-output
+        sys.exit("--metrics-port only works for a single token, use --metrics-output with --manifest")
+    with profiled(args.profile):
+        summary = sync_manifest(load_manifest(args.manifest), vars(args), args.processes)
+    if args.metrics_output:
+        with open(args.metrics_output, "w") as file:
+            json.dump(summary, file, indent=2, default=str)
+        LOG.info(f"Wrote run summary to {args.metrics_output}")
+    return 1 if summary["failed"] else 0
 
 if __name__ == "__main__":
     args = parse_args()
-    up_sync = UpSync(os.environ["UP_TOKEN"], args.lookback)
-    up_sync.sync()
+    if args.manifest:
+        sys.exit(main_manifest(args))
+    metrics = Metrics()
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+    if args.mode == "replay" and not args.archive:
+        sys.exit("replay needs --archive")
+    # replays and analytics make no requests, so they run without a token
+    offline = args.mode in ("replay", "analytics")
+    token = os.environ.get("UP_TOKEN", "") if offline else os.environ["UP_TOKEN"]
+    up_sync = UpSync.from_options(token, vars(args), metrics=metrics)
+    try:
+        with profiled(args.profile):
+            if args.mode == "serve":
+                up_sync.serve(
+                    os.environ["UP_WEBHOOK_SECRET"],
+                    args.host,
+                    args.port,
+                    args.webhook_batch_size,
+                    args.webhook_flush_interval,
+                    args.reconcile_interval,
+                )
+            elif args.mode == "daemon":
+                up_sync.daemon(args.interval, args.accounts_interval, args.jitter, args.shutdown_timeout)
+            elif args.mode == "replay":
+                up_sync.replay(args.streams, args.replay_accounts, args.replay_since, args.replay_until)
+            elif args.mode == "rebuild-rollups":
+                up_sync.rebuild_rollups()
+            elif args.mode == "check-rollups":
+                if up_sync.check_rollups():
+                    sys.exit(1)
+            elif args.mode == "partition-transactions":
+                up_sync.partition_transactions()
+            elif args.mode == "analytics":
+                up_sync.analytics(args.period, args.analytics_output)
+            else:
+                up_sync.sync(args.streams)
+    finally:
+        if args.metrics_output:
+            up_sync.write_metrics(args.metrics_output)
 
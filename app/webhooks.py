@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from sqlalchemy import delete
+
+from app import streams
+from app.clients import DailyAccountTotals, Transactions, UpClient
+from app.parsing import loads, parse_transaction, parse_transaction_links
+from app.sinks import BatchWriteError
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = "X-Up-Authenticity-Signature"
+UPSERT_EVENTS = {"TRANSACTION_CREATED", "TRANSACTION_SETTLED"}
+DELETE_EVENTS = {"TRANSACTION_DELETED"}
+
+DEFAULT_WEBHOOK_BATCH_SIZE = 50
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_RECONCILE_INTERVAL = 3600
+
+
+def sign(secret: str, body: bytes) -> str:
+    # Up signs the raw request body with HMAC-SHA256 keyed by the webhook's secretKey
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def verify(secret: str, body: bytes, signature: str) -> bool:
+    return bool(signature) and hmac.compare_digest(sign(secret, body), signature)
+
+
+def webhook_event(transaction_id: str = None, event_type: str = "TRANSACTION_CREATED") -> dict:
+    # the shape of an Up webhook-events payload, for tests and the local event generator
+    relationships = {"webhook": {"data": {"type": "webhooks", "id": "local"}}}
+    if transaction_id:
+        relationships["transaction"] = {"data": {"type": "transactions", "id": transaction_id}}
+    return {
+        "data": {
+            "type": "webhook-events",
+            "id": str(uuid.uuid4()),
+            "attributes": {
+                "eventType": event_type,
+                "createdAt": datetime.datetime.now(datetime.timezone.utc).strftime(Transactions.DATETIME_FORMAT),
+            },
+            "relationships": relationships,
+        }
+    }
+
+
+def json_response(body: dict, status: int = 200) -> web.Response:
+    # aiohttp's server side is only imported once serve mode is actually answering requests
+    from aiohttp import web
+
+    return web.json_response(body, status=status)
+
+
+def signed_request(secret: str, event: dict) -> tuple[bytes, dict]:
+    body = json.dumps(event).encode()
+    return body, {SIGNATURE_HEADER: sign(secret, body), "Content-Type": "application/json"}
+
+
+# Receives Up webhook events, verifies their signature and queues the referenced transaction. Events
+# are acknowledged straight away and a flusher coalesces bursts (up to batch_size events, or whatever
+# arrived within flush_interval of the first one) into one fetch round and one upsert. A periodic
+# reconciliation sync stays on as a safety net for events that were missed.
+class WebhookReceiver:
+    def __init__(
+        self,
+        client: UpClient,
+        secret: str,
+        batch_size: int = DEFAULT_WEBHOOK_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        reconcile_interval: float = DEFAULT_RECONCILE_INTERVAL,
+    ):
+        self.client = client
+        self.secret = secret
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.reconcile_interval = reconcile_interval
+        self.queue = None
+        # held by reconciliation and account refreshes, which share the client's session
+        self._syncing = None
+        # db_batch_errors when the http cache index was last saved
+        self._cache_errors = 0
+        self._executor = None
+        self._tasks = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        if not verify(self.secret, body, request.headers.get(SIGNATURE_HEADER)):
+            self.client.metrics.inc("webhook_events", result="invalid_signature")
+            return json_response({"error": "invalid signature"}, status=401)
+        try:
+            data = loads(body)["data"]
+            event_type = data["attributes"]["eventType"]
+        except (ValueError, KeyError, TypeError):
+            self.client.metrics.inc("webhook_events", result="invalid")
+            return json_response({"error": "invalid event"}, status=400)
+        self.client.metrics.inc("webhook_events", result="accepted", event=event_type)
+        transaction = ((data.get("relationships") or {}).get("transaction") or {}).get("data") or {}
+        if event_type in UPSERT_EVENTS | DELETE_EVENTS and transaction.get("id"):
+            await self.queue.put((event_type, transaction["id"], data["attributes"].get("createdAt")))
+        return json_response({"status": "ok"})
+
+    async def health(self, request: web.Request) -> web.Response:
+        return json_response({"status": "ok", "queued": self.queue.qsize() if self.queue else 0})
+
+    async def _next_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size and (timeout := deadline - loop.time()) > 0:
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _fetch(self, transaction_id: str):
+        async for page in self.client.async_get_request(endpoint=f"transactions/{transaction_id}"):
+            data = page["data"]
+            account_id = data["relationships"]["account"]["data"]["id"]
+            return parse_transaction(data, account_id), parse_transaction_links(data)
+
+    def _write(self, rows: list, links: dict, deleted: list) -> int:
+        statements = []
+        touched = set()
+        if deleted:
+            # no links left for a deleted transaction, and the daily totals of the days it was on change
+            statements = Transactions.link_statements({id: (None, []) for id in deleted})
+            statements.append(delete(Transactions.__table__).where(Transactions.id.in_(deleted)))
+            touched = DailyAccountTotals.stored_keys(self.client.sink.session, deleted)
+        return Transactions.write_batch(self.client, rows, links, statements, touched)
+
+    async def flush(self, batch: list):
+        loop = asyncio.get_running_loop()
+        # the last event per transaction wins, e.g. CREATED then SETTLED within one window is one fetch
+        events = {transaction_id: event_type for event_type, transaction_id, _ in batch}
+        upserts = [id for id, event_type in events.items() if event_type in UPSERT_EVENTS]
+        deleted = [id for id, event_type in events.items() if event_type in DELETE_EVENTS]
+        results = await asyncio.gather(*[self._fetch(id) for id in upserts], return_exceptions=True)
+        rows = []
+        links = {}
+        for transaction_id, result in zip(upserts, results):
+            if isinstance(result, Exception):
+                LOG.error(f"Failed to fetch webhook transaction {transaction_id}: {result}")
+                self.client.metrics.inc("webhook_fetch_errors")
+            elif result is not None:
+                rows.append(result[0])
+                links[result[0].id] = result[1]
+        try:
+            try:
+                written = await loop.run_in_executor(self._executor, self._write, rows, links, deleted)
+            except BatchWriteError:
+                # most likely a transaction on an account we haven't synced yet
+                LOG.warning("Webhook batch failed to write, syncing accounts and retrying")
+                async with self._syncing:
+                    await self.sync_accounts()
+                written = await loop.run_in_executor(self._executor, self._write, rows, links, deleted)
+        except BatchWriteError as e:
+            LOG.error(e)
+            return
+        now = time.time()
+        for _, _, created_at in batch:
+            if created_at:
+                lag = now - datetime.datetime.fromisoformat(created_at).timestamp()
+                self.client.metrics.observe("webhook_lag_seconds", max(0.0, lag))
+        self.client.metrics.observe("webhook_batch_size", len(batch))
+        LOG.info(f"Webhook batch of {len(batch)} events: upserted {written}, deleted {len(deleted)}")
+
+    async def _flush_loop(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self.flush(batch)
+            except Exception as e:
+                LOG.error(f"Failed to flush webhook batch: {e!r}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def sync_accounts(self) -> int:
+        # fetched on the event loop like the webhook transactions, the http cache and request scheduler
+        # are only ever touched from the loop's thread
+        return await streams.sync_accounts(self.client, streams.STREAMS["accounts"])
+
+    async def reconcile(self):
+        async with self._syncing:
+            LOG.info("Running reconciliation sync")
+            errors = self.client.metrics.counter("db_batch_errors")
+            await self.sync_accounts()
+            await Transactions.sync_transactions(self.client)
+            self.client.save_cache(errors)
+            self._cache_errors = self.client.metrics.counter("db_batch_errors")
+
+    async def _reconcile_loop(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                LOG.error(f"Reconciliation sync failed: {e!r}")
+
+    async def start(self, app: web.Application = None):
+        self.queue = asyncio.Queue()
+        self._syncing = asyncio.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._cache_errors = self.client.metrics.counter("db_batch_errors")
+        await self.client.__aenter__()
+        self._tasks = [asyncio.create_task(self._flush_loop())]
+        if self.reconcile_interval:
+            self._tasks.append(asyncio.create_task(self._reconcile_loop()))
+
+    async def stop(self, app: web.Application = None):
+        # whatever was acknowledged gets written before shutting down
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown()
+        self.client.save_cache(self._cache_errors)
+        await self.client.__aexit__()
+        self.client.sink.close()
+        self.client.release_session()
+
+    def app(self, path: str = "/webhook") -> web.Application:
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        app.router.add_get("/healthz", self.health)
+        app.on_startup.append(self.start)
+        app.on_cleanup.append(self.stop)
+        return app
@@ -32,6 +32,8 @@ CREATE TABLE transactions (
         REFERENCES accounts(id)
 );
 
+-- later schema changes are versioned migrations in app/migrations, applied at startup
+
 -- copy production to a test database
 CREATE DATABASE test
 WITH TEMPLATE postgres